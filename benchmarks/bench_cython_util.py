@@ -0,0 +1,104 @@
+"""Benchmarks for the Cython kernels in the module dep.cython_util.
+
+The most recent version of the code can be found on GitHub:
+https://github.com/gelman/ep-stan
+
+"""
+
+# Licensed under the 3-clause BSD license.
+# http://opensource.org/licenses/BSD-3-Clause
+#
+# Copyright (C) 2014 Tuomas Sivula
+# All rights reserved.
+
+from __future__ import division
+import numpy as np
+
+from dep.cython_util import (
+    copy_triu_to_tril,
+    auto_outer,
+    ravel_triu,
+    unravel_triu,
+    fro_norm_squared,
+    copy_triu_to_tril_stack,
+    ravel_triu_stack,
+    unravel_triu_stack,
+    fro_norm_squared_stack
+)
+
+
+class AutoOuter(object):
+    
+    params = ([10, 50, 100], [1000, 4000], ['float64', 'float32'])
+    param_names = ['dphi', 'n', 'dtype']
+    
+    def setup(self, dphi, n, dtype):
+        self.A = np.random.RandomState(0).randn(n, dphi).astype(dtype)
+        self.out = np.empty((n, dphi*(dphi+1)//2), dtype=dtype)
+    
+    def time_auto_outer(self, dphi, n, dtype):
+        auto_outer(self.A, self.out)
+
+
+class TriangularKernels(object):
+    
+    params = ([10, 50, 100, 500, 2000], ['float64', 'float32'])
+    param_names = ['dphi', 'dtype']
+    
+    def setup(self, dphi, dtype):
+        rnd = np.random.RandomState(0)
+        self.A_C = rnd.randn(dphi, dphi).astype(dtype)
+        self.A_F = np.asfortranarray(self.A_C)
+        self.vec = np.empty(dphi*(dphi+1)//2, dtype=dtype)
+    
+    def time_copy_triu_to_tril_C(self, dphi, dtype):
+        copy_triu_to_tril(self.A_C)
+    
+    def time_copy_triu_to_tril_F(self, dphi, dtype):
+        copy_triu_to_tril(self.A_F)
+    
+    def time_ravel_triu(self, dphi, dtype):
+        ravel_triu(self.A_C, self.vec)
+    
+    def time_unravel_triu(self, dphi, dtype):
+        unravel_triu(self.vec, self.A_C)
+    
+    def time_fro_norm_squared(self, dphi, dtype):
+        fro_norm_squared(self.A_C)
+
+
+class StackedKernels(object):
+    """Stacked kernels vs. a Python loop over the sites."""
+    
+    params = ([5, 20, 50], [100, 1000])
+    param_names = ['dphi', 'K']
+    
+    def setup(self, dphi, K):
+        rnd = np.random.RandomState(0)
+        self.A = np.asfortranarray(rnd.randn(dphi, dphi, K))
+        self.vecs = np.empty((dphi*(dphi+1)//2, K), order='F')
+        self.norms = np.empty(K)
+    
+    def time_copy_triu_to_tril_loop(self, dphi, K):
+        for k in xrange(K):
+            copy_triu_to_tril(self.A[:,:,k])
+    
+    def time_copy_triu_to_tril_stack(self, dphi, K):
+        copy_triu_to_tril_stack(self.A)
+    
+    def time_ravel_triu_loop(self, dphi, K):
+        for k in xrange(K):
+            ravel_triu(self.A[:,:,k], self.vecs[:,k])
+    
+    def time_ravel_triu_stack(self, dphi, K):
+        ravel_triu_stack(self.A, self.vecs)
+    
+    def time_unravel_triu_stack(self, dphi, K):
+        unravel_triu_stack(self.vecs, self.A)
+    
+    def time_fro_norm_squared_loop(self, dphi, K):
+        for k in xrange(K):
+            self.norms[k] = fro_norm_squared(self.A[:,:,k])
+    
+    def time_fro_norm_squared_stack(self, dphi, K):
+        fro_norm_squared_stack(self.A, self.norms)
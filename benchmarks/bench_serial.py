@@ -0,0 +1,176 @@
+"""Benchmarks for the classes Worker and Master in the module dep.serial.
+
+The tilted distributions are sampled exactly with the mock site model
+dep.mock.GaussianSiteModel so that the timings measure the EP machinery instead
+of the MCMC.
+
+The most recent version of the code can be found on GitHub:
+https://github.com/gelman/ep-stan
+
+"""
+
+# Licensed under the 3-clause BSD license.
+# http://opensource.org/licenses/BSD-3-Clause
+#
+# Copyright (C) 2014 Tuomas Sivula
+# All rights reserved.
+
+from __future__ import division
+import numpy as np
+
+from dep.serial import Worker, Master
+from dep.mock import GaussianSiteModel
+
+
+def _master(dphi, K, Nk=20, **kwargs):
+    rnd = np.random.RandomState(0)
+    X = rnd.randn(K*Nk, dphi)
+    y = X.dot(rnd.randn(dphi)) + rnd.randn(K*Nk)
+    return Master(GaussianSiteModel(exact_moments=True), X, y, dphi=dphi,
+                  site_sizes=np.repeat(Nk, K), init_prev=False, seed=0,
+                  iter=4*dphi, warmup=2*dphi, thin=1, **kwargs)
+
+
+class WorkerCavity(object):
+    
+    params = [10, 50, 100, 500]
+    param_names = ['dphi']
+    
+    def setup(self, dphi):
+        rnd = np.random.RandomState(0)
+        self.worker = Worker(0, None, dphi, rnd.randn(10, dphi), rnd.randn(10))
+        self.Q = np.asfortranarray(np.eye(dphi)*10)
+        self.r = rnd.randn(dphi)
+        self.Qi = np.asfortranarray(np.eye(dphi))
+        self.ri = rnd.randn(dphi)
+        self.dQi = np.asfortranarray(np.eye(dphi)*0.5)
+        self.dri = rnd.randn(dphi)
+    
+    def time_cavity(self, dphi):
+        self.worker.cavity(self.Q, self.r, self.Qi, self.ri)
+    
+    def time_cavity_damped(self, dphi):
+        self.worker.cavity(self.Q, self.r, self.Qi, self.ri,
+                           dQi=self.dQi, dri=self.dri, df=0.5)
+
+
+class MasterRun(object):
+    
+    params = ([5, 20, 50], [10, 100, 1000])
+    param_names = ['dphi', 'K']
+    timeout = 300
+    
+    def setup(self, dphi, K):
+        self.master = _master(dphi, K)
+        # Run two iterations so that the timed ones include damping
+        self.master.run(2, verbose=False)
+    
+    def time_iteration(self, dphi, K):
+        self.master.run(1, verbose=False)
+    
+    def peakmem_iteration(self, dphi, K):
+        self.master.run(1, verbose=False)
+    
+    def time_mix_samples(self, dphi, K):
+        self.master.mix_samples()
+
+
+class MasterRunDtype(object):
+    """Site parameter storage in double vs. single precision."""
+    
+    params = ([50, 200], [100, 500], ['float64', 'float32'])
+    param_names = ['dphi', 'K', 'dtype']
+    timeout = 600
+    
+    def setup(self, dphi, K, dtype):
+        self.master = _master(dphi, K, Nk=dphi, dtype=dtype)
+        self.master.run(2, verbose=False)
+    
+    def time_iteration(self, dphi, K, dtype):
+        self.master.run(1, verbose=False)
+    
+    def peakmem_iteration(self, dphi, K, dtype):
+        self.master.run(1, verbose=False)
+    
+    def track_site_param_bytes(self, dphi, K, dtype):
+        m = self.master
+        return m.Qi.nbytes + m.ri.nbytes + m.dQi.nbytes + m.dri.nbytes
+
+
+class MasterRunSmooth(object):
+    """Smoothing over five previous iterations vs. the recursive smoothing."""
+    
+    params = ([20, 50], [100, 500], ['list', 'recursive'])
+    param_names = ['dphi', 'K', 'smooth']
+    timeout = 300
+    
+    def setup(self, dphi, K, smooth):
+        if smooth == 'list':
+            smooth = [0.5**i for i in xrange(1, 6)]
+        else:
+            smooth = 0.5
+        self.master = _master(dphi, K, smooth=smooth, smooth_ignore=0)
+        self.master.run(2, verbose=False)
+    
+    def time_iteration(self, dphi, K, smooth):
+        self.master.run(1, verbose=False)
+    
+    def peakmem_iteration(self, dphi, K, smooth):
+        self.master.run(1, verbose=False)
+
+
+class MasterRunGroups(object):
+    """Flat sum over the sites vs. summing through the site groups."""
+    
+    params = ([5, 50], [1000, 10000], [None, 100])
+    param_names = ['dphi', 'K', 'site_groups']
+    timeout = 600
+    
+    def setup(self, dphi, K, site_groups):
+        self.master = _master(dphi, K, Nk=dphi, site_groups=site_groups,
+                              df_pergroup=site_groups is not None)
+        self.master.run(2, verbose=False)
+    
+    def time_iteration(self, dphi, K, site_groups):
+        self.master.run(1, verbose=False)
+
+
+class MasterInit(object):
+    """Construction of Master with sorted and unsorted site indices."""
+    
+    params = ([10**5, 10**6], [100, 1000], ['sizes', 'sorted', 'unsorted'])
+    param_names = ['N', 'K', 'site_def']
+    
+    def setup(self, N, K, site_def):
+        rnd = np.random.RandomState(0)
+        self.X = rnd.randn(N, 5)
+        self.y = rnd.randn(N)
+        self.A_n = {'z': rnd.randn(N)}
+        k_ind = rnd.randint(K, size=N)
+        if site_def == 'sizes':
+            self.site = {'site_sizes': np.bincount(k_ind, minlength=K)}
+        elif site_def == 'sorted':
+            self.site = {'site_ind': np.sort(k_ind)}
+        else:
+            self.site = {'site_ind': k_ind}
+    
+    def time_init(self, N, K, site_def):
+        Master(GaussianSiteModel(), self.X, self.y, dphi=5, A_n=self.A_n,
+               seed=0, **self.site)
+
+
+class MasterInitLazy(object):
+    """Construction of Master with all the workers vs. lazy workers."""
+    
+    params = ([10**3, 10**4, 10**5], [None, 100])
+    param_names = ['K', 'max_workers']
+    timeout = 600
+    
+    def setup(self, K, max_workers):
+        rnd = np.random.RandomState(0)
+        self.X = rnd.randn(2*K, 5)
+        self.y = rnd.randn(2*K)
+    
+    def time_init(self, K, max_workers):
+        Master(GaussianSiteModel(), self.X, self.y, dphi=5,
+               site_sizes=np.full(K, 2), seed=0, max_workers=max_workers)
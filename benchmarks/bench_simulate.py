@@ -0,0 +1,49 @@
+"""Benchmarks for the data generators in the module dep.simulate.
+
+The most recent version of the code can be found on GitHub:
+https://github.com/gelman/ep-stan
+
+"""
+
+# Licensed under the 3-clause BSD license.
+# http://opensource.org/licenses/BSD-3-Clause
+#
+# Copyright (C) 2014 Tuomas Sivula
+# All rights reserved.
+
+from __future__ import division
+import shutil
+import tempfile
+
+from dep.simulate import simulate_m2, simulate_stars
+
+
+class SimulateM2(object):
+    
+    params = [10**4, 10**6]
+    param_names = ['N']
+    timeout = 300
+    
+    def setup(self, N):
+        self.out_dir = tempfile.mkdtemp()
+    
+    def teardown(self, N):
+        shutil.rmtree(self.out_dir)
+    
+    def time_simulate(self, N):
+        simulate_m2(N//50, 10, 50, seed=0)
+    
+    def peakmem_simulate(self, N):
+        simulate_m2(N//50, 10, 50, seed=0)
+    
+    def peakmem_simulate_memmap(self, N):
+        simulate_m2(N//50, 10, 50, seed=0, out_dir=self.out_dir)
+
+
+class SimulateStars(object):
+    
+    params = [10**4, 10**6]
+    param_names = ['N']
+    
+    def time_simulate(self, N):
+        simulate_stars(N//20, 20, seed=0)
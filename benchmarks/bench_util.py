@@ -0,0 +1,144 @@
+"""Benchmarks for the numerical utilities in the module dep.util.
+
+The most recent version of the code can be found on GitHub:
+https://github.com/gelman/ep-stan
+
+"""
+
+# Licensed under the 3-clause BSD license.
+# http://opensource.org/licenses/BSD-3-Clause
+#
+# Copyright (C) 2014 Tuomas Sivula
+# All rights reserved.
+
+from __future__ import division
+import numpy as np
+
+from dep.util import (
+    invert_normal_params, invert_normal_params_stack, olse, cv_moments,
+    merge_moments
+)
+
+
+def random_cov(d, rnd):
+    """Generate a well conditioned random covariance matrix in F-order."""
+    A = rnd.randn(d, 2*d)
+    S = A.dot(A.T) / (2*d)
+    S.flat[::d+1] += 0.1
+    return np.asfortranarray(S)
+
+
+class InvertNormalParams(object):
+    
+    params = [10, 50, 100, 500]
+    param_names = ['dphi']
+    
+    def setup(self, dphi):
+        rnd = np.random.RandomState(0)
+        self.S = random_cov(dphi, rnd)
+        self.m = rnd.randn(dphi)
+        self.out_A = np.empty((dphi,dphi), order='F')
+        self.out_b = np.empty(dphi)
+    
+    def time_invert_normal_params(self, dphi):
+        invert_normal_params(self.S, self.m, out_A=self.out_A,
+                             out_b=self.out_b)
+
+
+class InvertNormalParamsStack(object):
+    """Stacked inversion vs. a Python loop over the sites."""
+    
+    params = ([5, 20, 50], [100, 1000])
+    param_names = ['dphi', 'K']
+    
+    def setup(self, dphi, K):
+        rnd = np.random.RandomState(0)
+        self.S = np.empty((dphi,dphi,K), order='F')
+        for k in xrange(K):
+            self.S[:,:,k] = random_cov(dphi, rnd)
+        self.m = rnd.randn(dphi, K)
+        self.out_A = np.empty((dphi,dphi,K), order='F')
+        self.out_b = np.empty((dphi,K), order='F')
+    
+    def time_loop(self, dphi, K):
+        for k in xrange(K):
+            invert_normal_params(self.S[:,:,k], self.m[:,k],
+                                 out_A=self.out_A[:,:,k],
+                                 out_b=self.out_b[:,k])
+    
+    def time_stack(self, dphi, K):
+        invert_normal_params_stack(self.S, self.m, out_A=self.out_A,
+                                   out_b=self.out_b)
+
+
+class MergeMoments(object):
+    """Pairwise merge of the site moments as in Master.mix_samples."""
+    
+    params = ([5, 50], [1000, 10000])
+    param_names = ['dphi', 'K']
+    
+    def setup(self, dphi, K):
+        rnd = np.random.RandomState(0)
+        self.n = np.full(K, 1000.0)
+        self.m = rnd.randn(K, dphi)
+        self.M2 = np.empty((K, dphi, dphi))
+        self.M2[:] = random_cov(dphi, rnd) * 999
+    
+    def time_merge_moments(self, dphi, K):
+        merge_moments(self.n, self.m.copy(), self.M2.copy())
+
+
+class Olse(object):
+    
+    params = ([10, 50, 100, 500], [1000, 4000])
+    param_names = ['dphi', 'n']
+    
+    def setup(self, dphi, n):
+        rnd = np.random.RandomState(0)
+        self.S = random_cov(dphi, rnd)
+        self.P = np.asfortranarray(np.linalg.inv(random_cov(dphi, rnd)))
+        self.out = np.empty((dphi,dphi), order='F')
+    
+    def time_olse_naive_prior(self, dphi, n):
+        olse(self.S, n, out=self.out)
+    
+    def time_olse_prior(self, dphi, n):
+        olse(self.S, n, P=self.P, out=self.out)
+
+
+class CvMoments(object):
+    
+    params = ([2, 5, 10, 20, 50], [200, 1000], [True, False])
+    param_names = ['dphi', 'n', 'multiple_cv']
+    
+    def setup(self, dphi, n, multiple_cv):
+        rnd = np.random.RandomState(0)
+        S = random_cov(dphi, rnd)
+        m = rnd.randn(dphi)
+        cho = np.linalg.cholesky(S)
+        self.samp = m + rnd.randn(n, dphi).dot(cho.T)
+        dev = np.linalg.solve(cho, (self.samp - m).T)
+        self.lp = (- 0.5*np.sum(dev**2, axis=0)
+                   - np.sum(np.log(np.diag(cho)))
+                   - 0.5*dphi*np.log(2*np.pi))
+        # Slightly different control variate distribution
+        self.Q_tilde, self.r_tilde = invert_normal_params(
+            S*1.05, m + 0.05*rnd.randn(dphi))
+    
+    def time_cv_moments(self, dphi, n, multiple_cv):
+        cv_moments(self.samp.copy(), self.lp.copy(), self.Q_tilde,
+                   self.r_tilde, multiple_cv=multiple_cv, m_treshold=None)
+    
+    def peakmem_cv_moments(self, dphi, n, multiple_cv):
+        cv_moments(self.samp.copy(), self.lp.copy(), self.Q_tilde,
+                   self.r_tilde, multiple_cv=multiple_cv, m_treshold=None)
+    
+    def time_cv_moments_blocks(self, dphi, n, multiple_cv):
+        cv_moments(self.samp.copy(), self.lp.copy(), self.Q_tilde,
+                   self.r_tilde, multiple_cv=multiple_cv, m_treshold=None,
+                   block_size=64)
+    
+    def peakmem_cv_moments_blocks(self, dphi, n, multiple_cv):
+        cv_moments(self.samp.copy(), self.lp.copy(), self.Q_tilde,
+                   self.r_tilde, multiple_cv=multiple_cv, m_treshold=None,
+                   block_size=64)
@@ -0,0 +1,349 @@
+"""Persistent capture of the output of the site models.
+
+Stan writes its progress and diagnostic messages directly into the file
+descriptors 1 and 2, also from the processes running the chains, so that they
+can not be captured by replacing sys.stdout. The class OutputCapture redirects
+the descriptors once per process into an anonymous capture file. When a site
+call ends, only the output written during the call is moved from the capture
+file into the sink of the site, e.g. a RingBuffer keeping the latest output in
+memory or a RotatingLog file. The output written outside the site calls is
+passed through to the original stdout. The Python level streams sys.stdout and
+sys.stderr are rebound to the original descriptors, so that print statements
+are not captured.
+
+Compared to redirecting the descriptors on every call (see util.suppress_stdout)
+a call costs only a few system calls and no descriptors are opened or
+duplicated. The redirection stays in effect until OutputCapture.stop is
+called, which Master.run does in the end of the run; it is also called at the
+exit of the process. The workers use the capture only if the site has a sink
+(see the option stan_output of serial.Master), otherwise the output is
+discarded only during each call with util.suppress_stdout.
+
+N.B. Concurrent sites are supported only in separate processes, which have
+separate captures (see get_capture). As the descriptors are shared by the whole
+process, the output of sites running concurrently in the same process, e.g. in
+threads, can not be told apart. Such calls are therefore rejected with a
+CaptureError instead of being captured.
+
+Example:
+    >>> sink = RingBuffer()
+    >>> with get_capture().site(sink):
+    ...     fit = stan_model.sampling(...)
+    >>> print sink.getvalue()
+
+The most recent version of the code can be found on GitHub:
+https://github.com/gelman/ep-stan
+
+"""
+
+# Licensed under the 3-clause BSD license.
+# http://opensource.org/licenses/BSD-3-Clause
+#
+# Copyright (C) 2014 Tuomas Sivula
+# All rights reserved.
+
+from __future__ import division
+import os
+import sys
+import tempfile
+import threading
+import collections
+import ctypes
+import atexit
+from contextlib import contextmanager
+
+
+# The capture file is truncated when it grows larger than this
+TRUNCATE_SIZE = 2**20
+
+_start_lock = threading.Lock()
+
+
+class CaptureError(Exception):
+    """Raised if the output of a site can not be captured.
+    
+    Not derived from RuntimeError, so that it is not taken for a failure of
+    the site model (see tilted.StanSampler.sample).
+    
+    """
+    pass
+
+
+try:
+    _libc = ctypes.CDLL(None)
+    def _flush_c():
+        """Flush the buffers of the C standard streams."""
+        _libc.fflush(None)
+except (OSError, AttributeError):
+    def _flush_c():
+        pass
+
+
+class RingBuffer(object):
+    """In-memory sink keeping the last `maxlen` bytes of the output."""
+    
+    def __init__(self, maxlen=2**16):
+        if maxlen < 1:
+            raise ValueError("Arg. `maxlen` has to be positive")
+        self.maxlen = maxlen
+        self.chunks = collections.deque()
+        self.size = 0
+    
+    def write(self, data):
+        if len(data) >= self.maxlen:
+            self.chunks.clear()
+            self.size = 0
+            data = data[-self.maxlen:]
+        self.chunks.append(data)
+        self.size += len(data)
+        # Drop the oldest output
+        while self.size > self.maxlen:
+            excess = self.size - self.maxlen
+            first = self.chunks[0]
+            if len(first) <= excess:
+                self.chunks.popleft()
+                self.size -= len(first)
+            else:
+                self.chunks[0] = first[excess:]
+                self.size -= excess
+    
+    def getvalue(self):
+        """Return the stored output as a string."""
+        return ''.join(self.chunks)
+    
+    def close(self):
+        pass
+
+
+class RotatingLog(object):
+    """Sink appending the output into a log file.
+    
+    When the file would grow larger than `max_bytes`, it is renamed to
+    filename.1 (the older ones to filename.2, ... filename.<backups>) and a new
+    file is started. The file is opened on the first write.
+    
+    """
+    
+    def __init__(self, filename, max_bytes=2**20, backups=2):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.f = None
+        self.size = 0
+    
+    def write(self, data):
+        if self.f is None:
+            self.f = open(self.filename, 'ab')
+            self.size = os.path.getsize(self.filename)
+        if self.max_bytes and self.size > 0 \
+           and self.size + len(data) > self.max_bytes:
+            self.rotate()
+        self.f.write(data)
+        self.f.flush()
+        self.size += len(data)
+    
+    def rotate(self):
+        """Move the current file into the backups and start a new one."""
+        self.f.close()
+        for i in xrange(self.backups-1, 0, -1):
+            src = '{}.{}'.format(self.filename, i)
+            if os.path.exists(src):
+                os.rename(src, '{}.{}'.format(self.filename, i+1))
+        if self.backups > 0:
+            os.rename(self.filename, self.filename + '.1')
+        else:
+            os.remove(self.filename)
+        self.f = open(self.filename, 'wb')
+        self.size = 0
+    
+    def getvalue(self):
+        """Return the content of the current file as a string."""
+        if not os.path.exists(self.filename):
+            return ''
+        with open(self.filename, 'rb') as f:
+            return f.read()
+    
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
+
+class _FdWriter(object):
+    """Sink writing the output into a file descriptor."""
+    
+    def __init__(self, fd):
+        self.fd = fd
+    
+    def write(self, data):
+        while data:
+            data = data[os.write(self.fd, data):]
+
+
+def make_sink(spec, index=None):
+    """Create the output sink of a site.
+    
+    Parameters
+    ----------
+    spec : {None, 'ring', str, object}
+        None discards the output, 'ring' creates a RingBuffer and other strings
+        are interpreted as a directory where a RotatingLog site_<index>.log is
+        created. Other objects having the method write are returned as is.
+    
+    index : int, optional
+        The index of the site.
+    
+    """
+    if spec is None or hasattr(spec, 'write'):
+        return spec
+    if spec == 'ring':
+        return RingBuffer()
+    if isinstance(spec, basestring):
+        if not os.path.exists(spec):
+            os.makedirs(spec)
+        return RotatingLog(os.path.join(spec, 'site_{}.log'.format(index)))
+    raise ValueError("Invalid output sink {!r}".format(spec))
+
+
+class OutputCapture(object):
+    """Redirection of the file descriptors 1 and 2 into per-site sinks.
+    
+    The redirection is started on the first call of the method site, or
+    explicitly with the method start, and it stays in effect until the method
+    stop is called or the process exits. Only one site can be captured at a
+    time in a process (see CaptureError).
+    
+    """
+    
+    def __init__(self, truncate_size=TRUNCATE_SIZE):
+        self.truncate_size = truncate_size
+        self.pid = None
+        self.lock = threading.RLock()
+        # The thread running the current site call
+        self.active = None
+        self.exit_registered = False
+    
+    def start(self):
+        """Redirect the descriptors 1 and 2 into the capture file."""
+        if self.pid == os.getpid():
+            return
+        with _start_lock:
+            if self.pid != os.getpid():
+                self._start()
+    
+    def _start(self):
+        # N.B. a forked child process does not share the lock or the file
+        self.lock = threading.RLock()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        _flush_c()
+        # Anonymous file in append mode, so that the writes of all the
+        # processes go to the end also after truncating
+        fd, name = tempfile.mkstemp(prefix='epstan_output_')
+        os.close(fd)
+        self.fd = os.open(name, os.O_RDWR | os.O_APPEND)
+        os.unlink(name)
+        self.offset = 0
+        self.saved_fds = (os.dup(1), os.dup(2))
+        self.passthrough = _FdWriter(self.saved_fds[0])
+        # Rebind the Python streams using the descriptors 1 and 2
+        self.saved_streams = (sys.stdout, sys.stderr)
+        sys.stdout = self._rebind(sys.stdout, 1, 0)
+        sys.stderr = self._rebind(sys.stderr, 2, 1)
+        os.dup2(self.fd, 1)
+        os.dup2(self.fd, 2)
+        self.pid = os.getpid()
+        self.active = None
+        if not self.exit_registered:
+            # Restore the descriptors also if stop is never called
+            atexit.register(self.stop)
+            self.exit_registered = True
+    
+    def _rebind(self, stream, fd, i):
+        try:
+            if stream.fileno() != fd:
+                return stream
+        except (AttributeError, ValueError, IOError):
+            return stream
+        return os.fdopen(os.dup(self.saved_fds[i]), stream.mode, 1)
+    
+    def stop(self):
+        """Pass the pending output through and restore the descriptors.
+        
+        Does nothing if a site call is in progress.
+        
+        """
+        if self.pid != os.getpid():
+            return
+        with self.lock:
+            if not self.active is None:
+                return
+            self.collect(self.passthrough)
+            for (i, stream) in enumerate((sys.stdout, sys.stderr)):
+                if stream is not self.saved_streams[i]:
+                    stream.close()
+            sys.stdout, sys.stderr = self.saved_streams
+            os.dup2(self.saved_fds[0], 1)
+            os.dup2(self.saved_fds[1], 2)
+            os.close(self.saved_fds[0])
+            os.close(self.saved_fds[1])
+            os.close(self.fd)
+            self.pid = None
+    
+    def collect(self, sink):
+        """Move the output written after the previous call into `sink`.
+        
+        If `sink` is None, the output is discarded.
+        
+        """
+        with self.lock:
+            _flush_c()
+            end = os.fstat(self.fd).st_size
+            if end > self.offset and sink is not None:
+                os.lseek(self.fd, self.offset, os.SEEK_SET)
+                chunks = []
+                left = end - self.offset
+                while left > 0:
+                    data = os.read(self.fd, left)
+                    if not data:
+                        break
+                    chunks.append(data)
+                    left -= len(data)
+                sink.write(''.join(chunks))
+            if end >= self.truncate_size and os.fstat(self.fd).st_size == end:
+                os.ftruncate(self.fd, 0)
+                end = 0
+            self.offset = end
+    
+    @contextmanager
+    def site(self, sink):
+        """Context capturing the output written inside it into `sink`.
+        
+        The output pending from outside the site calls is passed through to
+        the original stdout first. If `sink` is None, the output is discarded.
+        Raises CaptureError if another site call is in progress in this
+        process.
+        
+        """
+        self.start()
+        with self.lock:
+            if not self.active is None:
+                raise CaptureError("Concurrent site calls in the same process "
+                                   "are not supported, run the sites in "
+                                   "separate processes")
+            self.active = threading.current_thread().ident
+        try:
+            self.collect(self.passthrough)
+            yield sink
+        finally:
+            try:
+                self.collect(sink)
+            finally:
+                self.active = None
+
+
+_capture = OutputCapture()
+
+def get_capture():
+    """Return the output capture of the current process."""
+    return _capture
@@ -1,4 +1,14 @@
-"""This module contains some Cython utilities."""
+"""This module contains some Cython utilities.
+
+The functions accept both float64 and float32 arrays (all the array arguments
+of one call must have the same type). If the module is compiled with OpenMP
+(see setup.py), the loops over large arrays are run in parallel.
+
+The functions ending with _stack operate on stacks of matrices of shape
+(d,d,K), e.g. the site parameters Qi in Master, processing each slice [:,:,k]
+in one call.
+
+"""
 
 # Licensed under the 3-clause BSD license.
 # http://opensource.org/licenses/BSD-3-Clause
@@ -6,15 +16,37 @@
 # Copyright (C) 2014 Tuomas Sivula
 # All rights reserved.
 
-import numpy as np
 cimport cython
-cimport numpy as np
-ctypedef np.float64_t DTYPE_t
+from cython cimport floating
+from cython.parallel cimport prange
+from scipy.linalg.cython_lapack cimport (
+    dpotrf, dpotrs, dpotri, spotrf, spotrs, spotri
+)
+
+
+cdef enum:
+    # Minimum number of elements processed in parallel
+    PAR_MIN = 20000
+    # Side length of the tiles in the cache blocked traversal
+    TILE = 32
+
+
+cdef inline Py_ssize_t _triu_len(Py_ssize_t d) noexcept nogil:
+    """Calculate d+1 choose 2."""
+    if d % 2 == 0:
+        return (d >> 1) * (d+1)
+    else:
+        return ((d+1) >> 1) * d
+
+
+cdef inline Py_ssize_t _triu_row_start(Py_ssize_t x, Py_ssize_t d) noexcept nogil:
+    """Index of the element (x,x) in the raveled upper triangular."""
+    return x*d - ((x*(x-1)) >> 1)
 
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-def fro_norm_squared(np.ndarray[DTYPE_t, ndim=2] A):
+def fro_norm_squared(const floating[:,:] A):
     """Squared Frobenius norm of matrix.
     
     Parameters
@@ -24,25 +56,47 @@ def fro_norm_squared(np.ndarray[DTYPE_t, ndim=2] A):
     
     Returns
     -------
-    out : ndarray
-        Squared frobenius norm, i.e. np.sum(A**2)
+    out : float
+        Squared frobenius norm, i.e. np.sum(A**2), accumulated in double
+        precision.
     
     """
     cdef Py_ssize_t n = A.shape[0]
     cdef Py_ssize_t d = A.shape[1]
     cdef Py_ssize_t x, y
-    cdef DTYPE_t cur
-    cdef DTYPE_t tot = 0
-    for x in range(n):
-        for y in range(d):
-            cur = A[x,y]
-            tot += cur*cur
+    cdef double cur
+    cdef double tot = 0
+    if n*d >= PAR_MIN:
+        for x in prange(n, nogil=True, schedule='static'):
+            for y in range(d):
+                cur = A[x,y]
+                tot += cur*cur
+    else:
+        for x in range(n):
+            for y in range(d):
+                cur = A[x,y]
+                tot += cur*cur
     return tot
 
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-def auto_outer(np.ndarray[DTYPE_t, ndim=2] A, np.ndarray[DTYPE_t, ndim=2] out):
+cdef inline void _auto_outer_row(const floating[:,:] A, floating[:,:] out,
+                                 Py_ssize_t z, Py_ssize_t d) noexcept nogil:
+    """Outer product of row `z` of `A` with itself into row `z` of `out`."""
+    cdef Py_ssize_t x, y
+    cdef Py_ssize_t c = 0
+    cdef floating a
+    for x in range(d):
+        a = A[z,x]
+        for y in range(x,d):
+            out[z,c] = a * A[z,y]
+            c += 1
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def auto_outer(const floating[:,:] A, floating[:,:] out):
     """Outer product with itself.
     
     Calculates the outer product of each row of `A` with itself. Each row of the
@@ -57,33 +111,60 @@ def auto_outer(np.ndarray[DTYPE_t, ndim=2] A, np.ndarray[DTYPE_t, ndim=2] out):
     
     out : ndarray
         Output array of shape (n,d'), where d' = d+1 choose 2 = d*(d+1)/2.
+        Works faster if this is C-contiguous.
     
     """
     cdef Py_ssize_t n = A.shape[0]
     cdef Py_ssize_t d = A.shape[1]
     # Check shapes
-    cdef Py_ssize_t d2
-    if d % 2 == 0:
-        d2 = d >> 1
-        d2 *= d+1
-    else:
-        d2 = (d+1) >> 1
-        d2 *= d
+    cdef Py_ssize_t d2 = _triu_len(d)
     if out.shape[0] != n or out.shape[1] != d2:
         raise ValueError("Shapes of `A` and `out` does not match")
-    # Calculate
-    cdef Py_ssize_t x, y, z, c
-    for z in range(n):
-        c = 0
-        for x in range(d):
-            for y in range(x,d):
-                out[z,c] = A[z,x] * A[z,y]
-                c += 1
+    # Calculate (rows are independent)
+    cdef Py_ssize_t z
+    if n*d2 >= PAR_MIN:
+        for z in prange(n, nogil=True, schedule='static'):
+            _auto_outer_row(A, out, z, d)
+    else:
+        for z in range(n):
+            _auto_outer_row(A, out, z, d)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef inline void _copy_tile(floating[:,:] A, Py_ssize_t bx, Py_ssize_t by,
+                            Py_ssize_t n) noexcept nogil:
+    """Copy the tile (bx,by) of the upper triangular into the lower."""
+    cdef Py_ssize_t x, y, y0
+    cdef Py_ssize_t x1 = min(bx + TILE, n)
+    cdef Py_ssize_t y1 = min(by + TILE, n)
+    for x in range(bx, x1):
+        # Skip the diagonal and the lower triangular in the diagonal tiles
+        y0 = max(by, x+1)
+        for y in range(y0, y1):
+            A[y,x] = A[x,y]
 
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-def copy_triu_to_tril(np.ndarray[DTYPE_t, ndim=2] A):
+cdef void _copy_triu_to_tril(floating[:,:] A,
+                             bint parallel=True) noexcept nogil:
+    """Tiled copy of the upper triangular into the lower triangular."""
+    cdef Py_ssize_t n = A.shape[0]
+    cdef Py_ssize_t ntiles = (n + TILE - 1) // TILE
+    cdef Py_ssize_t bx, by
+    if parallel and n*n >= 2*PAR_MIN:
+        # Each tile row is processed by one thread
+        for bx in prange(ntiles, schedule='dynamic'):
+            for by in range(bx, ntiles):
+                _copy_tile(A, bx*TILE, by*TILE, n)
+    else:
+        for bx in range(ntiles):
+            for by in range(bx, ntiles):
+                _copy_tile(A, bx*TILE, by*TILE, n)
+
+
+def copy_triu_to_tril(floating[:,:] A):
     """Copy upper triangular into the lower triangular.
     
     Parameters
@@ -93,22 +174,20 @@ def copy_triu_to_tril(np.ndarray[DTYPE_t, ndim=2] A):
     
     Notes
     -----
-    Works slightly faster with either C of F -contiguous arrays depending on the
-    system and the size of the array. 
+    The matrix is traversed in square tiles so that both the read and the
+    transposed write stay in cache, making the performance similar for C and
+    F -contiguous arrays.
     
     """
-    cdef Py_ssize_t n = A.shape[0]
-    if n != A.shape[1]:
+    if A.shape[0] != A.shape[1]:
         raise ValueError("Input array is not square")
-    cdef Py_ssize_t x, y
-    for x in range(n-1):
-        for y in range(x+1,n):
-            A[y,x] = A[x,y]
+    with nogil:
+        _copy_triu_to_tril(A)
 
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-def ravel_triu(np.ndarray[DTYPE_t, ndim=2] A, np.ndarray[DTYPE_t, ndim=1] out):
+def ravel_triu(const floating[:,:] A, floating[:] out):
     """Extract the upper triangular into one dimensional array.
     
     Parameters
@@ -123,29 +202,29 @@ def ravel_triu(np.ndarray[DTYPE_t, ndim=2] A, np.ndarray[DTYPE_t, ndim=1] out):
     """
     # Check shapes
     cdef Py_ssize_t d = A.shape[0]
-    cdef Py_ssize_t d2
     if A.shape[1] != d:
         raise ValueError("Input array `A` is not square")
-    if d % 2 == 0:
-        d2 = d >> 1
-        d2 *= d+1
-    else:
-        d2 = (d+1) >> 1
-        d2 *= d
+    cdef Py_ssize_t d2 = _triu_len(d)
     if out.shape[0] != d2:
         raise ValueError("Shapes of `A` and `out` does not match")
-    # Copy the values
-    cdef Py_ssize_t x, y
-    cdef Py_ssize_t c = 0
-    for x in range(d):
-        for y in range(x,d):
-            out[c] = A[x,y]
-            c += 1
+    # Copy the values (the start of each row is known so rows are independent)
+    cdef Py_ssize_t x, y, c
+    if d2 >= PAR_MIN:
+        for x in prange(d, nogil=True, schedule='dynamic'):
+            c = _triu_row_start(x, d)
+            for y in range(x,d):
+                out[c+y-x] = A[x,y]
+    else:
+        c = 0
+        for x in range(d):
+            for y in range(x,d):
+                out[c] = A[x,y]
+                c += 1
 
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-def unravel_triu(np.ndarray[DTYPE_t, ndim=1] a, np.ndarray[DTYPE_t, ndim=2] out):
+def unravel_triu(const floating[:] a, floating[:,:] out):
     """Form square matrix from one dimensional array extracted by ravel_triu.
     
     Parameters
@@ -160,27 +239,258 @@ def unravel_triu(np.ndarray[DTYPE_t, ndim=1] a, np.ndarray[DTYPE_t, ndim=2] out)
     """
     # Check shapes
     cdef Py_ssize_t d = out.shape[0]
-    cdef Py_ssize_t d2
     if out.shape[1] != d:
         raise ValueError("Output array `out` is not square")
-    if d % 2 == 0:
-        d2 = d >> 1
-        d2 *= d+1
-    else:
-        d2 = (d+1) >> 1
-        d2 *= d
+    cdef Py_ssize_t d2 = _triu_len(d)
     if a.shape[0] != d2:
         raise ValueError("Shapes of `a` and `out` does not match")
-    # Copy the values
-    cdef Py_ssize_t x, y
-    cdef Py_ssize_t c = 0
-    for x in range(d):
-        out[x,x] = a[c]
-        c += 1
-        for y in range(x+1,d):
-            out[x,y] = a[c]
-            out[y,x] = a[c]
-            c += 1
+    # Copy the values into the upper triangular
+    cdef Py_ssize_t x, y, c
+    if d2 >= PAR_MIN:
+        for x in prange(d, nogil=True, schedule='dynamic'):
+            c = _triu_row_start(x, d)
+            for y in range(x,d):
+                out[x,y] = a[c+y-x]
+    else:
+        c = 0
+        for x in range(d):
+            for y in range(x,d):
+                out[x,y] = a[c]
+                c += 1
+    # Mirror into the lower triangular
+    with nogil:
+        _copy_triu_to_tril(out)
+
+
+
+# ------------------------------------------------------------------------------
+#   Stacked versions
+# ------------------------------------------------------------------------------
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def fro_norm_squared_stack(const floating[:,:,:] A, double[:] out):
+    """Squared Frobenius norm of each matrix in a stack.
+    
+    Parameters
+    ----------
+    A : ndarray
+        The input array of shape (n,d,K).
+    
+    out : ndarray
+        Output array of shape (K,) into which np.sum(A[:,:,k]**2) is calculated
+        for each k (in double precision).
+    
+    """
+    cdef Py_ssize_t n = A.shape[0]
+    cdef Py_ssize_t d = A.shape[1]
+    cdef Py_ssize_t K = A.shape[2]
+    if out.shape[0] != K:
+        raise ValueError("Shapes of `A` and `out` does not match")
+    cdef Py_ssize_t x, y, k
+    cdef double cur, tot
+    for k in prange(K, nogil=True, schedule='static'):
+        tot = 0
+        for x in range(n):
+            for y in range(d):
+                cur = A[x,y,k]
+                tot = tot + cur*cur
+        out[k] = tot
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def copy_triu_to_tril_stack(floating[:,:,:] A):
+    """Copy upper triangular into the lower triangular in each matrix.
+    
+    Parameters
+    ----------
+    A : ndarray
+        The array of shape (d,d,K) to operate on.
+    
+    """
+    if A.shape[0] != A.shape[1]:
+        raise ValueError("Input array is not a stack of square matrices")
+    cdef Py_ssize_t K = A.shape[2]
+    cdef Py_ssize_t k
+    for k in prange(K, nogil=True, schedule='static'):
+        _copy_triu_to_tril(A[:,:,k], False)
 
 
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def ravel_triu_stack(const floating[:,:,:] A, floating[:,:] out):
+    """Extract the upper triangular of each matrix into the columns of `out`.
+    
+    Parameters
+    ----------
+    A : ndarray
+        The array of shape (d,d,K) to operate on.
+    
+    out : ndarray
+        The output array of shape (d2,K), where d2 is d+1 choose 2. Works faster
+        if this is F-contiguous.
+    
+    """
+    cdef Py_ssize_t d = A.shape[0]
+    cdef Py_ssize_t K = A.shape[2]
+    if A.shape[1] != d:
+        raise ValueError("Input array is not a stack of square matrices")
+    if out.shape[0] != _triu_len(d) or out.shape[1] != K:
+        raise ValueError("Shapes of `A` and `out` does not match")
+    cdef Py_ssize_t x, y, c, k
+    for k in prange(K, nogil=True, schedule='static'):
+        c = 0
+        for x in range(d):
+            for y in range(x,d):
+                out[c,k] = A[x,y,k]
+                c = c + 1
+
 
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def unravel_triu_stack(const floating[:,:] a, floating[:,:,:] out):
+    """Form stack of square matrices from columns extracted by ravel_triu_stack.
+    
+    Parameters
+    ----------
+    a : ndarray
+        The array of shape (d2,K) to operate on.
+    
+    out : ndarray
+        The output array of shape (d,d,K), where d2 is d+1 choose 2.
+    
+    """
+    cdef Py_ssize_t d = out.shape[0]
+    cdef Py_ssize_t K = out.shape[2]
+    if out.shape[1] != d:
+        raise ValueError("Output array is not a stack of square matrices")
+    if a.shape[0] != _triu_len(d) or a.shape[1] != K:
+        raise ValueError("Shapes of `a` and `out` does not match")
+    cdef Py_ssize_t x, y, c, k
+    for k in prange(K, nogil=True, schedule='static'):
+        c = 0
+        for x in range(d):
+            for y in range(x,d):
+                out[x,y,k] = a[c,k]
+                c = c + 1
+        _copy_triu_to_tril(out[:,:,k], False)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef int _cho_inv(floating* A, floating* b, int d) noexcept nogil:
+    """Invert positive definite F-order matrix `A` in place and solve `b`."""
+    cdef char uplo = b'U'
+    cdef int one = 1
+    cdef int info
+    if floating is double:
+        dpotrf(&uplo, &d, A, &d, &info)
+        if info == 0 and b != NULL:
+            dpotrs(&uplo, &d, &one, A, &d, b, &d, &info)
+        if info == 0:
+            dpotri(&uplo, &d, A, &d, &info)
+    else:
+        spotrf(&uplo, &d, A, &d, &info)
+        if info == 0 and b != NULL:
+            spotrs(&uplo, &d, &one, A, &d, b, &d, &info)
+        if info == 0:
+            spotri(&uplo, &d, A, &d, &info)
+    return info
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def cho_inv_stack(floating[::1,:,:] A, floating[::1,:] b, int[:] info):
+    """Invert each positive definite matrix in a stack in place.
+    
+    Calculates inv(A[:,:,k]) and inv(A[:,:,k]).dot(b[:,k]) in place for each k
+    using the Cholesky decomposition. Used by util.invert_normal_params_stack.
+    
+    Parameters
+    ----------
+    A : ndarray
+        F-contiguous array of shape (d,d,K).
+    
+    b : {None, ndarray}
+        F-contiguous array of shape (d,K) or None.
+    
+    info : ndarray
+        Integer array of shape (K,) into which the LAPACK error codes are
+        stored. Nonzero value indicates that the corresponding matrix is not
+        positive definite, in which case the contents of the slice are
+        undefined.
+    
+    """
+    cdef int d = A.shape[0]
+    cdef Py_ssize_t K = A.shape[2]
+    if A.shape[1] != d or A.strides[1] != d*A.itemsize:
+        raise ValueError("Input array is not a F-contiguous stack of square "
+                         "matrices")
+    if info.shape[0] != K:
+        raise ValueError("Shapes of `A` and `info` does not match")
+    cdef bint has_b = b is not None
+    if has_b and (b.shape[0] != d or b.shape[1] != K):
+        raise ValueError("Shapes of `A` and `b` does not match")
+    cdef Py_ssize_t x, y, k
+    for k in prange(K, nogil=True, schedule='dynamic'):
+        if has_b:
+            info[k] = _cho_inv(&A[0,0,k], &b[0,k], d)
+        else:
+            info[k] = _cho_inv(&A[0,0,k], <floating*>NULL, d)
+        if info[k] == 0:
+            # Copy the upper triangular into the lower (slices are small)
+            for x in range(d-1):
+                for y in range(x+1,d):
+                    A[y,x,k] = A[x,y,k]
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def bucket_argsort(const cython.integral[:] k_ind, Py_ssize_t[:] counts,
+                   Py_ssize_t[:] out):
+    """Stable argsort of bucket indices with counting sort in O(N+K) time.
+    
+    Used in Master to sort the samples into the sites.
+    
+    Parameters
+    ----------
+    k_ind : ndarray
+        Integer array of shape (N,) of the bucket index of each element, in
+        the range [0,K).
+    
+    counts : ndarray
+        Array of shape (K,) of type np.intp into which the size of each bucket
+        is stored.
+    
+    out : ndarray
+        Array of shape (N,) of type np.intp into which the permutation sorting
+        `k_ind` is stored. Elements in the same bucket retain their order.
+    
+    """
+    cdef Py_ssize_t N = k_ind.shape[0]
+    cdef Py_ssize_t K = counts.shape[0]
+    if out.shape[0] != N:
+        raise ValueError("Shapes of `k_ind` and `out` does not match")
+    cdef Py_ssize_t n, k, cum, c
+    counts[:] = 0
+    for n in range(N):
+        k = k_ind[n]
+        if k < 0 or k >= K:
+            raise ValueError("Bucket index {} out of range".format(k))
+        counts[k] += 1
+    # Starting position of each bucket
+    cum = 0
+    for k in range(K):
+        c = counts[k]
+        counts[k] = cum
+        cum += c
+    # Place the elements, after which counts holds the end of each bucket
+    with nogil:
+        for n in range(N):
+            k = k_ind[n]
+            out[counts[k]] = n
+            counts[k] += 1
+        for k in range(K-1, 0, -1):
+            counts[k] -= counts[k-1]
@@ -0,0 +1,241 @@
+"""Instrumentation of the distributed EP algorithm.
+
+The method Master.run accepts a list of hooks, i.e. instances of the class
+Hook, which are notified about every phase of the algorithm. The class
+TraceWriter is a built-in hook writing the events into a JSON lines file. See
+also the module store for a hook recording the results of each iteration.
+
+The most recent version of the code can be found on GitHub:
+https://github.com/gelman/ep-stan
+
+"""
+
+# Licensed under the 3-clause BSD license.
+# http://opensource.org/licenses/BSD-3-Clause
+#
+# Copyright (C) 2014 Tuomas Sivula
+# All rights reserved.
+
+from __future__ import division
+import time
+import json
+import numpy as np
+
+
+def clock():
+    """Return the current wall and CPU time."""
+    return time.time(), time.clock()
+
+
+def elapsed(t0):
+    """Return the wall and CPU time elapsed since `t0` obtained from clock."""
+    return time.time() - t0[0], time.clock() - t0[1]
+
+
+class Hook(object):
+    """Base class for the instrumentation hooks of Master.run.
+    
+    The methods of this class do nothing. Subclasses override the methods
+    corresponding to the events they are interested in. All the times are given
+    in seconds.
+    
+    """
+    
+    def run_start(self, master, niter):
+        """Called in the beginning of Master.run."""
+        pass
+    
+    def iteration_start(self, iteration):
+        """Called in the beginning of each iteration."""
+        pass
+    
+    def phase(self, iteration, name, wall, cpu, site=None, **info):
+        """Called after each timed phase.
+        
+        Parameters
+        ----------
+        iteration : int
+            The current iteration.
+        
+        name : str
+            The name of the phase, one of:
+                'global_cholesky'  : positive definiteness check of the global
+                                     approximation (once per damping attempt)
+                'cavity'           : cavity distribution of one site (of all
+                                     the sites at once with `site` None if
+                                     the workers are created lazily)
+                'moment_inversion' : moment parameters of the global
+                                     approximation
+                'tilted'           : tilted distribution of one site
+        
+        wall, cpu : float
+            The wall and CPU time spent in the phase.
+        
+        site : {None, int}, optional
+            The index of the site for the site specific phases.
+        
+        Other parameters
+        ----------------
+        Phase specific information, e.g. `posdef` for the phases 'cavity' and
+        'tilted' and `nsamp`, `sampling` and `prec_estim` for the phase
+        'tilted'. The latter two are (wall, cpu) tuples of the corresponding
+        sub-phases.
+        
+        """
+        pass
+    
+    def damping(self, iteration, cause, sites, dfs):
+        """Called when the damping factors are reduced.
+        
+        Parameters
+        ----------
+        iteration : int
+            The current iteration.
+        
+        cause : {'global', 'cavity'}
+            Indicates if the global approximation or the cavity distributions
+            were not positive definite.
+        
+        sites : ndarray
+            The indices of the sites whose damping factor was reduced.
+        
+        dfs : ndarray
+            The reduced damping factors of every site.
+        
+        """
+        pass
+    
+    def moments(self, iteration, S, m):
+        """Called with the moments of the global approximation.
+        
+        Called in each iteration after the moment inversion, if the moments
+        are calculated (argument `calc_moments` of Master.run). The arrays are
+        overwritten in the next iteration.
+        
+        """
+        pass
+    
+    def iteration_end(self, iteration, dfs):
+        """Called in the end of each iteration with the accepted dfs."""
+        pass
+    
+    def run_end(self, status):
+        """Called in the end of Master.run with the return code or None."""
+        pass
+
+
+def _to_builtin(obj):
+    """Convert numpy types into built-in types for json serialisation."""
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError("{} is not JSON serializable".format(repr(obj)))
+
+
+class TraceWriter(Hook):
+    """Hook writing a JSON lines trace of the EP iterations.
+    
+    One record is written for each site and for each iteration at the end of
+    the iteration. The site records (type 'site') contain the wall and CPU
+    times of the cavity and tilted phases of the site and the sub-phases of the
+    tilted phase, the number of samples, the number of non positive definite
+    cavity distributions encountered, the positive definiteness of the tilted
+    distribution and the accepted damping factor. The iteration records (type
+    'iteration') contain the total wall and CPU times of the iteration and of
+    each phase, the number of damping attempts and the damping events.
+    
+    Parameters
+    ----------
+    out : str or file
+        The filename or an open file into which the trace is written.
+    
+    sites : bool, optional
+        If False, only the iteration records are written. Default is True.
+    
+    """
+    
+    def __init__(self, out, sites=True):
+        if isinstance(out, basestring):
+            self.file = open(out, 'a')
+            self.own_file = True
+        else:
+            self.file = out
+            self.own_file = False
+        self.sites = sites
+    
+    def _write(self, record):
+        self.file.write(json.dumps(record, default=_to_builtin))
+        self.file.write('\n')
+    
+    def run_start(self, master, niter):
+        self.K = master.K
+        self._write({'type': 'run', 'K': master.K, 'dphi': master.dphi,
+                     'niter': niter, 'start_iter': master.iter})
+    
+    def iteration_start(self, iteration):
+        self.t0 = clock()
+        self.phases = {}
+        self.damping_events = []
+        if self.sites:
+            self.site_recs = [{'type': 'site', 'iter': iteration, 'site': k,
+                               'cavity_fails': 0}
+                              for k in xrange(self.K)]
+    
+    def phase(self, iteration, name, wall, cpu, site=None, **info):
+        tot = self.phases.setdefault(name, [0.0, 0.0, 0])
+        tot[0] += wall
+        tot[1] += cpu
+        tot[2] += 1
+        if site is None or not self.sites:
+            return
+        rec = self.site_recs[site]
+        if name == 'cavity':
+            # Accumulate over the damping attempts
+            rec['cavity_wall'] = rec.get('cavity_wall', 0.0) + wall
+            rec['cavity_cpu'] = rec.get('cavity_cpu', 0.0) + cpu
+            if not info['posdef']:
+                rec['cavity_fails'] += 1
+        else:
+            rec[name+'_wall'] = wall
+            rec[name+'_cpu'] = cpu
+            for (key, val) in info.iteritems():
+                if isinstance(val, tuple):
+                    rec[key+'_wall'], rec[key+'_cpu'] = val
+                else:
+                    rec[key] = val
+    
+    def damping(self, iteration, cause, sites, dfs):
+        self.damping_events.append(
+            {'cause': cause, 'sites': sites, 'df_min': dfs.min()})
+    
+    def iteration_end(self, iteration, dfs):
+        wall, cpu = elapsed(self.t0)
+        if self.sites:
+            for k in xrange(self.K):
+                rec = self.site_recs[k]
+                rec['df'] = dfs[k]
+                self._write(rec)
+        self._write({
+            'type'     : 'iteration',
+            'iter'     : iteration,
+            'wall'     : wall,
+            'cpu'      : cpu,
+            'phases'   : dict((name, {'wall': tot[0], 'cpu': tot[1],
+                                      'count': tot[2]})
+                              for (name, tot) in self.phases.iteritems()),
+            'attempts' : len(self.damping_events) + 1,
+            'damping'  : self.damping_events,
+            'df_min'   : dfs.min(),
+            'df_max'   : dfs.max()
+        })
+        self.file.flush()
+    
+    def run_end(self, status):
+        self._write({'type': 'end', 'status': status})
+        self.file.flush()
+    
+    def close(self):
+        """Close the file if it was opened by this instance."""
+        if self.own_file:
+            self.file.close()
@@ -0,0 +1,214 @@
+"""Analytic mock site model for testing and benchmarking the EP machinery.
+
+The class GaussianSiteModel can be used in place of a PyStan model as the site
+model of Master. It implements the conjugate linear Gaussian model
+    y ~ N(X*phi, sigma^2),
+so that the tilted distribution of each site is Gaussian and it can be sampled
+exactly without MCMC. Because the model is conjugate, EP converges to the exact
+posterior, which can be calculated with the method posterior.
+
+Example:
+    >>> model = GaussianSiteModel()
+    >>> master = Master(model, X, y, dphi=X.shape[1], site_sizes=Nk,
+    ...                 init_prev=False)
+
+The most recent version of the code can be found on GitHub:
+https://github.com/gelman/ep-stan
+
+"""
+
+# Licensed under the 3-clause BSD license.
+# http://opensource.org/licenses/BSD-3-Clause
+#
+# Copyright (C) 2014 Tuomas Sivula
+# All rights reserved.
+
+from __future__ import division
+import numpy as np
+from scipy import linalg
+
+
+class GaussianFit(object):
+    """Fit object returned by GaussianSiteModel.sampling.
+    
+    Mimics the parts of the PyStan fit object used by the modules serial and
+    tilted, i.e. the methods extract, unconstrain_pars and grad_log_prob and
+    the attributes used by util.get_last_sample.
+    
+    """
+    
+    def __init__(self, samp, lp, chains, Q, m):
+        self.samp = samp
+        self.lp = lp
+        self.Q = Q
+        self.m = m
+        self.model_pars = ['phi']
+        self.par_dims = [[samp.shape[1]]]
+        self.chains = chains
+        self._sim = None
+    
+    @property
+    def sim(self):
+        """Samples in the structure of PyStan fit.sim (created on demand)."""
+        if self._sim is None:
+            n = self.samp.shape[0] // self.chains
+            samples = []
+            for c in xrange(self.chains):
+                chain = self.samp[c*n:(c+1)*n]
+                samples.append({'chains': dict(
+                    (u'phi[{}]'.format(i), chain[:,i])
+                    for i in xrange(chain.shape[1])
+                )})
+            self._sim = {'chains': self.chains, 'samples': samples}
+        return self._sim
+    
+    def extract(self, pars=None, permuted=True):
+        """Extract the samples of phi and lp__.
+        
+        With `permuted` False, an array of shape (iterations, chains, dphi+1)
+        is returned similarly as in PyStan, the last column being lp__.
+        
+        """
+        if not permuted:
+            n = self.samp.shape[0] // self.chains
+            out = np.empty((n, self.chains, self.samp.shape[1]+1))
+            for c in xrange(self.chains):
+                out[:,c,:-1] = self.samp[c*n:(c+1)*n]
+                out[:,c,-1] = self.lp[c*n:(c+1)*n]
+            return out
+        if pars is None:
+            pars = ('phi', 'lp__')
+        elif isinstance(pars, basestring):
+            pars = (pars,)
+        out = {}
+        for p in pars:
+            if p == 'phi':
+                out['phi'] = self.samp.copy()
+            elif p == 'lp__':
+                out['lp__'] = self.lp.copy()
+            else:
+                raise ValueError("No parameter {}".format(p))
+        return out
+    
+    def unconstrain_pars(self, par):
+        """Parameter phi as a vector (phi is unconstrained)."""
+        return np.array(par['phi'], dtype=np.float64)
+    
+    def grad_log_prob(self, upar, adjust_transform=True):
+        """Gradient of the tilted log density."""
+        return self.Q.dot(self.m - upar)
+
+
+class GaussianSiteModel(object):
+    """Conjugate linear Gaussian site model with exact tilted sampling.
+    
+    The site likelihood is y ~ N(X*phi, sigma^2), where `X` is the data matrix
+    of shape (N,dphi) given to Master. The tilted distribution of the site is
+    then the Gaussian distribution with natural parameters
+        Q = Omega_phi + X'X / sigma^2
+        r = Omega_phi*mu_phi + X'y / sigma^2.
+    
+    Parameters
+    ----------
+    sigma : float, optional
+        The standard deviation of the observation noise. Default is 1.
+    
+    exact_moments : bool, optional
+        If True, the samples are transformed so that their sample mean and
+        unbiased sample covariance are exactly the moments of the tilted
+        distribution. Requires more samples than dimensions. Default is False.
+    
+    """
+    
+    model_name = 'gaussian_mock'
+    
+    def __init__(self, sigma=1.0, exact_moments=False):
+        self.sigma = sigma
+        self.exact_moments = exact_moments
+    
+    def site_params(self, data):
+        """Natural parameters of the site likelihood."""
+        X = data['X']
+        if len(X.shape) == 1:
+            X = X[:,np.newaxis]
+        Qs = X.T.dot(X)
+        Qs /= self.sigma**2
+        rs = X.T.dot(data['y'])
+        rs /= self.sigma**2
+        return Qs, rs
+    
+    def tilted_params(self, data):
+        """Natural parameters of the tilted distribution."""
+        Q, r = self.site_params(data)
+        Q += data['Omega_phi']
+        r += data['Omega_phi'].dot(data['mu_phi'])
+        return Q, r
+    
+    def posterior(self, X, y, Q0, r0):
+        """Exact posterior moment parameters of the whole data set."""
+        Q, r = self.site_params({'X':X, 'y':y})
+        Q += Q0
+        r += r0
+        cho = linalg.cho_factor(Q)
+        return linalg.cho_solve(cho, np.eye(Q.shape[0])), \
+               linalg.cho_solve(cho, r)
+    
+    def sampling(self, data=None, pars=None, chains=4, iter=2000, warmup=None,
+                 thin=1, seed=None, chain_id=None, **kwargs):
+        """Draw exact samples from the tilted distribution.
+        
+        The arguments follow StanModel.sampling, other keyword arguments (e.g.
+        init) are ignored. With an integer `seed`, each chain is drawn from its
+        own stream identified by the seed and the id of the chain, similarly
+        as in Stan. As in PyStan, `chain_id` can be an iterable of the ids or
+        an integer giving the id of the first chain, and by default the chains
+        are numbered from zero. Returns a GaussianFit instance.
+        
+        """
+        if chain_id is None:
+            chain_id = range(chains)
+        elif isinstance(chain_id, (int, long, np.integer)):
+            chain_id = range(chain_id, chain_id + chains)
+        else:
+            chain_id = list(chain_id)
+            if len(chain_id) != chains:
+                raise ValueError("Length of `chain_id` does not match with "
+                                 "`chains`")
+        if warmup is None:
+            warmup = iter // 2
+        n = max((iter - warmup - 1) // thin + 1, 1)
+        Q, r = self.tilted_params(data)
+        d = Q.shape[0]
+        # Upper Cholesky Q = U'U
+        U = linalg.cholesky(Q, overwrite_a=True)
+        m = linalg.cho_solve((U, False), r)
+        if isinstance(seed, (int, long, np.integer)):
+            z = np.concatenate([
+                np.random.RandomState([seed, c]).randn(n, d)
+                for c in chain_id
+            ])
+        else:
+            if not isinstance(seed, np.random.RandomState):
+                seed = np.random.RandomState(seed)
+            z = seed.randn(n*chains, d)
+        if self.exact_moments and n*chains > d:
+            # Whiten the standard normal samples
+            z -= np.mean(z, axis=0)
+            Uz = linalg.cholesky(z.T.dot(z) / (n*chains - 1))
+            z = linalg.solve_triangular(Uz, z.T, trans='T').T
+        lp = np.sum(z**2, axis=1)
+        lp *= -0.5
+        # x = m + inv(U) z has covariance inv(Q)
+        samp = linalg.solve_triangular(U, z.T, overwrite_b=True).T
+        samp += m
+        return GaussianFit(samp, lp, chains, U.T.dot(U), m)
+    
+    def optimizing(self, data=None, **kwargs):
+        """Mode of the tilted distribution.
+        
+        The arguments follow StanModel.optimizing, other keyword arguments are
+        ignored. Returns a dict containing the mode of phi.
+        
+        """
+        Q, r = self.tilted_params(data)
+        return {'phi': linalg.cho_solve(linalg.cho_factor(Q), r)}
@@ -15,18 +15,21 @@ https://github.com/gelman/ep-stan
 # All rights reserved.
 
 from __future__ import division
+import os
+import json
+import pickle
+from collections import OrderedDict
 import numpy as np
 from scipy import linalg
 
-import pickle
-
 from util import (
-    invert_normal_params,
-    olse,
-    get_last_sample,
-    suppress_stdout,
-    load_stan
+    invert_normal_params, invert_normal_params_stack, olse, cv_moments,
+    merge_moments, load_stan, root_seed, derive_seed, suppress_stdout
 )
+from cython_util import bucket_argsort
+from hooks import Hook, clock, elapsed
+from tilted import StanSampler, SamplingError
+from capture import get_capture, make_sink, RotatingLog
 
 
 class Worker(object):
@@ -49,6 +52,12 @@ class Worker(object):
     A : dict, optional
         Additional data included in this site.
     
+    Mat, vec, temp_M, temp_v : ndarray, optional
+        Preallocated arrays used as the respective instance variables, e.g.
+        slices of the compact site state in Master (see LazyWorkers). Mat and
+        temp_M have to be F-contiguous of shape (dphi,dphi) and vec and temp_v
+        of shape (dphi,).
+    
     Other parameters
     ----------------
     See the class DistributedEP
@@ -59,9 +68,14 @@ class Worker(object):
         'init_prev'       : True,
         'prec_estim'      : 'sample',
         'prec_estim_skip' : 0,
+        'cv_block_size'   : 512,
+        'cv_ridge'        : None,
         'smooth'          : None,
         'smooth_ignore'   : 1,
-        'tmp_fix_32bit'   : False # FIXME: Temp fix for RandomState problem
+        'tilted_estim'    : None,
+        'stan_output'     : None,
+        'max_retries'     : 2,
+        'failure_dir'     : None
     }
     
     DEFAULT_STAN_PARAMS = {
@@ -70,15 +84,17 @@ class Worker(object):
         'warmup'          : None,
         'thin'            : 2,
         'init'            : 'random',
-        'seed'            : None
+        'seed'            : None,
+        'n_jobs'          : -1
     }
     
     # Available values for option `prec_estim`
-    PREC_ESTIM_OPTIONS = ('sample', 'olse')
+    PREC_ESTIM_OPTIONS = ('sample', 'olse', 'cv')
     
     RESERVED_STAN_PARAMETER_NAMES = ['X', 'y', 'N', 'D', 'mu_phi', 'Omega_phi']
     
-    def __init__(self, index, stan_model, dphi, X, y, A={}, **options):
+    def __init__(self, index, stan_model, dphi, X, y, A={}, Mat=None,
+                 vec=None, temp_M=None, temp_v=None, **options):
         
         # Parse options
         # Set missing options to defaults
@@ -102,8 +118,8 @@ class Worker(object):
         # and self.vec holds the mean of the cavity distribution. After calling
         # the method tilted, self.Mat holds the unnormalised covariance matrix
         # and self.vec holds the mean of the tilted distributions.
-        self.Mat = np.empty((dphi,dphi), order='F')
-        self.vec = np.empty(dphi)
+        self.Mat = np.empty((dphi,dphi), order='F') if Mat is None else Mat
+        self.vec = np.empty(dphi) if vec is None else vec
         # The instance variable self.phase indicates if self.Mat and self.vec
         # contains the cavity or tilted distribution parameters:
         #     0: neither
@@ -115,13 +131,19 @@ class Worker(object):
         # covariance matrix in self.Mat
         self.nsamp = None
         
+        # If self.profile is True, the wall and CPU times of the sub-phases of
+        # the method tilted are stored into the dict self.times
+        self.profile = False
+        self.times = {}
+        
         # Current iteration global approximations
         self.Q = None
         self.r = None
         
         # Temporary arrays for calculations
-        self.temp_M = np.empty((dphi,dphi), order='F')
-        self.temp_v = np.empty(dphi)
+        self.temp_M = (np.empty((dphi,dphi), order='F') if temp_M is None
+                       else temp_M)
+        self.temp_v = np.empty(dphi) if temp_v is None else temp_v
         
         # Data for stan model in method tilted
         self.data = dict(
@@ -153,39 +175,129 @@ class Worker(object):
                 raise ValueError("Arg. `init` has to be a string if "
                                  "`init_prev` is True")
         
+        # Samples of the tilted distribution stored for reuse by the estimator
+        # (see tilted.RecyclingSampler)
+        self.prev_samples = None
+        
+        # Tilted distribution estimator
+        self.tilted_estim = options['tilted_estim']
+        if self.tilted_estim is None:
+            self.tilted_estim = StanSampler()
+        
+        # Sink of the output of the site model (see module capture)
+        self.output = make_sink(options['stan_output'], index)
+        
+        # Failure handling of the tilted distribution estimation
+        if options['max_retries'] < 0:
+            raise ValueError("Arg. `max_retries` has to be non-negative")
+        self.max_retries = options['max_retries']
+        self.failure_dir = options['failure_dir']
+        # Indicates if the estimation failed on the last iteration
+        self.failed = False
+        
         # Tilted precision estimate method
         self.prec_estim = options['prec_estim']
         if not self.prec_estim in self.PREC_ESTIM_OPTIONS:
             raise ValueError("Invalid value for option `prec_estim`")
-        if self.prec_estim != 'sample':
-            self.prec_estim_skip = options['prec_estim_skip']
+        self.prec_estim_skip = options['prec_estim_skip']
+        self.cv_block_size = options['cv_block_size']
+        self.cv_ridge = options['cv_ridge']
+        # Samples and their log densities for the control variate estimate
+        # (see tilted.StanSampler.draw)
+        self.cv_samples = None
         
         # Smoothing
         self.smooth = options['smooth']
-        if not self.smooth is None and len(self.smooth) == 0:
+        if (    not self.smooth is None
+            and np.ndim(self.smooth) > 0
+            and len(self.smooth) == 0
+           ):
             self.smooth = None
         if not self.smooth is None:
-            # Memorise previous tilted distributions
-            self.smooth = np.asarray(self.smooth)
+            if self.prec_estim == 'cv':
+                raise ValueError("Option `smooth` can not be used with "
+                                 "`prec_estim` 'cv'")
             # Skip some first iterations
             if options['smooth_ignore'] < 0:
                 raise ValueError("Arg. `smooth_ignore` has to be non-negative")
             self.prev_stored = -options['smooth_ignore']
-            # Arrays from the previous iterations
-            self.prev_St = [np.empty((dphi,dphi), order='F')
-                            for _ in range(len(self.smooth))]
-            self.prev_mt = [np.empty(dphi)
-                            for _ in range(len(self.smooth))]
-        
-        # FIXME: Temp fix for RandomState problem in 32-bit Python
-        if options['tmp_fix_32bit']:
-            self.fix32bit = True
-            self.rstate = self.stan_params['seed']
-        else:
-            self.fix32bit = False
+            if np.ndim(self.smooth) == 0:
+                # Exponentially weighted recursive smoothing
+                self.smooth = float(self.smooth)
+                if not 0 < self.smooth < 1:
+                    raise ValueError("Scalar `smooth` has to be in (0,1)")
+                # Running accumulator of the weighted sample size, mean and
+                # unnormalised covariance
+                self.smooth_n = 0.0
+                self.smooth_St = np.empty((dphi,dphi), order='F')
+                self.smooth_mt = np.empty(dphi)
+            else:
+                # Memorise previous tilted distributions
+                self.smooth = np.asarray(self.smooth)
+                # Arrays from the previous iterations
+                self.prev_St = [np.empty((dphi,dphi), order='F')
+                                for _ in range(len(self.smooth))]
+                self.prev_mt = [np.empty(dphi)
+                                for _ in range(len(self.smooth))]
+        
+        # Root seed of the random streams of the site (see method tilted)
+        self.seed = root_seed(self.stan_params['seed'])
+        
+    
+    def capture_output(self):
+        """Context capturing the output of the site model into self.output.
+        
+        If self.output is None, the output is discarded only for the duration
+        of the call (see util.suppress_stdout) without starting the persistent
+        capture of the process.
         
+        """
+        if self.output is None:
+            return suppress_stdout()
+        return get_capture().site(self.output)
+    
+    def write_failure(self, attempt, stan_params, error):
+        """Write the artifacts of a failed sampling attempt.
+        
+        The artifacts are written into the directory
+        `failure_dir`/site_<index>_iter_<iteration>_try_<attempt> containing
+        failure.json describing the failure, the sampling parameters and data
+        as pickles stan_params.pkl and data.pkl and the captured output of the
+        site model (if any) as output.txt. Nothing is written if the option
+        `failure_dir` is None.
+        
+        """
+        if self.failure_dir is None:
+            return
+        path = os.path.join(
+            self.failure_dir,
+            'site_{}_iter_{}_try_{}'.format(self.index, self.iteration, attempt)
+        )
+        if not os.path.exists(path):
+            os.makedirs(path)
+        seed = stan_params['seed']
+        init = stan_params['init']
+        info = {
+            'site': self.index,
+            'iteration': self.iteration,
+            'attempt': attempt,
+            'error': type(error).__name__,
+            'message': str(error),
+            'seed': int(seed) if isinstance(seed, (int, long, np.integer))
+                    else None,
+            'init': init if isinstance(init, basestring) else 'previous'
+        }
+        with open(os.path.join(path, 'failure.json'), 'w') as f:
+            json.dump(info, f, indent=1, sort_keys=True)
+        with open(os.path.join(path, 'stan_params.pkl'), 'wb') as f:
+            pickle.dump(stan_params, f)
+        with open(os.path.join(path, 'data.pkl'), 'wb') as f:
+            pickle.dump(self.data, f)
+        if hasattr(self.output, 'getvalue'):
+            with open(os.path.join(path, 'output.txt'), 'wb') as f:
+                f.write(self.output.getvalue())
     
-    def cavity(self, Q, r, Qi, ri):
+    def cavity(self, Q, r, Qi, ri, dQi=None, dri=None, df=1):
         """Form the cavity distribution and convert them to moment parameters.
         
         Parameters
@@ -196,6 +308,14 @@ class Worker(object):
         Qi, ri : ndarray
             Natural site parameters
         
+        dQi, dri : ndarray, optional
+            Natural site parameter updates. If provided, the cavity distribution
+            is formed using the proposed site parameters Qi + df*dQi and
+            ri + df*dri.
+        
+        df : float, optional
+            The damping factor for the site parameter updates. Default is 1.
+        
         Returns
         -------
         pos_def
@@ -208,6 +328,9 @@ class Worker(object):
         self.r = r
         np.subtract(self.Q, Qi, out=self.Mat)
         np.subtract(self.r, ri, out=self.vec)
+        if not dQi is None:
+            self.Mat -= np.multiply(dQi, df, out=self.temp_M)
+            self.vec -= np.multiply(dri, df, out=self.temp_v)
         
         # Check if positive definite and solve the mean
         try:
@@ -223,7 +346,7 @@ class Worker(object):
             return True
         
         
-    def tilted(self, dQi, dri):
+    def tilted(self, dQi, dri, S=None, m=None, ldet_Q=None):
         """Estimate the tilted distribution parameters.
         
         This method estimates the tilted distribution parameters and calculates
@@ -239,76 +362,105 @@ class Worker(object):
         Parameters
         ----------
         dQi, dri : ndarray
-            Output arrays where the site parameter updates are placed.
+            Output arrays where the site parameter updates are placed. If they
+            are single precision, the updates are calculated in double
+            precision and cast into them in the end.
+        
+        S, m : ndarray, optional
+            Moment parameters of the global approximation used in the control
+            variate precision estimate. Calculated if not provided.
+        
+        ldet_Q : float, optional
+            Half of the log determinant of the global approximation precision
+            matrix (see util.cv_moments). Calculated if not provided.
         
         Returns
         -------
         pos_def
             True if the estimated tilted distribution covariance matrix is
-            positive definite. False otherwise.
+            positive definite. False otherwise, also if the estimation failed
+            (see tilted.SamplingError), in which case self.failed is set. The
+            site parameter updates are then zero.
         
         """
         
         if self.phase != 1:
             raise RuntimeError('Cavity has to be calculated before tilted.')
         
-        # FIXME: Temp fix for RandomState problem in 32-bit Python
-        if self.fix32bit:
-            self.stan_params['seed'] = self.rstate.randint(2**31-1)
+        # Seed of this site and iteration, the chains are separated with the
+        # chain_id in Stan
+        self.stan_params['seed'] = derive_seed(self.seed, self.index,
+                                               self.iteration)
         
-        # Sample from the model
-        try:
-            with suppress_stdout():
-                fit = self.stan_model.sampling(
-                        data=self.data,
-                        pars=('phi'),
-                        **self.stan_params
-                )
-        except ValueError:
-            print 'Worker {} failed'.format(self.index)
-            with open('stan_params.pkl', 'wb') as f:
-                pickle.dump(self.stan_params, f)
-            with open('data.pkl', 'wb') as f:
-                pickle.dump(self.data, f)
-            raise ValueError('Jaahast')
+        if self.profile:
+            t0 = clock()
         
-        if self.init_prev:
-            # Store the last sample of each chain
-            if isinstance(self.stan_params['init'], basestring):
-                # No samples stored before ... initialise list of dicts
-                self.stan_params['init'] = get_last_sample(fit)
-            else:
-                get_last_sample(fit, out=self.stan_params['init'])
+        # Estimate the tilted distribution mean and unnormalised covariance
+        # into self.vec and self.Mat
+        self.cv_samples = None
+        try:
+            self.nsamp, exact = self.tilted_estim.estimate(self)
+        except SamplingError:
+            # Skip the site ... keep the previous site parameters, self.Mat
+            # and self.vec still hold the cavity distribution
+            self.failed = True
+            self.phase = 0
+            self.nsamp = 0
+            dQi.fill(0)
+            dri.fill(0)
+            if self.init_prev:
+                # Reset initialisation method
+                self.stan_params['init'] = self.init_orig
+            if self.profile:
+                self.times['sampling'] = elapsed(t0)
+                # No precision estimate on this iteration
+                self.times['prec_estim'] = (0.0, 0.0)
+            self.iteration += 1
+            return False
+        self.failed = False
         
-        # TODO: Make a non-copying extract
-        samp = fit.extract(pars='phi')['phi']
-        self.nsamp = samp.shape[0]
+        if self.profile:
+            self.times['sampling'] = elapsed(t0)
+            t0 = clock()
         
         # Assign arrays
         St = self.Mat
         mt = self.vec
         
-        # Sample mean and covariance
-        np.mean(samp, axis=0, out=mt)
-        samp -= mt
-        np.dot(samp.T, samp, out=St.T)
-        
         if not self.smooth is None:
-            # Smoothen the distribution (use dri and dQi as temp arrays)
-            St, mt = self._apply_smooth(dri, dQi)
+            if np.ndim(self.smooth) == 0:
+                St, mt = self._apply_smooth_recursive()
+            else:
+                # Smoothen the distribution (use dri and dQi as temp arrays)
+                St, mt = self._apply_smooth(dri, dQi)
+        
+        if dQi.dtype != np.float64:
+            # Single precision output ... calculate in the temp arrays (free
+            # after _apply_smooth) and cast into the output in the end
+            dQi_out = dQi
+            dri_out = dri
+            dQi = self.temp_M
+            dri = self.temp_v
+        else:
+            dQi_out = None
         
         # Estimate precision matrix
         try:
-            # Basic sample estimate
-            if self.prec_estim == 'sample' or self.prec_estim_skip > 0:
+            # Basic sample estimate (or exact moments)
+            if (    self.prec_estim == 'sample'
+                 or self.iteration < self.prec_estim_skip
+                 or exact
+                 or (self.prec_estim == 'cv' and self.cv_samples is None)
+               ):
                 # Normalise St unbiased into dQi
                 np.divide(St, self.nsamp - 1, out=dQi)
                 # Convert moment params to natural params
                 invert_normal_params(dQi, mt, out_A='in_place', out_b=dri)
-                # Unbiased natural parameter estimates
-                unbias_k = (self.nsamp-self.dphi-2)/(self.nsamp-1)
-                dQi *= unbias_k
-                dri *= unbias_k
+                if not exact:
+                    # Unbiased natural parameter estimates
+                    unbias_k = (self.nsamp-self.dphi-2)/(self.nsamp-1)
+                    dQi *= unbias_k
+                    dri *= unbias_k
             
             # Optimal linear shrinkage estimate
             elif self.prec_estim == 'olse':
@@ -318,6 +470,10 @@ class Worker(object):
                 olse(dQi, self.nsamp, P=self.Q, out='in_place')
                 np.dot(dQi, mt, out=dri)
             
+            # Control variate estimate
+            elif self.prec_estim == 'cv':
+                self._cv_estim(dQi, dri, S, m, ldet_Q)
+            
             else:
                 raise ValueError("Invalid value for option `prec_estim`")
             
@@ -336,16 +492,61 @@ class Worker(object):
                 self.prev_stored = 0
             if self.init_prev:
                 # Reset initialisation method
-                self.init = self.init_orig
+                self.stan_params['init'] = self.init_orig
         else:
             # Set return and phase flag
             pos_def = True
             self.phase = 2
         
+        if not dQi_out is None:
+            np.copyto(dQi_out, dQi, casting='same_kind')
+            np.copyto(dri_out, dri, casting='same_kind')
+        
+        if self.profile:
+            self.times['prec_estim'] = elapsed(t0)
+        
         self.iteration += 1
         return pos_def
     
     
+    def _cv_estim(self, dQi, dri, S, m, ldet_Q):
+        """Control variate estimate of the tilted natural parameters.
+        
+        The global approximation is used as the control variate distribution.
+        Its moment parameters `S`, `m` and `ldet_Q` (see util.cv_moments) are
+        calculated here if not provided. The log densities of the samples are
+        normalised with the importance sampling estimate of the normalising
+        constant using the global approximation as the proposal. N.B. This
+        requires that phi is the only parameter in the site model, so that
+        lp__ is the log density of phi.
+        
+        """
+        samp, lp = self.cv_samples
+        if S is None or m is None or ldet_Q is None:
+            cho = linalg.cho_factor(self.Q)
+            S, m = invert_normal_params(cho, self.r, cho_form=True)
+            ldet_Q = np.sum(np.log(np.diag(cho[0])))
+        # Normalise lp: 1/Z = E_tilted[ N(samp|m,S) / exp(lp) ]
+        dev = samp - m
+        lr = np.sum(dev.dot(self.Q)*dev, axis=1)
+        lr *= -0.5
+        lr += ldet_Q - 0.5*self.dphi*np.log(2*np.pi)
+        lr -= lp
+        lr_max = np.max(lr)
+        log_Z = -(lr_max + np.log(np.mean(np.exp(lr - lr_max))))
+        lp = lp - log_Z
+        # Estimate the moments into dQi and dri
+        cv_moments(samp, lp, self.Q, self.r, S_tilde=S, m_tilde=m,
+                   ldet_Q_tilde=ldet_Q, S_hat=dQi, m_hat=dri,
+                   block_size=self.cv_block_size, ridge=self.cv_ridge)
+        # Convert moment params to natural params
+        invert_normal_params(dQi, dri, out_A='in_place', out_b='in_place')
+        # Unbiased natural parameter estimates
+        unbias_k = (self.nsamp-self.dphi-2)/(self.nsamp-1)
+        dQi *= unbias_k
+        dri *= unbias_k
+    
+    
     def _apply_smooth(self, temp_v, temp_M):
         """Memorise and combine previous St and mt.
         
@@ -431,6 +632,241 @@ class Worker(object):
             return St_new, mt_new
 
 
+    def _apply_smooth_recursive(self):
+        """Combine St and mt into an exponentially weighted running estimate.
+        
+        The accumulated weighted sample size is multiplied by the decay factor
+        self.smooth and the current moments are merged into the accumulator
+        with the pairwise update of Chan et al. (see util.merge_moments).
+        Contrary to _apply_smooth, the number of samples may vary between the
+        iterations.
+        
+        After this:
+            self.Mat contains the smoothed unnormalised covariance estimate
+            self.vec contains the mean
+            self.nsamp contains the contributing sample size.
+        
+        """
+        
+        St = self.Mat
+        mt = self.vec
+        
+        if self.prev_stored < 0:
+            # Skip some first iterations ... no smoothing yet
+            self.prev_stored += 1
+            return St, mt
+        
+        elif self.prev_stored == 0:
+            # Store the first St and mt ... no smoothing yet
+            self.prev_stored += 1
+            self.smooth_n = float(self.nsamp)
+            np.copyto(self.smooth_mt, mt)
+            np.copyto(self.smooth_St, St)
+            return St, mt
+        
+        else:
+            # Decay the accumulator
+            acc_St = self.smooth_St
+            acc_mt = self.smooth_mt
+            n_a = self.smooth*self.smooth_n
+            acc_St *= self.smooth
+            # Merge the current moments into it
+            n_tot = n_a + self.nsamp
+            delta = self.temp_v
+            np.subtract(mt, acc_mt, out=delta)
+            np.multiply(delta[:,np.newaxis], delta, out=self.temp_M)
+            self.temp_M *= n_a*self.nsamp/n_tot
+            acc_St += St
+            acc_St += self.temp_M
+            delta *= self.nsamp/n_tot
+            acc_mt += delta
+            self.smooth_n = n_tot
+            # Output into St and mt, which are not needed anymore
+            np.copyto(St, acc_St)
+            np.copyto(mt, acc_mt)
+            # Set contributing sample size
+            self.nsamp = n_tot
+            return St, mt
+
+
+class LazyWorkers(object):
+    """Workers of the sites created on demand.
+    
+    Used by Master as the sequence `master.workers` when the option
+    `max_workers` is given. Indexing with k returns the worker of site k,
+    creating it if necessary. At most `max_workers` workers are kept, the
+    least recently used one is released when a new one is created. The state
+    of the sites is kept in compact arrays, so that a released worker can be
+    recreated at any time:
+        Mat, vec  : the arrays Worker.Mat (d,d,K) and Worker.vec (d,K), whose
+                    slices are used by the workers
+        iteration : the iterations of the workers (K,)
+        phase     : the phases of the workers (K,)
+        nsamp     : the contributing sample sizes (K,), NaN if not available
+        failed    : the failure flags of the tilted estimation (K,)
+        init      : the last samples of the chains if the option `init_prev`
+                    is used, None if not available (list of length K)
+        prev      : the samples stored for reuse by the estimator, e.g.
+                    tilted.RecyclingSampler (list of length K)
+        output    : the output sinks of the sites, None if not created yet
+                    (list of length K)
+    The scalar states of the kept workers are written into the arrays when
+    they are released or when the method sync is called. The workers share
+    the temporary arrays temp_M and temp_v. The cavity distributions of all
+    the sites are formed at once with the method cavity.
+    
+    Parameters
+    ----------
+    master : Master
+        The master of the sites.
+    
+    max_workers : int
+        The maximum number of workers kept at a time.
+    
+    """
+    
+    def __init__(self, master, max_workers):
+        self.master = master
+        self.max_workers = max_workers
+        K = master.K
+        dphi = master.dphi
+        self.Mat = np.empty((dphi,dphi,K), order='F')
+        self.vec = np.empty((dphi,K), order='F')
+        self.temp_M = np.empty((dphi,dphi), order='F')
+        self.temp_v = np.empty(dphi)
+        self.iteration = np.zeros(K, dtype=np.int64)
+        self.phase = np.zeros(K, dtype=np.int8)
+        self.nsamp = np.full(K, np.nan)
+        self.failed = np.zeros(K, dtype=bool)
+        self.init = [None]*K
+        self.prev = [None]*K
+        self.output = [None]*K
+        self.profile = False
+        # Kept workers in the order of use
+        self.kept = OrderedDict()
+        # Temporary arrays for the batched cavity distributions
+        self.block_size = 1024
+        self.cavity_temp = None
+    
+    def __len__(self):
+        return self.master.K
+    
+    def __iter__(self):
+        for k in xrange(self.master.K):
+            yield self[k]
+    
+    def __getitem__(self, k):
+        if k < 0:
+            k += self.master.K
+        if not 0 <= k < self.master.K:
+            raise IndexError("Site index out of range")
+        worker = self.kept.pop(k, None)
+        if worker is None:
+            if len(self.kept) >= self.max_workers:
+                self._release(*self.kept.popitem(last=False))
+            worker = self._create(k)
+        # Mark as the most recently used
+        self.kept[k] = worker
+        return worker
+    
+    def _create(self, k):
+        worker = self.master.make_worker(
+            k,
+            Mat=self.Mat[:,:,k],
+            vec=self.vec[:,k],
+            temp_M=self.temp_M,
+            temp_v=self.temp_v
+        )
+        worker.iteration = int(self.iteration[k])
+        worker.phase = int(self.phase[k])
+        if not np.isnan(self.nsamp[k]):
+            worker.nsamp = self.nsamp[k]
+        worker.failed = bool(self.failed[k])
+        if not self.init[k] is None:
+            worker.stan_params['init'] = self.init[k]
+        worker.prev_samples = self.prev[k]
+        if not self.output[k] is None:
+            worker.output = self.output[k]
+        worker.Q = self.master.Q
+        worker.r = self.master.r
+        worker.profile = self.profile
+        return worker
+    
+    def _save(self, k, worker):
+        self.iteration[k] = worker.iteration
+        self.phase[k] = worker.phase
+        self.nsamp[k] = np.nan if worker.nsamp is None else worker.nsamp
+        self.failed[k] = worker.failed
+        init = worker.stan_params['init']
+        self.init[k] = None if isinstance(init, basestring) else init
+        self.prev[k] = worker.prev_samples
+        if not worker.output is None:
+            self.output[k] = worker.output
+    
+    def cavity(self, Q, r, Qi, ri, dQi, dri, dfs, out):
+        """Form the cavity distributions of all the sites.
+        
+        Batched version of Worker.cavity operating directly on the compact
+        arrays, the sites being processed in blocks of `block_size` sites with
+        one native call per block (see util.invert_normal_params_stack). The
+        positive definiteness of the cavity of each site is placed into the
+        boolean array `out`.
+        
+        """
+        K = self.master.K
+        dphi = self.master.dphi
+        if self.cavity_temp is None:
+            B = min(self.block_size, K)
+            self.cavity_temp = (np.empty((dphi,dphi,B), order='F'),
+                                np.empty((dphi,B), order='F'))
+        temp_M, temp_v = self.cavity_temp
+        B = temp_M.shape[2]
+        for start in xrange(0, K, B):
+            end = min(start + B, K)
+            b = slice(start, end)
+            tM = temp_M[:,:,:end-start]
+            tv = temp_v[:,:end-start]
+            Mat = self.Mat[:,:,b]
+            vec = self.vec[:,b]
+            np.subtract(Q[:,:,np.newaxis], Qi[:,:,b], out=Mat)
+            np.subtract(r[:,np.newaxis], ri[:,b], out=vec)
+            Mat -= np.multiply(dQi[:,:,b], dfs[b], out=tM)
+            vec -= np.multiply(dri[:,b], dfs[b], out=tv)
+            # Check if positive definite and solve the means
+            np.copyto(tM, Mat)
+            _, _, out[b] = invert_normal_params_stack(
+                tM, vec, out_A='in_place', out_b='in_place')
+        self.phase[:] = out
+        for (k, worker) in self.kept.iteritems():
+            worker.Q = Q
+            worker.r = r
+            worker.phase = int(self.phase[k])
+    
+    def _release(self, k, worker):
+        self._save(k, worker)
+        if isinstance(worker.output, RotatingLog):
+            # Do not keep the log files of the released workers open, the
+            # file is reopened on the next write
+            worker.output.close()
+    
+    def sync(self):
+        """Write the state of the kept workers into the arrays."""
+        for (k, worker) in self.kept.iteritems():
+            self._save(k, worker)
+    
+    def release(self):
+        """Release all the kept workers."""
+        for (k, worker) in self.kept.iteritems():
+            self._release(k, worker)
+        self.kept.clear()
+    
+    def set_profile(self, profile):
+        """Set the attribute profile of all the workers."""
+        self.profile = profile
+        for worker in self.kept.itervalues():
+            worker.profile = profile
+
+
 class Master(object):
     """Manages the distributed EP algorithm.
     
@@ -486,8 +922,10 @@ class Master(object):
                            assumed to be in order (similary as for argument
                            `site_ind_ord`).
         Providing `site_ind_ord` or `site_sizes` is preferable over
-        `site_ind` because then the data arrays `X` and `y` does not have to be
-        copied.
+        `site_ind` because then the data arrays `X`, `y` and `A_n` does not
+        have to be copied. With `site_ind`, they are sorted into the order of
+        the sites with a stable counting sort (no copies are made if the
+        indices are already sorted).
     
     dphi : int, optional
         Number of parameters for the site model, i.e. the length of phi
@@ -505,8 +943,13 @@ class Master(object):
     Other parameters
     ----------------
     seed : {None, int, RandomState}, optional
-        The random seed used in the sampling. If not provided, a random seed is
-        used.
+        The root seed of the random streams. The seed of site k on iteration i
+        is derived from it with util.derive_seed(seed, k, i) and the chains
+        are separated with their chain_id in Stan, so that the results do not
+        depend on the order or the parallelism in which the sites and the
+        chains are sampled. A RandomState is used to draw the root seed. If
+        not provided, a random root seed is drawn; it is available as
+        `master.seed`.
     
     overwrite_model : bool, optional
         If a string for `site_model` is provided, the model is compiled even
@@ -526,6 +969,10 @@ class Master(object):
     thin : int, optional
         Thinning parameter for the site_model mcmc sampling. Default is 2.
     
+    n_jobs : int, optional
+        The number of processes running the chains in the site_model mcmc
+        sampling (see StanModel.sampling). Default is -1, i.e. all the CPUs.
+    
     init_prev : bool, optional
         Indicates if the last sample of each chain in the site mcmc sampling is
         used as the starting point for the next iteration sampling. Default is
@@ -537,17 +984,36 @@ class Master(object):
         the sampling on the first iteration, and strings 'random' and '0' are
         the only acceptable values for this argument.
     
-    prec_estim : {'sample', 'olse'}
+    prec_estim : {'sample', 'olse', 'cv'}
         Method for estimating the precision matrix from the tilted distribution
         samples. The available methods are:
             'sample'    : basic sample estimate
             'olse'      : optimal linear shrinkage estimate (see util.olse)
+            'cv'        : control variate estimate using the global
+                          approximation as the control (see util.cv_moments),
+                          requires that phi is the only parameter in the site
+                          model and that the samples are drawn with MCMC
+                          (tilted.StanSampler), otherwise the basic sample
+                          estimate is used
         The default method is 'sample'.
     
     prec_estim_skip : int
         Non-negative integer indicating on how many iterations from the begining
         the tilted distribution precision matrix is estimated using the default
-        sample estimate instead of anything else.
+        sample estimate instead of anything else. Default is 0.
+    
+    cv_block_size : {None, int}, optional
+        The number of covariance elements processed at a time in the control
+        variate estimate (see util.cv_moments). None processes all of them at
+        once. Default is 512.
+    
+    cv_ridge : {None, float}, optional
+        Ridge regularisation of the multiple control variate system of the
+        covariance in the control variate estimate (see util.cv_moments). It
+        is required for the multiple control variates if the number of the
+        covariance elements dphi*(dphi+1)/2 exceeds the number of samples,
+        otherwise each element is controlled only with its own control
+        variate. Used only if `cv_block_size` is given. Default is None.
     
     smooth : {None, array_like}, optional
         A portion of samples from previous iterations to be taken into account
@@ -555,12 +1021,40 @@ class Master(object):
         weights so that smooth[0] is a weight for the previous tilted
         distribution, smooth[1] is a weight for the distribution two iterations
         ago, etc. Empty list or None indicates that no smoothing is done
-        (default behaviour).
+        (default behaviour). A scalar in (0,1) applies exponentially weighted
+        smoothing instead, the weight of the distribution i iterations ago
+        being smooth**i. It is computed recursively with a single running
+        accumulator per site and allows varying sample sizes.
     
     smooth_ignore : int, optional
         If smoothing is applied, this non-negative integer indicates how many
         iterations are performed before the smoothing is started. Default is 1.
     
+    tilted_estim : {None, TiltedEstimator, list of TiltedEstimator}, optional
+        The estimator of the tilted distribution moments (see module tilted).
+        A list of length K provides a separate estimator for each site. If not
+        provided, the tilted distributions are sampled with the site model
+        (tilted.StanSampler). E.g. tilted.SwitchingEstimator uses the Laplace
+        approximation (tilted.LaplaceApprox) in the first iterations.
+    
+    max_retries : int, optional
+        The number of times a failed sampling of a site is retried with a new
+        seed and a random initialisation on each iteration. If all the
+        attempts fail, the site is skipped on that iteration and its previous
+        site parameters are kept. Default is 2.
+    
+    failure_dir : {None, str}, optional
+        The directory where the artifacts of the failed sampling attempts are
+        written (see Worker.write_failure). None (default) writes nothing.
+    
+    stan_output : {None, 'ring', str, object}, optional
+        Where the output of the site model is captured (see module capture).
+        None discards it (default), 'ring' keeps the latest output of each site
+        in memory (capture.RingBuffer) and a string is a directory for
+        rotating log files site_<k>.log (capture.RotatingLog). An object
+        with the method write is used as a sink shared by all the sites. The
+        sink of site k is available as `master.workers[k].output`.
+    
     df0 : float or function, optional
         The initial damping factor for each iteration. Must be a number in the
         range (0,1]. If a number is given, a constant initial damping factor for
@@ -583,6 +1077,59 @@ class Master(object):
         The treshold value for the damping factor. If the damping factor decays
         below this value, the algorithm is stopped. Default is 1e-8.
     
+    df_persite : bool, optional
+        If True, each site has its own damping factor and only the factors of
+        the sites whose cavity distribution is not positive definite are
+        reduced. If False, one damping factor shared by all the sites is
+        reduced whenever any of the cavity distributions fails. In both cases,
+        the damping factors of all the sites are reduced if the resulting
+        posterior covariance is not positive definite. Default is True.
+    
+    site_groups : {None, int, array_like}, optional
+        Groups of consecutive sites whose natural parameters are summed
+        together before the master combines the group sums into the global
+        approximation, i.e. a two level aggregation tree. An integer gives the
+        number of groups of (nearly) equal size, an array-like of length G
+        gives the number of sites in each group. In a distributed setting,
+        the group sums are what the processes holding the groups need to
+        communicate. None (default) sums over all the sites at once. With
+        `df_pergroup`, the positive definiteness of the global approximation
+        is also checked per group: if the combined damped update fails, the
+        damping factors of only the groups whose update alone makes the
+        approximation not positive definite are reduced, and of all the groups
+        if there are none.
+    
+    df_pergroup : bool, optional
+        If True, the sites in each group of `site_groups` share a damping
+        factor and the factor of every group containing a site whose cavity
+        distribution is not positive definite is reduced. The sums of the
+        damped updates are then adjusted with the group sums only. The same
+        is done for the groups failing the global check (see `site_groups`).
+        Overrides `df_persite`. Default is False.
+    
+    dtype : {'float64', 'float32'}, optional
+        The float type of the stored site parameters Qi, ri and their updates
+        dQi, dri. With 'float32', their memory usage and bandwidth are halved,
+        while the Cholesky decompositions, the inversions and the sums over
+        the sites are still calculated in double precision. Each stored site
+        parameter then has a relative rounding error of at most 2^-24 (6e-8)
+        per iteration, so that the error in the global natural parameters is
+        bounded by K*2^-24 times the sum of the absolute values of the site
+        parameters (typically sqrt(K)*2^-24) and the error in the posterior
+        moments by this times the condition number of Q. As long as this is
+        well below the Monte Carlo error of the tilted estimates (of order
+        1/sqrt(nsamp)), the mode does not affect the results. Default is
+        'float64'.
+    
+    max_workers : {None, int}, optional
+        If None (default), the workers of all the sites are created in the
+        beginning and kept in memory. If an integer is given, the workers are
+        created on demand when their site is processed and at most
+        `max_workers` of them are kept at a time (see LazyWorkers). The state
+        of the sites is then kept in compact arrays, so that the construction
+        is fast and the memory usage per site is small also with a very large
+        number of sites. Can not be used with the option `smooth`.
+    
     Notes
     -----
     TODO: Describe the structure of the site model.
@@ -610,6 +1157,11 @@ class Master(object):
         'df0_exp_speed'    : 0.8,
         'df_decay'         : 0.9,
         'df_treshold'      : 1e-8,
+        'df_persite'       : True,
+        'site_groups'      : None,
+        'df_pergroup'      : False,
+        'dtype'            : 'float64',
+        'max_workers'      : None,
         'overwrite_model'  : False
     }
     
@@ -659,14 +1211,13 @@ class Master(object):
         # Nk    : number of samples per site
         # k_ind : site index of each sample
         # k_lim : sample index limits
+        k_sort = None
         if not kwargs['site_sizes'] is None:
             # Size of each site provided
-            self.Nk = kwargs['site_sizes']
+            self.Nk = np.asarray(kwargs['site_sizes'], dtype=np.int64)
             self.K = len(self.Nk)
             self.k_lim = np.concatenate(([0], np.cumsum(self.Nk)))
-            self.k_ind = np.empty(self.N, dtype=np.int64)
-            for k in xrange(self.K):
-                self.k_ind[self.k_lim[k]:self.k_lim[k+1]] = k
+            self.k_ind = np.repeat(np.arange(self.K), self.Nk)
         elif not kwargs['site_ind_ord'] is None:
             # Sorted array of site indices provided
             self.k_ind = kwargs['site_ind_ord']
@@ -675,15 +1226,24 @@ class Master(object):
             self.k_lim = np.concatenate(([0], np.cumsum(self.Nk)))
         elif not kwargs['site_ind'] is None:
             # Unsorted array of site indices provided
-            k_ind = kwargs['site_ind']
-            k_sort = k_ind.argsort(kind='mergesort') # Stable sort
-            self.k_ind = k_ind[k_sort]
-            self.Nk = np.bincount(self.k_ind)
-            self.K = len(self.Nk)
+            k_ind = np.asarray(kwargs['site_ind'])
+            if not k_ind.dtype in (np.int32, np.int64):
+                k_ind = k_ind.astype(np.int64)
+            self.K = np.max(k_ind) + 1
+            # Stable counting sort
+            counts = np.empty(self.K, dtype=np.intp)
+            k_sort = np.empty(self.N, dtype=np.intp)
+            bucket_argsort(k_ind, counts, k_sort)
+            self.Nk = counts.astype(np.int64)
             self.k_lim = np.concatenate(([0], np.cumsum(self.Nk)))
-            # Copy X and y to a new sorted array
-            self.X = self.X[k_sort]
-            self.y = self.y[k_sort]
+            self.k_ind = np.repeat(np.arange(self.K), self.Nk)
+            if np.all(k_ind == self.k_ind):
+                # Already sorted
+                k_sort = None
+            else:
+                # Copy X and y to a new sorted array
+                self.X = self.X.take(k_sort, axis=0)
+                self.y = self.y.take(k_sort)
         else:
             raise NotImplementedError("Auto clustering not yet implemented")
         if self.k_lim[-1] != self.N:
@@ -716,8 +1276,11 @@ class Master(object):
                  or key in self.A
                ):
                 raise ValueError("Additional data name {} clashes.".format(key))
-            # Ensure C-contiguous
-            if not val.flags['CARRAY']:
+            if not k_sort is None:
+                # Sort into the order of the sites
+                self.A_n[key] = val.take(k_sort, axis=0)
+            elif not val.flags['C_CONTIGUOUS']:
+                # Ensure C-contiguous
                 self.A_n[key] = np.ascontiguousarray(val)
         # Process A_k
         self.A_k = kwargs['A_k']
@@ -765,6 +1328,9 @@ class Master(object):
         # Damping factor
         self.df_decay = kwargs['df_decay']
         self.df_treshold = kwargs['df_treshold']
+        self.df_persite = kwargs['df_persite']
+        self.df_pergroup = kwargs['df_pergroup']
+        self.dtype = kwargs['dtype']
         if kwargs['df0'] is None:
             # Use default exponential decay function
             df0_speed = kwargs['df0_exp_speed']
@@ -791,29 +1357,33 @@ class Master(object):
             self.site_model = site_model
         
         # Process seed in worker options
-        if not isinstance(self.worker_options['seed'], np.random.RandomState):
-            self.worker_options['seed'] = \
-                np.random.RandomState(seed=self.worker_options['seed'])
+        self.seed = root_seed(self.worker_options['seed'])
+        self.worker_options['seed'] = self.seed
+        
+        # Process site specific tilted distribution estimators
+        tilted_estims = self.worker_options['tilted_estim']
+        if isinstance(tilted_estims, (list, tuple)):
+            if len(tilted_estims) != self.K:
+                raise ValueError("Length of the list `tilted_estim` does not "
+                                 "match with the number of sites")
+        else:
+            tilted_estims = [tilted_estims]*self.K
+        
+        self.tilted_estims = tilted_estims
+        self.worker_options['tilted_estim'] = tilted_estims
         
         # Initialise the workers
-        self.workers = []
-        for k in xrange(self.K):
-            A = dict((key, val[self.k_lim[k]:self.k_lim[k+1]])
-                     for (key, val) in self.A_n.iteritems())
-            A.update(self.A)
-            for (key, val) in self.A_k.iteritems():
-                A[key] = val[k]
-            self.workers.append(
-                Worker(
-                    k,
-                    self.site_model,
-                    self.dphi,
-                    X[self.k_lim[k]:self.k_lim[k+1]],
-                    y[self.k_lim[k]:self.k_lim[k+1]],
-                    A=A,
-                    **self.worker_options
-                )
-            )
+        self.max_workers = kwargs['max_workers']
+        if self.max_workers is None:
+            self.workers = [self.make_worker(k) for k in xrange(self.K)]
+        else:
+            if self.max_workers < 1:
+                raise ValueError("Arg. `max_workers` has to be positive")
+            smooth = self.worker_options['smooth']
+            if not smooth is None and np.size(smooth) > 0:
+                raise ValueError("Option `smooth` can not be used with "
+                                 "`max_workers`")
+            self.workers = LazyWorkers(self, self.max_workers)
         
         # Allocate space for calculations
         # Mean and cov of the approximation
@@ -823,20 +1393,114 @@ class Master(object):
         self.Q = self.Q0.copy(order='F')
         self.r = self.r0.copy()
         # Natural site parameters
-        self.Qi = np.zeros((self.dphi,self.dphi,self.K), order='F')
-        self.ri = np.zeros((self.dphi,self.K), order='F')
-        # Natural site proposal parameters
-        self.Qi2 = np.zeros((self.dphi,self.dphi,self.K), order='F')
-        self.ri2 = np.zeros((self.dphi,self.K), order='F')
+        if not self.dtype in ('float64', 'float32'):
+            raise ValueError("Invalid value for option `dtype`")
+        self.Qi = np.zeros((self.dphi,self.dphi,self.K), order='F',
+                           dtype=self.dtype)
+        self.ri = np.zeros((self.dphi,self.K), order='F', dtype=self.dtype)
         # Site parameter updates
-        self.dQi = np.zeros((self.dphi,self.dphi,self.K), order='F')
-        self.dri = np.zeros((self.dphi,self.K), order='F')
+        self.dQi = np.zeros((self.dphi,self.dphi,self.K), order='F',
+                            dtype=self.dtype)
+        self.dri = np.zeros((self.dphi,self.K), order='F', dtype=self.dtype)
+        
+        # Site groups
+        # G         : number of groups
+        # group_lim : site index limits of the groups
+        # k_group   : group index of each site
+        groups = kwargs['site_groups']
+        if groups is None:
+            if self.df_pergroup:
+                raise ValueError("Option `df_pergroup` requires "
+                                 "`site_groups`")
+            self.G = None
+            self.group_lim = None
+            self.k_group = None
+        else:
+            if np.ndim(groups) == 0:
+                if groups < 1 or groups > self.K:
+                    raise ValueError("The number of groups has to be between "
+                                     "1 and K")
+                sizes = np.full(groups, self.K // groups, dtype=np.int64)
+                sizes[:self.K % groups] += 1
+            else:
+                sizes = np.asarray(groups, dtype=np.int64)
+                if np.any(sizes < 1) or sizes.sum() != self.K:
+                    raise ValueError("Group sizes in `site_groups` should be "
+                                     "positive and sum up to K")
+            self.G = len(sizes)
+            self.group_lim = np.concatenate(([0], np.cumsum(sizes)))
+            self.k_group = np.repeat(np.arange(self.G), sizes)
         
         # Track iterations
         self.iter = 0
     
     
-    def run(self, niter, calc_moments=True, verbose=True):
+    def make_worker(self, k, **arrays):
+        """Create the worker of site `k`.
+        
+        The keyword arguments `arrays` are passed to Worker (see Worker).
+        
+        """
+        A = dict((key, val[self.k_lim[k]:self.k_lim[k+1]])
+                 for (key, val) in self.A_n.iteritems())
+        A.update(self.A)
+        for (key, val) in self.A_k.iteritems():
+            A[key] = val[k]
+        options = dict(self.worker_options, tilted_estim=self.tilted_estims[k])
+        options.update(arrays)
+        return Worker(
+            k,
+            self.site_model,
+            self.dphi,
+            self.X[self.k_lim[k]:self.k_lim[k+1]],
+            self.y[self.k_lim[k]:self.k_lim[k+1]],
+            A=A,
+            **options
+        )
+    
+    def site_moments(self, start=0, end=None, out=None):
+        """Tilted distribution moments of the sites `start` to `end`-1.
+        
+        Returns the contributing sample sizes nsamp of shape (n,), the means
+        of shape (n,d) and the unnormalised covariance matrices of shape
+        (n,d,d) of the n sites (see Worker.tilted) without materialising the
+        workers. If `out` is given, the results are placed into the given
+        three arrays of at least n rows. The sites without valid tilted
+        distribution moments, i.e. the ones whose estimation failed or was not
+        done yet, have nsamp zero and NaN moments.
+        
+        """
+        if end is None:
+            end = self.K
+        n = end - start
+        if out is None:
+            out = (np.empty(n), np.empty((n,self.dphi)),
+                   np.empty((n,self.dphi,self.dphi)))
+        nsamp, mt, St = out
+        if isinstance(self.workers, LazyWorkers):
+            self.workers.sync()
+            nsamp[:n] = self.workers.nsamp[start:end]
+            mt[:n] = self.workers.vec[:,start:end].T
+            St[:n] = self.workers.Mat[:,:,start:end].transpose(2,0,1)
+            invalid = np.nonzero(self.workers.phase[start:end] != 2)[0]
+        else:
+            invalid = []
+            for k in xrange(start, end):
+                worker = self.workers[k]
+                if worker.phase != 2:
+                    invalid.append(k-start)
+                    continue
+                nsamp[k-start] = worker.nsamp
+                mt[k-start] = worker.vec
+                St[k-start] = worker.Mat
+        # Mark the sites whose Mat and vec do not hold the tilted moments
+        nsamp[invalid] = 0
+        mt[invalid] = np.nan
+        St[invalid] = np.nan
+        return nsamp[:n], mt[:n], St[:n]
+    
+    def run(self, niter, calc_moments=True, ret_df=False, hooks=None,
+            verbose=True):
         """Run the distributed EP algorithm.
         
         Parameters
@@ -849,6 +1513,15 @@ class Master(object):
             posterior approximation are calculated every iteration and returned.
             Default is True.
         
+        ret_df : bool, optional
+            If True, the accepted damping factor of each site at every
+            iteration is returned. Default is False.
+        
+        hooks : {None, Hook, list of Hook}, optional
+            Instrumentation hooks notified about the timings of each phase and
+            the damping events (see module hooks). The phases are timed only
+            if hooks are provided.
+        
         verbose : bool, optional
             If true, some progress information is printed. Default is True.
         
@@ -858,7 +1531,20 @@ class Master(object):
             Mean and variance of the posterior approximation at every iteration.
             Returned only if `calc_moments` is True.
         
+        df_s : ndarray
+            The accepted damping factors of the sites at every iteration in an
+            array of shape (niter, K). Returned only if `ret_df` is True.
+        
         """
+        try:
+            return self._run(niter, calc_moments, ret_df, hooks, verbose)
+        finally:
+            # Restore the descriptors redirected for capturing the output of
+            # the site models (see module capture)
+            get_capture().stop()
+    
+    def _run(self, niter, calc_moments, ret_df, hooks, verbose):
+        """Run the iterations, see the method run."""
         
         # Localise some instance variables
         # Mean and cov of the posterior approximation
@@ -870,134 +1556,380 @@ class Master(object):
         # Natural site parameters
         Qi = self.Qi
         ri = self.ri
-        # Natural site proposal parameters
-        Qi2 = self.Qi2
-        ri2 = self.ri2
         # Site parameter updates
         dQi = self.dQi
         dri = self.dri
         
+        # Sums of the natural site parameters over the sites
+        Qi_sum = np.empty((self.dphi,self.dphi), order='F')
+        ri_sum = np.empty(self.dphi)
+        # Sums of the site parameter updates multiplied by the damping factors
+        dQi_sum = np.empty((self.dphi,self.dphi), order='F')
+        dri_sum = np.empty(self.dphi)
+        if not self.G is None:
+            # Sums over the sites in each group
+            group_starts = self.group_lim[:-1]
+            Qi_g = np.empty((self.dphi,self.dphi,self.G), order='F')
+            ri_g = np.empty((self.dphi,self.G), order='F')
+            dQi_g = np.empty((self.dphi,self.dphi,self.G), order='F')
+            dri_g = np.empty((self.dphi,self.G), order='F')
+        
         # Array for positive definitness checking of each cavity distribution
         posdefs = np.empty(self.K, dtype=bool)
+        # Failed tilted distribution estimates
+        failed = np.empty(self.K, dtype=bool)
+        # Damping factor of each site
+        dfs = np.empty(self.K)
+        # The global moments are needed by the control variate estimates also
+        # if they are not returned
+        prec_cv = self.worker_options['prec_estim'] == 'cv'
         
         if calc_moments:
             # Allocate memory for results
             m_phi_s = np.zeros((niter, self.dphi))
             var_phi_s = np.zeros((niter, self.dphi))
+        if ret_df:
+            df_s = np.zeros((niter, self.K))
+        
+        # Instrumentation
+        if hooks is None:
+            hooks = []
+        elif isinstance(hooks, Hook):
+            hooks = [hooks]
+        if isinstance(self.workers, LazyWorkers):
+            self.workers.set_profile(bool(hooks))
+        else:
+            for worker in self.workers:
+                worker.profile = bool(hooks)
+        for hook in hooks:
+            hook.run_start(self, niter)
         
         # Iterate niter rounds
         for cur_iter in xrange(niter):
             self.iter += 1
+            for hook in hooks:
+                hook.iteration_start(self.iter)
             # Initial dampig factor
             if self.iter > 1:
-                df = self.df0(self.iter)
+                dfs.fill(self.df0(self.iter))
             else:
                 # At the first round (rond zero) there is nothing to damp yet
-                df = 1
+                dfs.fill(1)
             if verbose:
-                print 'Iter {}, starting df {:.3g}.'.format(self.iter, df)
+                print 'Iter {}, starting df {:.3g}.'.format(self.iter, dfs[0])
+            
+            # The global approximation for any damping factors is
+            #     Q = Q0 + sum(Qi) + sum(df*dQi),
+            # so that only the sums are needed when trying out the damping
+            # factors. The site parameters are updated once a step is accepted.
+            # The sums are accumulated in double precision also with float32
+            # site parameters. These 4 lines could be run in parallel also
+            if self.G is None:
+                Qi.sum(2, out=Qi_sum, dtype=np.float64)
+                ri.sum(1, out=ri_sum, dtype=np.float64)
+                dQi.sum(2, out=dQi_sum, dtype=np.float64)
+                dri.sum(1, out=dri_sum, dtype=np.float64)
+            else:
+                # Each group pre-sums its sites and only the group sums are
+                # combined (could be run in parallel over the groups)
+                np.add.reduceat(Qi, group_starts, axis=2, dtype=np.float64,
+                                out=Qi_g)
+                np.add.reduceat(ri, group_starts, axis=1, dtype=np.float64,
+                                out=ri_g)
+                np.add.reduceat(dQi, group_starts, axis=2, dtype=np.float64,
+                                out=dQi_g)
+                np.add.reduceat(dri, group_starts, axis=1, dtype=np.float64,
+                                out=dri_g)
+                Qi_g.sum(2, out=Qi_sum)
+                ri_g.sum(1, out=ri_sum)
+                dQi_g.sum(2, out=dQi_sum)
+                dri_g.sum(1, out=dri_sum)
+            dQi_sum *= dfs[0]
+            dri_sum *= dfs[0]
             
             while True:
                 # Try to update the global posterior approximation
-                
-                # These 4 lines could be run in parallel also
-                np.add(Qi, np.multiply(df, dQi, out=Qi2), out=Qi2)
-                np.add(ri, np.multiply(df, dri, out=ri2), out=ri2)
-                np.add(Qi2.sum(2, out=Q), self.Q0, out=Q)
-                np.add(ri2.sum(1, out=r), self.r0, out=r)
+                np.add(Qi_sum, self.Q0, out=Q)
+                Q += dQi_sum
+                np.add(ri_sum, self.r0, out=r)
+                r += dri_sum
                 # N.B. In the first iteration Q=Q0 and r=r0
                 
                 # Check for positive definiteness
+                if hooks:
+                    t0 = clock()
                 cho_Q = S
                 np.copyto(cho_Q, Q)
                 try:
                     linalg.cho_factor(cho_Q, overwrite_a=True)
+                    posdef = True
                 except linalg.LinAlgError:
-                    # Not positive definite -> reduce damping factor
-                    df *= self.df_decay
-                    if verbose:
-                        print 'Neg def posterior cov,', \
-                              'reducing df to {:.3}'.format(df)
+                    posdef = False
+                if hooks:
+                    wall, cpu = elapsed(t0)
+                    for hook in hooks:
+                        hook.phase(self.iter, 'global_cholesky', wall, cpu,
+                                   posdef=posdef)
+                if not posdef:
+                    gfails = None
+                    if self.df_pergroup and self.iter > 1:
+                        # Find the groups whose damped update alone makes
+                        # the global approximation not positive definite
+                        gfails = self._global_group_fails(
+                            Qi_sum, dQi_g, dfs[group_starts], cho_Q)
+                    if not gfails is None and len(gfails) > 0:
+                        # Reduce the damping factors of these groups only
+                        ddfs = (1 - self.df_decay)*dfs[self.group_lim[gfails]]
+                        dQi_sum -= dQi_g[:,:,gfails].dot(ddfs)
+                        dri_sum -= dri_g[:,gfails].dot(ddfs)
+                        fails = np.nonzero(np.in1d(self.k_group, gfails))[0]
+                        dfs[fails] *= self.df_decay
+                        for hook in hooks:
+                            hook.damping(self.iter, 'global', fails, dfs)
+                        if verbose:
+                            print 'Neg def posterior cov by group(s) {},' \
+                                  .format(gfails), \
+                                  'reducing their df to {:.3}.' \
+                                  .format(dfs[fails].max())
+                    else:
+                        # Not positive definite -> reduce all damping factors
+                        dfs *= self.df_decay
+                        dQi_sum *= self.df_decay
+                        dri_sum *= self.df_decay
+                        for hook in hooks:
+                            hook.damping(self.iter, 'global',
+                                         np.arange(self.K), dfs)
+                        if verbose:
+                            print 'Neg def posterior cov,', \
+                                  'reducing df to {:.3}'.format(dfs.max())
                     if self.iter == 1:
                         if verbose:
                             print 'Invalid prior.'
+                        for hook in hooks:
+                            hook.run_end(self.INVALID_PRIOR)
                         return self.INVALID_PRIOR
-                    if df < self.df_treshold:
+                    if dfs.min() < self.df_treshold:
                         if verbose:
                             print 'Damping factor reached minimum.'
+                        for hook in hooks:
+                            hook.run_end(self.DF_TRESHOLD_REACHED_GLOBAL)
                         return self.DF_TRESHOLD_REACHED_GLOBAL
                     continue
                 
                 # Cavity distributions (parallelisable)
                 # -------------------------------
                 # Check positive definitness for each cavity distribution
-                for k in xrange(self.K):
-                    posdefs[k] = \
-                        self.workers[k].cavity(Q, r, Qi2[:,:,k], ri2[:,k])
-                    # Early stopping criterion (when in serial)
-                    if not posdefs[k]:
-                        break
+                if isinstance(self.workers, LazyWorkers):
+                    # All the sites at once in the compact arrays
+                    if hooks:
+                        t0 = clock()
+                    self.workers.cavity(Q, r, Qi, ri, dQi, dri, dfs, posdefs)
+                    if hooks:
+                        wall, cpu = elapsed(t0)
+                        for hook in hooks:
+                            hook.phase(self.iter, 'cavity', wall, cpu,
+                                       posdef=np.all(posdefs))
+                else:
+                    for k in xrange(self.K):
+                        if hooks:
+                            t0 = clock()
+                        posdefs[k] = self.workers[k].cavity(
+                            Q, r, Qi[:,:,k], ri[:,k],
+                            dQi=dQi[:,:,k], dri=dri[:,k], df=dfs[k]
+                        )
+                        if hooks:
+                            wall, cpu = elapsed(t0)
+                            for hook in hooks:
+                                hook.phase(self.iter, 'cavity', wall, cpu,
+                                           site=k, posdef=posdefs[k])
+                        # Early stopping criterion (when in serial). With
+                        # per-site or per-group damping every failing site
+                        # has to be found.
+                        if (    not posdefs[k]
+                            and not self.df_persite
+                            and not self.df_pergroup
+                           ):
+                            break
                 
                 if np.all(posdefs):
                     # All cavity distributions are positive definite.
-                    # Accept step (switch Qi-Qi2 and ri-ri2)
-                    temp = Qi
-                    Qi = Qi2
-                    Qi2 = temp
-                    temp = ri
-                    ri = ri2
-                    ri2 = temp
-                    self.Qi = Qi
-                    self.Qi2 = Qi2
-                    self.ri = ri
-                    self.ri2 = ri2
+                    # Accept step (apply the damped updates in place, dQi and
+                    # dri are overwritten in the tilted phase anyway)
+                    Qi += np.multiply(dfs, dQi, out=dQi)
+                    ri += np.multiply(dfs, dri, out=dri)
                     break
-                    
+                
+                elif self.df_pergroup:
+                    # Not all cavity distributions are positive definite ...
+                    # reduce the damping factors of the groups containing
+                    # failed sites and remove the reduced portions from the
+                    # sums of the updates using the group sums
+                    gfails = np.nonzero(~np.logical_and.reduceat(
+                        posdefs, self.group_lim[:-1]))[0]
+                    ddfs = (1 - self.df_decay)*dfs[self.group_lim[gfails]]
+                    dQi_sum -= dQi_g[:,:,gfails].dot(ddfs)
+                    dri_sum -= dri_g[:,gfails].dot(ddfs)
+                    fails = np.nonzero(np.in1d(self.k_group, gfails))[0]
+                    dfs[fails] *= self.df_decay
+                    for hook in hooks:
+                        hook.damping(self.iter, 'cavity', fails, dfs)
+                    if verbose:
+                        print 'Neg.def. cavity in group(s) {},' \
+                              .format(gfails), \
+                              'reducing their df to {:.3}.' \
+                              .format(dfs[fails].max())
+                    if dfs.min() < self.df_treshold:
+                        if verbose:
+                            print 'Damping factor reached minimum.'
+                        for hook in hooks:
+                            hook.run_end(self.DF_TRESHOLD_REACHED_CAVITY)
+                        return self.DF_TRESHOLD_REACHED_CAVITY
+                
+                elif self.df_persite:
+                    # Not all cavity distributions are positive definite ...
+                    # reduce the damping factors of the failed sites and
+                    # remove the reduced portions from the sums of the updates
+                    fails = np.nonzero(~posdefs)[0]
+                    ddfs = (1 - self.df_decay)*dfs[fails]
+                    dQi_sum -= dQi[:,:,fails].dot(ddfs)
+                    dri_sum -= dri[:,fails].dot(ddfs)
+                    dfs[fails] *= self.df_decay
+                    for hook in hooks:
+                        hook.damping(self.iter, 'cavity', fails, dfs)
+                    if verbose:
+                        print 'Neg.def. cavity in site(s) {},' \
+                              .format(fails), \
+                              'reducing their df to {:.3}.' \
+                              .format(dfs[fails].max())
+                    if dfs.min() < self.df_treshold:
+                        if verbose:
+                            print 'Damping factor reached minimum.'
+                        for hook in hooks:
+                            hook.run_end(self.DF_TRESHOLD_REACHED_CAVITY)
+                        return self.DF_TRESHOLD_REACHED_CAVITY
+                
                 else:
                     # Not all cavity distributions are positive definite ...
                     # reduce the damping factor
-                    df *= self.df_decay
+                    dfs *= self.df_decay
+                    dQi_sum *= self.df_decay
+                    dri_sum *= self.df_decay
+                    for hook in hooks:
+                        hook.damping(self.iter, 'cavity', np.arange(self.K),
+                                     dfs)
                     if verbose:
                         print 'Neg.def. cavity', \
                               '(first encountered in site {}),' \
                               .format(np.nonzero(~posdefs)[0][0]), \
-                              'reducing df to {:.3}.'.format(df)
-                    if df < self.df_treshold:
+                              'reducing df to {:.3}.'.format(dfs[0])
+                    if dfs[0] < self.df_treshold:
                         if verbose:
                             print 'Damping factor reached minimum.'
+                        for hook in hooks:
+                            hook.run_end(self.DF_TRESHOLD_REACHED_CAVITY)
                         return self.DF_TRESHOLD_REACHED_CAVITY
             
-            if calc_moments:
+            if ret_df:
+                # Store the accepted damping factors
+                np.copyto(df_s[cur_iter], dfs)
+            
+            if calc_moments or prec_cv:
                 # Invert Q (chol was already calculated)
                 # N.B. The following inversion could be done while
                 # parallel jobs are running, thus saving time.
+                if hooks:
+                    t0 = clock()
+                ldet_Q = np.sum(np.log(np.diag(cho_Q)))
                 invert_normal_params(cho_Q, r, out_A='in_place', out_b=m,
                                      cho_form=True)
+                if hooks:
+                    wall, cpu = elapsed(t0)
+                    for hook in hooks:
+                        hook.phase(self.iter, 'moment_inversion', wall, cpu)
+                # Moments for the control variate estimates, so that the
+                # workers do not need to factorise Q again
+                glob_moments = dict(S=S, m=m, ldet_Q=ldet_Q)
+            else:
+                glob_moments = {}
+            if calc_moments:
                 # Store the approximation moments
                 np.copyto(m_phi_s[cur_iter], m)
                 np.copyto(var_phi_s[cur_iter], np.diag(S))
+                for hook in hooks:
+                    hook.moments(self.iter, S, m)
             
             # Tilted distributions (parallelisable)
             # -------------------------------
             for k in xrange(self.K):
-                posdefs[k] = self.workers[k].tilted(dQi[:,:,k], dri[:,k])
+                if hooks:
+                    t0 = clock()
+                worker = self.workers[k]
+                posdefs[k] = worker.tilted(dQi[:,:,k], dri[:,k],
+                                           **glob_moments)
+                failed[k] = worker.failed
+                if hooks:
+                    wall, cpu = elapsed(t0)
+                    for hook in hooks:
+                        hook.phase(self.iter, 'tilted', wall, cpu, site=k,
+                                   posdef=posdefs[k], nsamp=worker.nsamp,
+                                   failed=worker.failed,
+                                   **worker.times)
             if verbose and not np.all(posdefs):
-                print 'Neg.def. tilted in site(s) {}.' \
-                      .format(np.nonzero(~posdefs)[0])
+                if np.any(failed):
+                    print 'Sampling failed in site(s) {}.' \
+                          .format(np.nonzero(failed)[0])
+                if np.any(~posdefs & ~failed):
+                    print 'Neg.def. tilted in site(s) {}.' \
+                          .format(np.nonzero(~posdefs & ~failed)[0])
             
             if verbose and calc_moments:
                 print 'Iter {} done, std of phi[0]: {}' \
                       .format(self.iter, np.sqrt(var_phi_s[cur_iter,0]))
             
+            for hook in hooks:
+                hook.iteration_end(self.iter, dfs)
+        
+        for hook in hooks:
+            hook.run_end(None)
+        
         if calc_moments:
+            if ret_df:
+                return m_phi_s, var_phi_s, df_s
             return m_phi_s, var_phi_s
+        elif ret_df:
+            return df_s
     
     
-    def mix_samples(self, out_S=None, out_m=None):
+    def _global_group_fails(self, Qi_sum, dQi_g, dfs_g, temp):
+        """Find the groups whose damped update alone is not acceptable.
+        
+        The damped update of each group is applied alone into the current
+        global approximation Q0 + sum(Qi) and the groups for which the result
+        is not positive definite are returned. If the combined update fails
+        but every single group passes, an empty array is returned.
+        
+        """
+        gfails = []
+        for g in xrange(self.G):
+            np.add(Qi_sum, self.Q0, out=temp)
+            temp += dfs_g[g]*dQi_g[:,:,g]
+            try:
+                linalg.cho_factor(temp, overwrite_a=True)
+            except linalg.LinAlgError:
+                gfails.append(g)
+        return np.array(gfails, dtype=np.intp)
+    
+    
+    def mix_samples(self, out_S=None, out_m=None, block_size=1024):
         """Form the posterior approximation by mixing the last samples.
         
         Mixes the last obtained mcmc samples from the tilted distributions to
-        obtain an approximation to the posterior.
+        obtain an approximation to the posterior. The moments of the sites are
+        merged pairwise (see util.merge_moments) in blocks of `block_size`
+        sites, after which the blocks are merged similarly. The sites without
+        valid tilted distribution moments on the last iteration (see
+        site_moments), e.g. the skipped sites whose sampling failed, are
+        excluded.
         
         Parameters
         ----------
@@ -1005,6 +1937,9 @@ class Master(object):
             The output arrays into which the approximation covariance and mean
             are stored.
         
+        block_size : int, optional
+            The number of sites gathered and merged at once. Default is 1024.
+        
         Returns
         -------
         S, m : ndarray
@@ -1014,34 +1949,45 @@ class Master(object):
         if self.iter == 0:
             raise RuntimeError("Can not mix samples before at least one "
                                "iteration has been done.")
-        if not out_S:
+        if out_S is None:
             out_S = np.empty((self.dphi,self.dphi), order='F')
-        if not out_m:
+        if out_m is None:
             out_m = np.empty(self.dphi)
-        temp_M = np.empty((self.dphi,self.dphi), order='F')
-        temp_v = np.empty(self.dphi)
-        
-        # Combine mt from every site
-        np.copyto(out_m, self.workers[0].vec)
-        for k in xrange(1,self.K):
-            out_m += self.workers[k].vec
-        out_m /= self.K
-        
-        # Combine St from every site
-        np.subtract(self.workers[0].vec, out_m, out = temp_v)
-        np.multiply(temp_v[:,np.newaxis], temp_v, out=out_S)
-        out_S *= self.workers[0].nsamp
-        for k in xrange(1,self.K):
-            np.subtract(self.workers[k].vec, out_m, out = temp_v)
-            np.multiply(temp_v[:,np.newaxis], temp_v, out=temp_M)
-            temp_M *= self.workers[k].nsamp
-            out_S += temp_M
-        nsamp_tot = 0
-        for k in xrange(self.K):
-            out_S += self.workers[k].Mat
-            nsamp_tot += self.workers[k].nsamp
-        out_S /= nsamp_tot - 1
-        
+        block_size = min(block_size, self.K)
+        n_blocks = (self.K - 1) // block_size + 1
+        
+        # Buffers for one block of sites
+        n_b = np.empty(block_size)
+        m_b = np.empty((block_size, self.dphi))
+        M2_b = np.empty((block_size, self.dphi, self.dphi))
+        temp = np.empty((max(block_size, n_blocks)//2, self.dphi, self.dphi))
+        # Results of the blocks
+        n_p = np.empty(n_blocks)
+        m_p = np.empty((n_blocks, self.dphi))
+        M2_p = np.empty((n_blocks, self.dphi, self.dphi))
+        
+        n_valid = 0
+        for b in xrange(n_blocks):
+            start = b*block_size
+            end = min(start + block_size, self.K)
+            moments = self.site_moments(start, end, out=(n_b, m_b, M2_b))
+            valid = np.nonzero(moments[0] > 0)[0]
+            if len(valid) == 0:
+                continue
+            if len(valid) < end - start:
+                # Exclude the sites without tilted moments
+                moments = [x[valid] for x in moments]
+            n_p[n_valid], m_p[n_valid], M2_p[n_valid] = merge_moments(
+                *moments, temp=temp)
+            n_valid += 1
+        if n_valid == 0:
+            raise RuntimeError("No site has valid tilted distribution "
+                               "moments.")
+        nsamp_tot, m, M2 = merge_moments(n_p[:n_valid], m_p[:n_valid],
+                                         M2_p[:n_valid], temp=temp)
+        
+        np.copyto(out_m, m)
+        np.divide(M2, nsamp_tot - 1, out=out_S)
         return out_S, out_m
     
     
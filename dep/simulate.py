@@ -0,0 +1,291 @@
+"""Simulated data sets for the experiments.
+
+The functions simulate_m1, simulate_m2 and simulate_m3 simulate the
+hierarchical logistic regression models of the experiments in the folder
+experiment and the function simulate_stars the model of the simulated stars
+data in the folder stars_sim (see the respective scripts for the models).
+
+The data is generated in chunks of `chunk_size` observations without Python
+loops over the observations or the groups. If `out_dir` is given, the arrays X,
+y and j_ind are created as memory-mapped .npy files X.npy, y.npy and j_ind.npy
+in the directory, so that data sets much larger than the memory can be
+generated (and read later with np.load(filename, mmap_mode='r')). The generated
+data does not depend on `chunk_size` or `out_dir`.
+
+The most recent version of the code can be found on GitHub:
+https://github.com/gelman/ep-stan
+
+"""
+
+# Licensed under the 3-clause BSD license.
+# http://opensource.org/licenses/BSD-3-Clause
+#
+# Copyright (C) 2014 Tuomas Sivula
+# All rights reserved.
+
+from __future__ import division
+import os
+import numpy as np
+from scipy.special import ndtr, ndtri
+
+
+# Default number of observations generated at a time
+CHUNK_SIZE = 2**16
+
+
+def _rnd(seed):
+    if isinstance(seed, np.random.RandomState):
+        return seed
+    return np.random.RandomState(seed=seed)
+
+
+def _alloc(out_dir, name, shape, dtype):
+    """Allocate an array in memory or as a memory-mapped .npy file."""
+    if out_dir is None:
+        return np.empty(shape, dtype=dtype)
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    return np.lib.format.open_memmap(os.path.join(out_dir, name + '.npy'),
+                                     mode='w+', dtype=dtype, shape=shape)
+
+
+def _chunks(N, chunk_size):
+    for start in xrange(0, N, chunk_size):
+        yield start, min(start + chunk_size, N)
+
+
+def group_sizes(J, npg, rnd):
+    """Number of observations in each of the `J` groups.
+    
+    Parameter `npg` is either a constant or a pair [min, max], in which case
+    the sizes are drawn uniformly from the closed interval.
+    
+    """
+    if hasattr(npg, '__getitem__') and len(npg) == 2:
+        return rnd.randint(npg[0], npg[1]+1, size=J)
+    else:
+        return npg*np.ones(J, dtype=np.int64)
+
+
+def group_index(Nj, out=None, chunk_size=CHUNK_SIZE):
+    """Group index of each observation for the sorted groups of sizes `Nj`."""
+    j_lim = np.cumsum(Nj)
+    if out is None:
+        out = np.empty(j_lim[-1], dtype=np.int64)
+    for (start, end) in _chunks(len(out), chunk_size):
+        out[start:end] = np.searchsorted(
+            j_lim, np.arange(start, end), side='right')
+    return out
+
+
+def truncnorm_pos(mu, sigma, rnd, size=None):
+    """Draw from N(mu, sigma^2) truncated to the positive values.
+    
+    Uses the inverse of the cumulative distribution function of the upper
+    tail, which is accurate also far in the tail. Both `mu` and `sigma` may be
+    arrays, the shape of the output is their broadcast shape or `size`.
+    
+    """
+    a = np.divide(mu, sigma)
+    if size is None:
+        size = np.shape(a)
+    # N.B. 1 - rand is in (0,1]
+    w = 1 - rnd.rand(*size)
+    w *= ndtr(a)
+    return mu - sigma*ndtri(w)
+
+
+def _logistic_data(eta_fun, N, D, rnd, out_dir, chunk_size):
+    """Draw X and then y ~ bernoulli_logit(eta_fun(start, end, X_chunk))."""
+    X = _alloc(out_dir, 'X', (N,D), np.float64)
+    for (start, end) in _chunks(N, chunk_size):
+        X[start:end] = rnd.randn(end-start, D)
+    y = _alloc(out_dir, 'y', (N,), np.int64)
+    for (start, end) in _chunks(N, chunk_size):
+        eta = eta_fun(start, end, X[start:end])
+        np.negative(eta, out=eta)
+        np.exp(eta, out=eta)
+        eta += 1
+        np.divide(1, eta, out=eta)
+        y[start:end] = rnd.rand(end-start) < eta
+    return X, y
+
+
+def simulate_m1(J, D, npg, seed=None, sigma_a=2, sigma_aH=None, beta=None,
+                sigma_b=1, chunk_size=CHUNK_SIZE, out_dir=None):
+    """Simulate data from the model m1.
+    
+    Model m1:
+        y_j ~ bernoulli_logit(alpha_j + beta * x_j)
+        alpha_j ~ N(0,sigma_a)
+        beta ~ N(0,sigma_b)
+        phi = [log(sigma_a), beta]
+    
+    Parameters
+    ----------
+    J, D : int
+        The number of groups and the number of inputs.
+    
+    npg : int or pair of int
+        The number of observations per group, a constant or [min, max].
+    
+    seed : {None, int, RandomState}, optional
+        The random seed.
+    
+    sigma_a, sigma_aH : {None, float}, optional
+        The value of sigma_a. If None, it is drawn from log-N(0,sigma_aH).
+    
+    beta : {None, ndarray}, optional
+        The value of beta. If None (default), it is drawn from N(0,sigma_b),
+        where sigma_b is given by the argument `sigma_b`.
+    
+    chunk_size : int, optional
+        The number of observations generated at a time.
+    
+    out_dir : {None, str}, optional
+        The directory for memory-mapped output arrays, None (default) creates
+        the arrays in memory.
+    
+    Returns
+    -------
+    X, y, j_ind : ndarray
+        The inputs of shape (N,D), the outputs and the group index of each
+        observation.
+    
+    Nj : ndarray
+        The number of observations in each group.
+    
+    phi_true : ndarray
+        The true value of the shared parameters.
+    
+    """
+    rnd = _rnd(seed)
+    Nj = group_sizes(J, npg, rnd)
+    N = np.sum(Nj)
+    j_ind = group_index(Nj, out=_alloc(out_dir, 'j_ind', (N,), np.int64),
+                        chunk_size=chunk_size)
+    if sigma_a is None:
+        sigma_a = np.exp(rnd.randn()*sigma_aH)
+    if beta is None:
+        beta = rnd.randn(D)*sigma_b
+    alpha_j = rnd.randn(J)*sigma_a
+    phi_true = np.append(np.log(sigma_a), beta)
+    X, y = _logistic_data(
+        lambda start, end, X_c: alpha_j[j_ind[start:end]] + X_c.dot(beta),
+        N, D, rnd, out_dir, chunk_size
+    )
+    return X, y, j_ind, Nj, phi_true
+
+
+def _varying_slopes(alpha_j, beta_j, j_ind):
+    """Linear predictor alpha_j + beta_j * x_j of a chunk."""
+    def eta_fun(start, end, X_c):
+        j_c = j_ind[start:end]
+        eta = np.einsum('nd,nd->n', X_c, beta_j[j_c])
+        eta += alpha_j[j_c]
+        return eta
+    return eta_fun
+
+
+def simulate_m2(J, D, npg, seed=None, sigma_a=2, sigma_aH=None, sigma_bH=1,
+                chunk_size=CHUNK_SIZE, out_dir=None):
+    """Simulate data from the model m2.
+    
+    Model m2:
+        y_j ~ bernoulli_logit(alpha_j + beta_j * x_j)
+        alpha_j ~ N(0,sigma_a)
+        beta_j ~ N(0,sigma_b)
+        sigma_b ~ log-N(0,sigma_bH)
+        phi = [log(sigma_a), log(sigma_b)]
+    
+    See simulate_m1 for the parameters and the return values.
+    
+    """
+    rnd = _rnd(seed)
+    Nj = group_sizes(J, npg, rnd)
+    N = np.sum(Nj)
+    j_ind = group_index(Nj, out=_alloc(out_dir, 'j_ind', (N,), np.int64),
+                        chunk_size=chunk_size)
+    if sigma_a is None:
+        sigma_a = np.exp(rnd.randn()*sigma_aH)
+    sigma_b = np.exp(rnd.randn(D)*sigma_bH)
+    alpha_j = rnd.randn(J)*sigma_a
+    beta_j = rnd.randn(J,D)*sigma_b
+    phi_true = np.append(np.log(sigma_a), np.log(sigma_b))
+    X, y = _logistic_data(_varying_slopes(alpha_j, beta_j, j_ind),
+                          N, D, rnd, out_dir, chunk_size)
+    return X, y, j_ind, Nj, phi_true
+
+
+def simulate_m3(J, D, npg, seed=None, mu_a=0.1, sigma_ma=None, sigma_a=1,
+                sigma_sa=None, sigma_mb=0, sigma_sb=1, chunk_size=CHUNK_SIZE,
+                out_dir=None):
+    """Simulate data from the model m3.
+    
+    Model m3:
+        y_j ~ bernoulli_logit(alpha_j + beta_j * x_j)
+        alpha_j ~ N(mu_a,sigma_a)
+        beta_j ~ N(mu_b,sigma_b)
+        mu_b ~ N(0,sigma_mb)
+        sigma_b ~ log-N(0,sigma_sb)
+        phi = [mu_a, log(sigma_a), mu_b, log(sigma_b)]
+    
+    If `mu_a` or `sigma_a` is None, it is drawn from N(0,sigma_ma) or
+    log-N(0,sigma_sa) respectively. See simulate_m1 for the other parameters
+    and the return values.
+    
+    """
+    rnd = _rnd(seed)
+    Nj = group_sizes(J, npg, rnd)
+    N = np.sum(Nj)
+    j_ind = group_index(Nj, out=_alloc(out_dir, 'j_ind', (N,), np.int64),
+                        chunk_size=chunk_size)
+    if sigma_a is None:
+        sigma_a = np.exp(rnd.randn()*sigma_sa)
+    if mu_a is None:
+        mu_a = rnd.randn()*sigma_ma
+    sigma_b = np.exp(rnd.randn(D)*sigma_sb)
+    mu_b = rnd.randn(D)*sigma_mb
+    alpha_j = mu_a + rnd.randn(J)*sigma_a
+    beta_j = mu_b + rnd.randn(J,D)*sigma_b
+    phi_true = np.empty(2*D+2)
+    phi_true[0] = mu_a
+    phi_true[1] = np.log(sigma_a)
+    phi_true[2:2+D] = mu_b
+    phi_true[2+D:] = np.log(sigma_b)
+    X, y = _logistic_data(_varying_slopes(alpha_j, beta_j, j_ind),
+                          N, D, rnd, out_dir, chunk_size)
+    return X, y, j_ind, Nj, phi_true
+
+
+def simulate_stars(J, npg, seed=None, mu=270, tau=148, beta=250, sigma=490,
+                   x_mu=200, x_std=100, chunk_size=CHUNK_SIZE, out_dir=None):
+    """Simulate the stars data.
+    
+    Model:
+        y_j ~ N(alpha_j + beta * x_j, sigma) truncated to positive values
+        alpha_j ~ N(mu, tau)
+        x_j ~ N(x_mu, x_std) truncated to positive values
+        phi = log([mu, tau, beta, sigma])
+    
+    The truncated normal distributions are sampled with the inverse
+    cumulative distribution function (see truncnorm_pos). X is one
+    dimensional. See simulate_m1 for the other parameters and the return
+    values.
+    
+    """
+    rnd = _rnd(seed)
+    Nj = group_sizes(J, npg, rnd)
+    N = np.sum(Nj)
+    j_ind = group_index(Nj, out=_alloc(out_dir, 'j_ind', (N,), np.int64),
+                        chunk_size=chunk_size)
+    alpha_j = mu + rnd.randn(J)*tau
+    phi_true = np.log([mu, tau, beta, sigma])
+    X = _alloc(out_dir, 'X', (N,), np.float64)
+    for (start, end) in _chunks(N, chunk_size):
+        X[start:end] = truncnorm_pos(x_mu, x_std, rnd, size=(end-start,))
+    y = _alloc(out_dir, 'y', (N,), np.float64)
+    for (start, end) in _chunks(N, chunk_size):
+        f = alpha_j[j_ind[start:end]] + X[start:end]*beta
+        y[start:end] = truncnorm_pos(f, sigma, rnd)
+    return X, y, j_ind, Nj, phi_true
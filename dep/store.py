@@ -0,0 +1,279 @@
+"""Append-only on-disk store of the results of the EP iterations.
+
+The class ResultsStore is a hook for Master.run (see module hooks) appending
+the results of every iteration into a directory: the moments of the global
+approximation, optionally the full covariance matrices and the moments of the
+tilted distributions, the accepted damping factors and the timings. Each array
+is stored in its own raw binary file, one row per iteration, and the file
+meta.json describes the arrays and the number of complete rows. The rows are
+written before meta.json is (atomically) updated, so that a crash does not
+corrupt the previous iterations.
+
+The function load_results maps the arrays lazily into memory and can be
+called also while the run is in progress.
+
+Example:
+    >>> store = ResultsStore('results/run1', cov=True)
+    >>> master.run(10, hooks=store)
+    >>> res = load_results('results/run1')
+    >>> res['m'].shape
+    (10, dphi)
+
+The most recent version of the code can be found on GitHub:
+https://github.com/gelman/ep-stan
+
+"""
+
+# Licensed under the 3-clause BSD license.
+# http://opensource.org/licenses/BSD-3-Clause
+#
+# Copyright (C) 2014 Tuomas Sivula
+# All rights reserved.
+
+from __future__ import division
+import os
+import json
+import numpy as np
+
+from hooks import Hook, clock, elapsed
+
+
+META_FILE = 'meta.json'
+
+# The timed phases of Master.run (see Hook.phase)
+PHASES = ('global_cholesky', 'cavity', 'moment_inversion', 'tilted')
+
+# The number of sites whose moments are gathered at a time
+SITE_BLOCK_SIZE = 1024
+
+
+def _read_meta(path):
+    with open(os.path.join(path, META_FILE), 'r') as f:
+        return json.load(f)
+
+
+def load_results(path, names=None):
+    """Load the arrays of a results store as read-only memory maps.
+    
+    Only the complete iterations are included, so that the store can be read
+    while the run is in progress.
+    
+    Parameters
+    ----------
+    path : str
+        The directory of the store.
+    
+    names : {None, list of str}, optional
+        The names of the arrays to load. None (default) loads all of them.
+    
+    Returns
+    -------
+    res : dict
+        The arrays of shape (n, ...), where n is the number of stored
+        iterations, by their names. The arrays with no rows are ordinary empty
+        ndarrays.
+    
+    """
+    meta = _read_meta(path)
+    n = meta['n']
+    if names is None:
+        names = meta['arrays'].keys()
+    res = {}
+    for name in names:
+        spec = meta['arrays'][name]
+        shape = (n,) + tuple(spec['shape'])
+        if n == 0:
+            res[name] = np.empty(shape, dtype=spec['dtype'])
+        else:
+            res[name] = np.memmap(os.path.join(path, name + '.bin'),
+                                  dtype=spec['dtype'], mode='r', shape=shape)
+    return res
+
+
+class ResultsStore(Hook):
+    """Hook appending the results of every iteration into a directory.
+    
+    The stored arrays, one row per iteration, are:
+        iter       : the iteration number
+        m, var     : the mean and the variances of the global approximation
+                     (NaN if the moments are not calculated)
+        S          : the covariance matrix of the global approximation
+                     (if `cov` is True)
+        df         : the accepted damping factor of each site
+        attempts   : the number of the tried damping factors
+        wall, cpu  : the wall and CPU time of the iteration
+        phase_wall : the total wall time of each phase (see PHASES)
+        site_m     : the mean of each tilted distribution (if `sites` is True)
+        site_var   : the variances of each tilted distribution (if `sites` is
+                     True)
+        site_nsamp : the contributing sample size of each site (if `sites` is
+                     True)
+    The sites without valid tilted distribution moments, e.g. the skipped ones
+    whose sampling failed, have zero site_nsamp and NaN site_m and site_var
+    (see Master.site_moments).
+    
+    If the directory already contains a store, the new iterations are appended
+    into it. The arrays then have to match with the existing ones.
+    
+    Parameters
+    ----------
+    path : str
+        The directory of the store, created if it does not exist.
+    
+    cov : bool, optional
+        If True, the full covariance matrices are stored. Default is False.
+    
+    sites : bool, optional
+        If True, the moments of the tilted distributions are stored. Default
+        is False.
+    
+    chunk_size : int, optional
+        The number of iterations buffered in memory before they are written.
+        All the buffered iterations are written also in the end of the run.
+        Default is 1.
+    
+    """
+    
+    def __init__(self, path, cov=False, sites=False, chunk_size=1):
+        self.path = path
+        self.cov = cov
+        self.sites = sites
+        if chunk_size < 1:
+            raise ValueError("Arg. `chunk_size` has to be positive")
+        self.chunk_size = chunk_size
+        self.meta = None
+        self.buffer = []
+    
+    def _array_specs(self, K, dphi):
+        specs = [
+            ('iter', 'int64', ()),
+            ('m', 'float64', (dphi,)),
+            ('var', 'float64', (dphi,)),
+            ('df', 'float64', (K,)),
+            ('attempts', 'int64', ()),
+            ('wall', 'float64', ()),
+            ('cpu', 'float64', ()),
+            ('phase_wall', 'float64', (len(PHASES),))
+        ]
+        if self.cov:
+            specs.append(('S', 'float64', (dphi,dphi)))
+        if self.sites:
+            specs.extend([
+                ('site_m', 'float64', (K,dphi)),
+                ('site_var', 'float64', (K,dphi)),
+                ('site_nsamp', 'float64', (K,))
+            ])
+        return dict((name, {'dtype': dtype, 'shape': list(shape)})
+                    for (name, dtype, shape) in specs)
+    
+    def _write_meta(self):
+        # Write into a temporary file and rename (atomic in POSIX)
+        fname = os.path.join(self.path, META_FILE)
+        with open(fname + '.tmp', 'w') as f:
+            json.dump(self.meta, f, indent=1, sort_keys=True)
+        os.rename(fname + '.tmp', fname)
+    
+    def run_start(self, master, niter):
+        self.master = master
+        arrays = self._array_specs(master.K, master.dphi)
+        if self.sites:
+            # Buffers for gathering the moments of a block of sites
+            B = min(SITE_BLOCK_SIZE, master.K)
+            self.site_buf = (np.empty(B), np.empty((B,master.dphi)),
+                             np.empty((B,master.dphi,master.dphi)))
+        if self.meta is None:
+            if os.path.exists(os.path.join(self.path, META_FILE)):
+                # Continue an existing store
+                self.meta = _read_meta(self.path)
+                if self.meta['arrays'] != arrays:
+                    raise ValueError("The arrays in the existing store {} do "
+                                     "not match".format(self.path))
+                # Remove possible incomplete rows after a crash
+                for (name, spec) in arrays.iteritems():
+                    row = (np.dtype(spec['dtype']).itemsize
+                           * int(np.prod(spec['shape'])))
+                    with open(os.path.join(self.path, name + '.bin'),
+                              'r+b') as f:
+                        f.truncate(self.meta['n']*row)
+            else:
+                if not os.path.exists(self.path):
+                    os.makedirs(self.path)
+                self.meta = {'n': 0, 'K': master.K, 'dphi': master.dphi,
+                             'phases': list(PHASES), 'arrays': arrays}
+                for name in arrays:
+                    open(os.path.join(self.path, name + '.bin'), 'wb').close()
+                self._write_meta()
+        elif self.meta['arrays'] != arrays:
+            raise ValueError("The store is used with an incompatible Master")
+    
+    def iteration_start(self, iteration):
+        self.t0 = clock()
+        self.attempts = 1
+        self.phase_wall = np.zeros(len(PHASES))
+        self.record = {}
+    
+    def phase(self, iteration, name, wall, cpu, site=None, **info):
+        self.phase_wall[PHASES.index(name)] += wall
+    
+    def damping(self, iteration, cause, sites, dfs):
+        self.attempts += 1
+    
+    def moments(self, iteration, S, m):
+        self.record['m'] = m.copy()
+        self.record['var'] = np.diag(S).copy()
+        if self.cov:
+            self.record['S'] = np.array(S, order='C')
+    
+    def iteration_end(self, iteration, dfs):
+        wall, cpu = elapsed(self.t0)
+        rec = self.record
+        rec['iter'] = np.int64(iteration)
+        rec['df'] = dfs.copy()
+        rec['attempts'] = np.int64(self.attempts)
+        rec['wall'] = np.float64(wall)
+        rec['cpu'] = np.float64(cpu)
+        rec['phase_wall'] = self.phase_wall
+        dphi = self.master.dphi
+        if not rec.has_key('m'):
+            rec['m'] = np.full(dphi, np.nan)
+            rec['var'] = np.full(dphi, np.nan)
+            if self.cov:
+                rec['S'] = np.full((dphi,dphi), np.nan)
+        if self.sites:
+            # Gather the moments in blocks in order not to copy all the
+            # covariance matrices at once
+            K = self.master.K
+            site_nsamp = np.empty(K)
+            site_m = np.empty((K,dphi))
+            site_var = np.empty((K,dphi))
+            B = self.site_buf[0].shape[0]
+            for start in xrange(0, K, B):
+                end = min(start + B, K)
+                nsamp, mt, St = self.master.site_moments(start, end,
+                                                         out=self.site_buf)
+                site_nsamp[start:end] = nsamp
+                site_m[start:end] = mt
+                np.divide(np.diagonal(St, axis1=1, axis2=2),
+                          (nsamp - 1)[:,np.newaxis], out=site_var[start:end])
+            rec['site_m'] = site_m
+            rec['site_var'] = site_var
+            rec['site_nsamp'] = site_nsamp
+        self.buffer.append(rec)
+        if len(self.buffer) >= self.chunk_size:
+            self.flush()
+    
+    def run_end(self, status):
+        self.flush()
+    
+    def flush(self):
+        """Write the buffered iterations into the store."""
+        if not self.buffer:
+            return
+        for (name, spec) in self.meta['arrays'].iteritems():
+            with open(os.path.join(self.path, name + '.bin'), 'ab') as f:
+                for rec in self.buffer:
+                    f.write(np.ascontiguousarray(
+                        rec[name], dtype=spec['dtype']).tobytes())
+        self.meta['n'] += len(self.buffer)
+        self._write_meta()
+        self.buffer = []
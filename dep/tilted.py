@@ -0,0 +1,653 @@
+"""Estimators for the tilted distribution moments of a site.
+
+The method Worker.tilted delegates the estimation of the tilted distribution
+moments into an estimator object. All the estimators share the same interface,
+the method estimate, so that the sites can use different engines:
+    StanSampler        : MCMC sampling with the Stan site model (default)
+    ImportanceSampler  : importance sampling from the cavity distribution using
+                         a vectorised NumPy log-likelihood of the site
+    LaplaceApprox      : Gaussian approximation at the mode found with the Stan
+                         optimizer
+    SwitchingEstimator : uses a fast estimator, e.g. LaplaceApprox, until the
+                         global approximation stabilises and a more accurate
+                         one, e.g. StanSampler, after that
+    RecyclingSampler   : reuses the previous samples of the site by importance
+                         reweighting them with the change of the cavity
+                         distribution while the weights are reliable
+
+The estimators do not store any site specific state, so one instance can be
+shared by all the sites. An estimator raises SamplingError if it fails to
+produce an estimate, in which case the site is skipped for the iteration (see
+Worker.tilted).
+
+The most recent version of the code can be found on GitHub:
+https://github.com/gelman/ep-stan
+
+"""
+
+# Licensed under the 3-clause BSD license.
+# http://opensource.org/licenses/BSD-3-Clause
+#
+# Copyright (C) 2014 Tuomas Sivula
+# All rights reserved.
+
+from __future__ import division
+import numpy as np
+from scipy import linalg
+
+from util import (
+    get_last_sample, invert_normal_params, merge_moments, derive_seed
+)
+
+
+def _get_rnd(worker):
+    """Get a RandomState for the worker based on its current seed."""
+    return np.random.RandomState(worker.stan_params['seed'])
+
+
+def sample_moments(samp, St, mt):
+    """Sample mean and unnormalised covariance of samples `samp` of shape (n,d).
+    
+    N.B. The samples are centered in place.
+    
+    """
+    np.mean(samp, axis=0, out=mt)
+    samp -= mt
+    np.dot(samp.T, samp, out=St.T)
+    return samp.shape[0]
+
+
+def chain_moments(samp, out=None):
+    """Sufficient statistics of each chain of samples `samp`.
+    
+    Parameters
+    ----------
+    samp : ndarray
+        Array of shape (n,C,d) of the n samples of each of the C chains.
+    
+    out : tuple of ndarray, optional
+        Output arrays for the return values.
+    
+    Returns
+    -------
+    n, m, M2 : ndarray
+        The number of samples (C,), the means (C,d) and the sums of the squared
+        deviations from the mean (C,d,d) of the chains (see
+        util.merge_moments).
+    
+    """
+    if out is None:
+        C, d = samp.shape[1:]
+        out = (np.empty(C), np.empty((C,d)), np.empty((C,d,d)))
+    n, m, M2 = out
+    n.fill(samp.shape[0])
+    np.mean(samp, axis=0, out=m)
+    dev = samp - m
+    np.einsum('nci,ncj->cij', dev, dev, out=M2)
+    return n, m, M2
+
+
+def merge_chains(n, m, M2, St, mt):
+    """Merge the statistics of the chains into `St` and `mt`.
+    
+    The statistics `n`, `m` and `M2` (see chain_moments) are merged exactly
+    (see util.merge_moments) and the arrays `m` and `M2` are overwritten. The
+    total number of samples is returned.
+    
+    """
+    ntot, m_tot, M2_tot = merge_moments(n, m, M2)
+    np.copyto(mt, m_tot)
+    np.copyto(St, M2_tot)
+    return ntot
+
+
+def weighted_moments(samp, w, St, mt):
+    """Weighted mean and unnormalised covariance of samples `samp`.
+    
+    The weights `w` of shape (n,) have to sum to one. The covariance is scaled
+    to correspond to the unnormalised covariance of the effective sample size
+    of the weights, which is returned. N.B. The samples are centered in place.
+    
+    """
+    ess = 1 / np.sum(w**2)
+    np.dot(w, samp, out=mt)
+    samp -= mt
+    np.dot(samp.T, samp*w[:,np.newaxis], out=St.T)
+    St *= ess - 1
+    return ess
+
+
+def pareto_khat(lw):
+    """Pareto shape parameter estimate of the tail of importance weights.
+    
+    The generalised Pareto distribution is fitted into the largest weights
+    with the method by Zhang and Stephens (2009) as in Pareto smoothed
+    importance sampling (Vehtari, Gelman and Gabry, 2015). Values of k < 0.5
+    indicate that the importance sampling estimate is reliable and values of
+    k > 0.7 that it is not.
+    
+    Parameters
+    ----------
+    lw : ndarray
+        Log weights of shape (n,), normalisation not required.
+    
+    Returns
+    -------
+    k : float
+        The estimated shape parameter. Inf if it can not be estimated.
+    
+    """
+    n = lw.shape[0]
+    # Number of samples in the tail
+    tail_len = int(np.ceil(min(0.2*n, 3*np.sqrt(n))))
+    if tail_len < 5:
+        return np.inf
+    lw_sorted = np.sort(lw)
+    cutoff = lw_sorted[-tail_len-1]
+    x = np.exp(lw_sorted[-tail_len:] - lw_sorted[-1])
+    x -= np.exp(cutoff - lw_sorted[-1])
+    if x[-1] <= 0:
+        # All the weights in the tail are equal
+        return -np.inf
+    # Profile likelihood estimate of the scale parameter
+    prior = 3
+    m = 30 + int(np.sqrt(tail_len))
+    b = np.arange(1, m+1, dtype=np.float64)
+    b -= 0.5
+    np.divide(m, b, out=b)
+    np.sqrt(b, out=b)
+    np.subtract(1, b, out=b)
+    b /= prior * x[int(tail_len/4 + 0.5) - 1]
+    b += 1 / x[-1]
+    k = np.log1p(-b[:,np.newaxis] * x).mean(axis=1)
+    L = tail_len * (np.log(-b / k) - k - 1)
+    w = 1 / np.exp(L - L[:,np.newaxis]).sum(axis=1)
+    b = np.dot(b, w) / np.sum(w)
+    k = np.mean(np.log1p(-b * x))
+    # Weakly informative prior for k
+    return (tail_len * k + 10 * 0.5) / (tail_len + 10)
+
+
+class SamplingError(RuntimeError):
+    """Raised when the tilted distribution of a site could not be estimated."""
+    pass
+
+
+def _reseed(seed, attempt):
+    """Seed for the retry number `attempt` of a failed sampling."""
+    return derive_seed(seed, attempt)
+
+
+class TiltedEstimator(object):
+    """Base class for the tilted distribution estimators."""
+    
+    def estimate(self, worker):
+        """Estimate the tilted distribution moments of the given worker.
+        
+        When this method is called, the cavity distribution precision matrix
+        and mean are in `worker.Mat` and `worker.vec` (also available for the
+        site model in `worker.data`). The estimate of the unnormalised
+        covariance matrix and the mean of the tilted distribution are to be
+        placed into the same arrays.
+        
+        Parameters
+        ----------
+        worker : Worker
+            The worker of the site.
+        
+        Returns
+        -------
+        nsamp : int or float
+            Number of (effective) samples contributing into the unnormalised
+            covariance matrix.
+        
+        exact : bool
+            True if the moments are not sample estimates, in which case no
+            small sample corrections are applied into them and `nsamp` is used
+            only as a weight for the estimate.
+        
+        """
+        raise NotImplementedError
+
+
+class StanSampler(TiltedEstimator):
+    """Estimate the tilted distribution with MCMC using the Stan site model.
+    
+    The sampling parameters are taken from `worker.stan_params` and the last
+    sample of each chain is stored as the initial point for the next iteration
+    if `worker.init_prev` is True. If the sampling raises an error, it is
+    retried at most `worker.max_retries` times with a new seed and a random
+    initialisation before SamplingError is raised.
+    
+    The moments are computed for each chain separately (see chain_moments) and
+    merged exactly (see util.merge_moments), so that the chains do not need to
+    be sampled together. Except with the control variate precision estimate,
+    which needs all the samples.
+    
+    Parameters
+    ----------
+    split_chains : bool, optional
+        If True, each chain is sampled with a separate call of the method
+        sample, so that the chains of a site can be scheduled independently,
+        e.g. in different processes. Default is False.
+    
+    """
+    
+    def __init__(self, split_chains=False):
+        self.split_chains = split_chains
+    
+    def estimate(self, worker):
+        if worker.prec_estim == 'cv':
+            samp = self.draw(worker)
+            # Sample mean and covariance
+            return sample_moments(samp, worker.Mat, worker.vec), False
+        if self.split_chains:
+            nchains = worker.stan_params['chains']
+            n = np.empty(nchains)
+            m = np.empty((nchains, worker.dphi))
+            M2 = np.empty((nchains, worker.dphi, worker.dphi))
+            last = []
+            for c in xrange(nchains):
+                fit = self.sample(worker, chain=c)
+                samp = fit.extract(permuted=False)[:,:,:worker.dphi]
+                chain_moments(samp, out=(n[c:c+1], m[c:c+1], M2[c:c+1]))
+                if worker.init_prev:
+                    last.append(get_last_sample(fit)[0])
+            if worker.init_prev:
+                worker.stan_params['init'] = last
+        else:
+            fit = self.sample(worker)
+            samp = fit.extract(permuted=False)[:,:,:worker.dphi]
+            n, m, M2 = chain_moments(samp)
+        return merge_chains(n, m, M2, worker.Mat, worker.vec), False
+    
+    def sample(self, worker, chain=None, store_init=True):
+        """Sample from the tilted distribution, returns the fit object.
+        
+        If `chain` is given, only the chain with that index is sampled. If
+        `store_init` is True and `worker.init_prev` is True, the last samples
+        are stored as the initial points of the next iteration. The last
+        sample of a single chain is not stored, but left for the caller.
+        
+        """
+        # The chains are identified explicitly with 1-based chain ids, so that
+        # a chain has the same random stream when sampled alone or together
+        # with the others regardless of the default of StanModel.sampling
+        params = worker.stan_params
+        if chain is not None:
+            params = dict(params, chains=1, chain_id=[chain+1], n_jobs=1)
+            if not isinstance(params['init'], basestring):
+                params['init'] = [params['init'][chain]]
+        else:
+            params = dict(params, chain_id=range(1, params['chains']+1))
+        
+        # Sample from the model, retry with a new seed and a random
+        # initialisation if the sampling fails
+        stan_params = params
+        for attempt in xrange(worker.max_retries + 1):
+            try:
+                with worker.capture_output():
+                    fit = worker.stan_model.sampling(
+                            data=worker.data,
+                            pars=('phi'),
+                            **stan_params
+                    )
+            except (ValueError, RuntimeError) as e:
+                worker.write_failure(attempt, stan_params, e)
+                stan_params = dict(
+                    params,
+                    seed=_reseed(params['seed'], attempt + 1),
+                    init='random'
+                )
+            else:
+                break
+        else:
+            raise SamplingError("Sampling failed in site {} after {} attempts"
+                                .format(worker.index, attempt + 1))
+        
+        if worker.init_prev and store_init and chain is None:
+            # Store the last sample of each chain
+            if isinstance(worker.stan_params['init'], basestring):
+                # No samples stored before ... initialise list of dicts
+                worker.stan_params['init'] = get_last_sample(fit)
+            else:
+                get_last_sample(fit, out=worker.stan_params['init'])
+        return fit
+    
+    def draw(self, worker):
+        """Sample from the tilted distribution, returns array of shape (n,d).
+        
+        If the worker uses the control variate precision estimate, a copy of
+        the samples and their log densities lp__ are stored into
+        `worker.cv_samples`.
+        
+        """
+        fit = self.sample(worker)
+        # TODO: Make a non-copying extract
+        if worker.prec_estim == 'cv':
+            ext = fit.extract(pars=('phi', 'lp__'))
+            worker.cv_samples = (ext['phi'].copy(), ext['lp__'])
+            return ext['phi']
+        return fit.extract(pars='phi')['phi']
+
+
+class ImportanceSampler(TiltedEstimator):
+    """Estimate the tilted distribution with importance sampling.
+    
+    The samples are drawn from the cavity distribution and weighted with the
+    site likelihood. This is cheap compared to MCMC but accurate only if the
+    site likelihood is weak compared to the cavity distribution, e.g. when
+    the site contains little data. The number of samples contributing into the
+    estimate is the effective sample size of the weights.
+    
+    Parameters
+    ----------
+    log_lik : function
+        Vectorised log-likelihood of the site called as log_lik(phi, data),
+        where `phi` is an array of shape (n,dphi) and `data` is the data dict
+        of the worker (see `Worker.data`). Returns an array of shape (n,).
+    
+    nsamp : int, optional
+        Number of samples drawn. Default is 4000.
+    
+    min_ess : {None, float}, optional
+        Minimum effective sample size. If the effective sample size of the
+        weights is smaller than this, the estimator `fallback` is used instead.
+        Default is 200.
+    
+    fallback : {None, TiltedEstimator}, optional
+        The estimator used if the effective sample size is too small. If None,
+        the StanSampler is used. Default is None.
+    
+    """
+    
+    def __init__(self, log_lik, nsamp=4000, min_ess=200, fallback=None):
+        self.log_lik = log_lik
+        self.nsamp = nsamp
+        self.min_ess = min_ess
+        if fallback is None:
+            fallback = StanSampler()
+        self.fallback = fallback
+    
+    def estimate(self, worker):
+        
+        rnd = _get_rnd(worker)
+        
+        # Sample from the cavity distribution
+        # Upper Cholesky Q = U'U, x = m + inv(U) z has covariance inv(Q)
+        U = linalg.cholesky(worker.Mat)
+        samp = rnd.randn(self.nsamp, worker.dphi)
+        samp = linalg.solve_triangular(U, samp.T, overwrite_b=True).T
+        samp += worker.vec
+        
+        # Self-normalised importance weights
+        lw = self.log_lik(samp, worker.data)
+        lw -= np.max(lw)
+        w = np.exp(lw, out=lw)
+        w /= np.sum(w)
+        if self.min_ess and 1 / np.sum(w**2) < self.min_ess:
+            return self.fallback.estimate(worker)
+        
+        # Weighted mean and covariance
+        return weighted_moments(samp, w, worker.Mat, worker.vec), False
+
+
+def mcmc_nsamp(stan_params):
+    """Number of samples produced by the MCMC with the given parameters."""
+    warmup = stan_params['warmup']
+    if warmup is None:
+        warmup = stan_params['iter'] // 2
+    return stan_params['chains'] * (
+        (stan_params['iter'] - warmup - 1) // stan_params['thin'] + 1)
+
+
+class LaplaceApprox(TiltedEstimator):
+    """Estimate the tilted distribution with the Laplace approximation.
+    
+    The mode of the tilted distribution is found with the Stan optimizer
+    (StanModel.optimizing) and the covariance is obtained from the inverse of
+    the negative Hessian of the log density at the mode. The Hessian is
+    computed with respect to all the unconstrained parameters of the site model
+    with central differences of the gradient provided by the Stan fit object
+    (grad_log_prob), and the covariance of phi is the corresponding block of its
+    inverse. Thus `phi` is required to be the first parameter declared in the
+    site model. The approximation is much faster than MCMC but it ignores the
+    skewness of the tilted distribution, which makes it well suited for the
+    first iterations (see SwitchingEstimator). A failed optimisation is retried
+    similarly as a failed sampling in StanSampler.sample, after which
+    SamplingError is raised and the site is skipped.
+    
+    Parameters
+    ----------
+    nsamp : {None, int}, optional
+        The number of samples the approximation is considered equivalent to,
+        used as its weight in the smoothing and in Master.mix_samples. If None,
+        the number of MCMC samples given by the sampling parameters of the
+        worker is used. Default is None.
+    
+    eps : float, optional
+        The step size in the finite difference Hessian. Default is 1e-5.
+    
+    fallback : {None, TiltedEstimator}, optional
+        The estimator used if the negative Hessian is not positive definite.
+        If None, the StanSampler is used. Default is None.
+    
+    """
+    
+    def __init__(self, nsamp=None, eps=1e-5, fallback=None):
+        self.nsamp = nsamp
+        self.eps = eps
+        if fallback is None:
+            fallback = StanSampler()
+        self.fallback = fallback
+    
+    def estimate(self, worker):
+        
+        # Initialise from the previous samples if available
+        init = worker.stan_params['init']
+        if not isinstance(init, basestring):
+            init = init[0]
+        
+        # Find the mode, retry with a new seed and a random initialisation if
+        # the optimisation fails (similarly as in StanSampler.sample)
+        seed = worker.stan_params['seed']
+        for attempt in xrange(worker.max_retries + 1):
+            try:
+                with worker.capture_output():
+                    mode = worker.stan_model.optimizing(
+                        data=worker.data,
+                        seed=seed,
+                        init=init
+                    )
+                    # Fit object for the gradient evaluations
+                    fit = worker.stan_model.sampling(
+                        data=worker.data,
+                        chains=1,
+                        iter=1,
+                        algorithm='Fixed_param',
+                        init=[mode],
+                        seed=seed
+                    )
+            except (ValueError, RuntimeError) as e:
+                worker.write_failure(attempt, {'seed': seed, 'init': init}, e)
+                seed = _reseed(worker.stan_params['seed'], attempt + 1)
+                init = 'random'
+            else:
+                break
+        else:
+            raise SamplingError("Optimisation failed in site {} after {} "
+                                "attempts".format(worker.index, attempt + 1))
+        upar = np.asarray(fit.unconstrain_pars(mode), dtype=np.float64)
+        
+        # Negative Hessian with central differences of the gradient
+        p = upar.shape[0]
+        H = np.empty((p,p), order='F')
+        for i in xrange(p):
+            temp = upar[i]
+            upar[i] = temp + self.eps
+            g1 = np.asarray(fit.grad_log_prob(upar, adjust_transform=False))
+            upar[i] = temp - self.eps
+            g2 = np.asarray(fit.grad_log_prob(upar, adjust_transform=False))
+            upar[i] = temp
+            np.subtract(g2, g1, out=H[:,i])
+        H /= 2*self.eps
+        # Symmetrise
+        H += H.T
+        H /= 2
+        
+        # Covariance of phi, the first block of the inverse of H
+        try:
+            cho = linalg.cho_factor(H, overwrite_a=True)
+        except linalg.LinAlgError:
+            return self.fallback.estimate(worker)
+        E = np.zeros((p, worker.dphi), order='F')
+        E.flat[::p+1] = 1
+        St = worker.Mat
+        np.copyto(St, linalg.cho_solve(cho, E, overwrite_b=True)[:worker.dphi])
+        np.copyto(worker.vec, mode['phi'])
+        
+        # Scale to correspond to the unnormalised covariance
+        nsamp = self.nsamp
+        if nsamp is None:
+            nsamp = mcmc_nsamp(worker.stan_params)
+        St *= nsamp - 1
+        return nsamp, True
+
+
+class SwitchingEstimator(TiltedEstimator):
+    """Switch from a fast estimator into an accurate one.
+    
+    The estimator `fast` is used until the global approximation stabilises,
+    after which the estimator `accurate` is used. The global approximation is
+    considered stable when the change of its mean in each dimension between
+    two consecutive iterations is less than `tol` standard deviations and the
+    relative change of each variance is less than `tol`. Once switched, the
+    accurate estimator is used for the rest of the iterations.
+    
+    As the switch is decided based on the global approximation, one instance
+    should be shared by all the sites of one Master (and not between multiple
+    Master instances).
+    
+    Parameters
+    ----------
+    fast : {None, TiltedEstimator}, optional
+        The fast estimator. If None, LaplaceApprox is used. Default is None.
+    
+    accurate : {None, TiltedEstimator}, optional
+        The accurate estimator. If None, StanSampler is used. Default is None.
+    
+    tol : float, optional
+        The tolerance for the change of the global approximation. Default is
+        0.1.
+    
+    max_fast : {None, int}, optional
+        The maximum number of iterations the fast estimator is used. Default is
+        None, i.e. no limit.
+    
+    """
+    
+    def __init__(self, fast=None, accurate=None, tol=0.1, max_fast=None):
+        if fast is None:
+            fast = LaplaceApprox()
+        if accurate is None:
+            accurate = StanSampler()
+        self.fast = fast
+        self.accurate = accurate
+        self.tol = tol
+        self.max_fast = max_fast
+        self.switched = False
+        # Iteration (of the worker) of the latest check
+        self.checked = -1
+        self.prev_m = None
+        self.prev_v = None
+    
+    def _check(self, worker):
+        """Check if the global approximation has stabilised."""
+        self.checked = worker.iteration
+        if self.max_fast is not None and worker.iteration >= self.max_fast:
+            self.switched = True
+            return
+        # Moments of the global approximation
+        S, m = invert_normal_params(worker.Q, worker.r)
+        v = np.diag(S).copy()
+        if self.prev_m is not None:
+            dm = np.abs(m - self.prev_m) / np.sqrt(v)
+            dv = np.abs(v - self.prev_v) / v
+            if np.all(dm < self.tol) and np.all(dv < self.tol):
+                self.switched = True
+        self.prev_m = m
+        self.prev_v = v
+    
+    def estimate(self, worker):
+        if not self.switched and worker.iteration != self.checked:
+            # First site in this iteration
+            self._check(worker)
+        if self.switched:
+            return self.accurate.estimate(worker)
+        return self.fast.estimate(worker)
+
+
+def _log_cavity(samp, Q, m):
+    """Unnormalised log density of N(m, inv(Q)) at the samples."""
+    d = samp - m
+    out = np.einsum('ij,ij->i', d.dot(Q), d)
+    out *= -0.5
+    return out
+
+
+class RecyclingSampler(TiltedEstimator):
+    """Reuse the previous samples of the site by importance reweighting.
+    
+    The tilted distribution is the cavity distribution times the site
+    likelihood, so the samples drawn from a previous tilted distribution can be
+    reweighted into the current one with the ratio of the current and the
+    previous cavity densities. The samples drawn with `base` are stored into
+    the worker and reused in the next iterations as long as the weights are
+    reliable, i.e. their Pareto shape estimate (see pareto_khat) is at most
+    `max_khat` and their effective sample size at least `min_ess`. Otherwise
+    new samples are drawn. The weights are always computed with respect to the
+    cavity the samples were drawn with, so the accumulated change since the
+    last sampling is considered.
+    
+    Parameters
+    ----------
+    base : {None, StanSampler}, optional
+        The estimator used to draw the samples. It has to provide the method
+        draw(worker). If None, a StanSampler is used. Default is None.
+    
+    max_khat : float, optional
+        The maximum Pareto shape estimate of the weights. Default is 0.7.
+    
+    min_ess : float, optional
+        The minimum effective sample size of the weights. Default is 200.
+    
+    """
+    
+    def __init__(self, base=None, max_khat=0.7, min_ess=200):
+        if base is None:
+            base = StanSampler()
+        self.base = base
+        self.max_khat = max_khat
+        self.min_ess = min_ess
+    
+    def estimate(self, worker):
+        Q = worker.Mat
+        m = worker.vec
+        prev = worker.prev_samples
+        if prev is not None:
+            samp, Q_prev, m_prev = prev
+            # Log weights, the site likelihood cancels out
+            lw = _log_cavity(samp, Q, m)
+            lw -= _log_cavity(samp, Q_prev, m_prev)
+            if pareto_khat(lw) <= self.max_khat:
+                lw -= np.max(lw)
+                w = np.exp(lw, out=lw)
+                w /= np.sum(w)
+                if 1 / np.sum(w**2) >= self.min_ess:
+                    # Weighted mean and covariance (samp copied)
+                    ess = weighted_moments(samp.copy(), w, Q, m)
+                    return ess, False
+        # Draw new samples and store them with the current cavity
+        samp = self.base.draw(worker)
+        worker.prev_samples = (samp.copy(), Q.copy(order='F'), m.copy())
+        return sample_moments(samp, Q, m), False
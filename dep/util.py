@@ -14,16 +14,19 @@ https://github.com/gelman/ep-stan
 from __future__ import division
 import os
 import pickle
+import warnings
+import struct
+import hashlib
 import numpy as np
 from scipy import linalg
-from pystan import StanModel
 
 from cython_util import (
     copy_triu_to_tril,
     auto_outer,
     ravel_triu,
     unravel_triu,
-    fro_norm_squared
+    fro_norm_squared,
+    cho_inv_stack
 )
 
 # LAPACK positive definite inverse routine
@@ -110,6 +113,125 @@ def invert_normal_params(A, b=None, out_A=None, out_b=None, cho_form=False):
     return out_A, out_b
 
 
+def invert_normal_params_stack(A, b=None, out_A=None, out_b=None):
+    """Invert a stack of moment parameters into natural parameters or vice versa.
+    
+    Stacked version of invert_normal_params for K distributions at once, the
+    distributions corresponding to the last axis. All the matrices are
+    processed in one native call (see cython_util.cho_inv_stack).
+    
+    Parameters
+    ----------
+    A : ndarray
+        Array of shape (d,d,K) of symmetric positive-definite matrices to be
+        inverted.
+    
+    b : {None, ndarray}, optional
+        Array of shape (d,K) of the respective vectors, or None (default) if
+        `out_b` is not requested.
+    
+    out_A, out_b : {None, ndarray, 'in_place'}, optional
+        Spesifies where the output is calculate into; None (default) indicates
+        that a new array is created, providing a string 'in_place' overwrites
+        the corresponding input array. The arrays have to be F-contiguous and
+        of the same float type if provided.
+    
+    Returns
+    -------
+    out_A, out_b : ndarray
+        The corresponding output arrays (in F-order). If `b` was not provided,
+        `out_b` is None.
+    
+    posdef : ndarray
+        Boolean array of shape (K,) indicating which of the matrices are
+        positive definite. The output of the other ones is undefined.
+    
+    """
+    # Process parameters
+    if out_A == 'in_place':
+        out_A = A
+    elif out_A is None:
+        out_A = A.copy(order='F')
+    else:
+        np.copyto(out_A, A)
+    if not b is None:
+        if out_b == 'in_place':
+            out_b = b
+        elif out_b is None:
+            out_b = b.astype(out_A.dtype, order='F')
+        else:
+            np.copyto(out_b, b)
+    else:
+        out_b = None
+    info = np.empty(out_A.shape[2], dtype=np.intc)
+    cho_inv_stack(out_A, out_b, info)
+    return out_A, out_b, info == 0
+
+
+def merge_moments(n, m, M2, temp=None):
+    """Merge the moments of several sample sets with a pairwise tree.
+    
+    The sets are combined pairwise in a balanced tree with the update of Chan
+    et al. [1]_, each level being processed for all the pairs at once. The
+    error of the result grows only logarithmically with the number of sets.
+    
+    Parameters
+    ----------
+    n : ndarray
+        Array of shape (K,) of the number of samples in each set.
+    
+    m : ndarray
+        Array of shape (K,d) of the sample means of the sets.
+    
+    M2 : ndarray
+        Array of shape (K,d,d) of the sums of the squared deviations from the
+        mean of the sets, i.e. the sample covariance multiplied by n-1.
+    
+    temp : {None, ndarray}, optional
+        Temporary array of shape (>=K//2,d,d) used in the calculations.
+    
+    Returns
+    -------
+    n, m, M2 : float, ndarray
+        The number of samples, the mean and the sum of the squared deviations
+        of the merged set. The arrays `m` and `M2` are overwritten and the
+        results are views into their first element.
+    
+    References
+    ----------
+    .. [1] Chan, T.F., Golub, G.H. and LeVeque, R.J., Updating Formulae and a
+       Pairwise Algorithm for Computing Sample Variances, Technical Report
+       STAN-CS-79-773, Stanford University, 1979.
+    
+    """
+    n = np.asarray(n, dtype=np.float64).copy()
+    K = n.shape[0]
+    if temp is None and K > 1:
+        temp = np.empty((K//2,) + M2.shape[1:], dtype=M2.dtype)
+    while K > 1:
+        # Merge the second half of the sets into the first half
+        h = K // 2
+        nA = n[:h]
+        nB = n[h:2*h]
+        ntot = nA + nB
+        delta = m[h:2*h] - m[:h]
+        m[:h] += delta * (nB / ntot)[:,np.newaxis]
+        M2[:h] += M2[h:2*h]
+        np.multiply(delta[:,:,np.newaxis], delta[:,np.newaxis,:],
+                    out=temp[:h])
+        temp[:h] *= (nA * nB / ntot)[:,np.newaxis,np.newaxis]
+        M2[:h] += temp[:h]
+        n[:h] = ntot
+        if K % 2:
+            # Carry the odd set over to the next level
+            n[h] = n[K-1]
+            m[h] = m[K-1]
+            M2[h] = M2[K-1]
+            h += 1
+        K = h
+    return n[0], m[0], M2[0]
+
+
 def olse(S, n, P=None, out=None):
     """Optimal linear shrinkage estimator.
     
@@ -210,9 +332,9 @@ def _cv_estim(f, h, Eh, opt, cov_k=None, var_k=None, ddof_f=0, ddof_h=0,
         a = cov_fh / var_h
     # Regulate a
     if opt['regulate_a']:
-        a *= regulate_a
+        a *= opt['regulate_a']
     if opt['max_a']:
-        np.clip(a, -max_a, max_a, out=a)
+        np.clip(a, -opt['max_a'], opt['max_a'], out=a)
     # Calc f_hat
     if ddof_h == 0:
         hm = np.mean(hc, axis=0)
@@ -225,11 +347,125 @@ def _cv_estim(f, h, Eh, opt, cov_k=None, var_k=None, ddof_f=0, ddof_h=0,
     else:
         out -= np.multiply(hm, a, out=hm)
     return out, a
+
+
+def _cv_estim_cov_blocks(dev, dev_tilde, pr, S_tilde, opt, block_size,
+                         ridge=None, out=None):
+    """Estimate the covariance f_hat in column blocks.
+    
+    Blockwise version of the covariance part of function cv_moments. The
+    columns of f and h, i.e. the elements of the upper triangular of the
+    covariance matrix in the order of np.triu_indices, are formed at most
+    `block_size` at a time, so that the memory usage is O(n*block_size) in
+    addition to the solved system.
+    
+    With multiple control variates, a is never formed explicitly. Denoting the
+    centered controls by Hc and their mean by hm, the correction term is
+        hm' inv(Hc'Hc + ridge*I) Hc'Fc = v'Fc,  v = Hc inv(Hc'Hc + ridge*I) hm,
+    where the system of size d2 = d*(d+1)/2 is solved only if d2 <= n. If
+    d2 > n, the same v is obtained from the n x n Gram matrix Hc Hc' with the
+    push-through identity v = G inv(G + ridge*I) 1/n. The Gram matrix is
+    singular in this case, so that `ridge` is required; if it is not given,
+    each element is controlled only with its own control variate instead and
+    a RuntimeWarning is issued.
+    
+    """
+    n = dev.shape[0]
+    d = dev.shape[1]
+    rows, cols = np.triu_indices(d)
+    d2 = rows.shape[0]
+    if out is None:
+        out = np.empty(d2)
+    Eh = S_tilde[rows, cols]
+    # The scaling of a as in function cv_moments
+    k = n**2 / (n-1)**2
+    if opt['regulate_a']:
+        k *= opt['regulate_a']
+    blocks = [slice(j, min(j + block_size, d2))
+              for j in xrange(0, d2, block_size)]
+    
+    def f_block(b):
+        return np.multiply(dev[:,rows[b]], dev[:,cols[b]])
+    
+    def hc_block(b):
+        hc = np.multiply(dev_tilde[:,rows[b]], dev_tilde[:,cols[b]])
+        hc *= pr[:,np.newaxis]
+        hc -= Eh[b]
+        return hc
+    
+    multiple_cv = opt['multiple_cv']
+    if multiple_cv and d2 > n and not ridge:
+        warnings.warn("{} covariance control variates but only {} samples "
+                      "and no ridge regularisation given, using a single "
+                      "control variate per element".format(d2, n),
+                      RuntimeWarning)
+        multiple_cv = False
+    
+    if not multiple_cv:
+        # Each element has its own control variate
+        for b in blocks:
+            f = f_block(b)
+            np.sum(f, axis=0, out=out[b])
+            out[b] /= n - 1
+            f -= out[b]
+            hc = hc_block(b)
+            a = np.sum(f*hc, axis=0)
+            a /= np.sum(hc**2, axis=0)
+            a *= k
+            if opt['max_a']:
+                np.clip(a, -opt['max_a'], opt['max_a'], out=a)
+            a *= np.mean(hc, axis=0)
+            out[b] -= a
+        return out
     
+    if opt['max_a']:
+        raise ValueError("Arg. `max_a` can not be used with multiple control "
+                         "variates when `block_size` is given")
+    
+    if d2 <= n:
+        # Solve the d2 x d2 system
+        hm = np.empty(d2)
+        var_h = np.empty((d2,d2), order='F')
+        for i in xrange(len(blocks)):
+            bi = blocks[i]
+            hci = hc_block(bi)
+            np.mean(hci, axis=0, out=hm[bi])
+            var_h[bi,bi] = hci.T.dot(hci)
+            for bj in blocks[i+1:]:
+                var_h[bi,bj] = hci.T.dot(hc_block(bj))
+                var_h[bj,bi] = var_h[bi,bj].T
+        if ridge:
+            var_h.flat[::d2+1] += ridge * np.trace(var_h) / d2
+        u = linalg.solve(var_h, hm, overwrite_a=True, overwrite_b=True)
+        v = np.zeros(n)
+        for b in blocks:
+            v += hc_block(b).dot(u[b])
+    else:
+        # Solve the n x n system with the Gram matrix
+        G = np.zeros((n,n), order='F')
+        for b in blocks:
+            hc = hc_block(b)
+            G += hc.dot(hc.T)
+        v = np.empty(n)
+        v.fill(1/n)
+        temp = G.copy(order='F')
+        temp.flat[::n+1] += ridge * np.trace(G) / d2
+        v = G.dot(linalg.solve(temp, v, overwrite_a=True, overwrite_b=True))
+    
+    # Calc f_hat
+    for b in blocks:
+        f = f_block(b)
+        np.sum(f, axis=0, out=out[b])
+        out[b] /= n - 1
+        f -= out[b]
+        out[b] -= k * v.dot(f)
+    return out
+
 
 def cv_moments(samp, lp, Q_tilde, r_tilde, S_tilde=None, m_tilde=None,
                ldet_Q_tilde=None, multiple_cv=True, regulate_a=None, max_a=None,
-               m_treshold=0.9, S_hat=None, m_hat=None, ret_a=False):
+               m_treshold=0.9, S_hat=None, m_hat=None, ret_a=False,
+               block_size=None, ridge=None):
     """Approximate moments using control variate.
     
     N.B. This requires that the sample log probabilities are normalised!
@@ -278,6 +514,21 @@ def cv_moments(samp, lp, Q_tilde, r_tilde, S_tilde=None, m_tilde=None,
     ret_a : bool, optional
         Indicates whether a_S and a_m are returned. Default value is False.
     
+    block_size : {None, int}, optional
+        If given, the covariance control variates are processed in blocks of
+        this many elements of the covariance matrix, so that the memory usage
+        does not grow as O(n*d^2). The correlation term a_S is not formed
+        explicitly (None is returned for it) and with multiple control
+        variates `max_a` can not be used. By default, all the elements are
+        processed at once.
+    
+    ridge : {None, float}, optional
+        Ridge regularisation for the multiple control variate system of the
+        covariance, relative to the mean variance of the control variates.
+        Used only if `block_size` is given, in which case it is required for
+        multiple control variates if d*(d+1)/2 > n (see _cv_estim_cov_blocks).
+        Default is None, i.e. no regularisation.
+    
     Returns
     -------
     S_hat, m_hat : ndarray
@@ -359,6 +610,17 @@ def cv_moments(samp, lp, Q_tilde, r_tilde, S_tilde=None, m_tilde=None,
     # ----------------------------------
     #   Covariance
     # ----------------------------------
+    if block_size:
+        # Calc f_hat with the samples centered with m_hat
+        dev = samp - m_hat
+        d2vec = _cv_estim_cov_blocks(dev, dev_tilde, pr, S_tilde, opt,
+                                     block_size, ridge=ridge)
+        unravel_triu(d2vec, S_hat.T)
+        if ret_a:
+            return S_hat, m_hat, True, None, a_m
+        else:
+            return S_hat, m_hat, True
+    
     # Calc d+1 choose 2
     if d % 2 == 0:
         d2 = (d >> 1) * (d+1)
@@ -396,6 +658,37 @@ def cv_moments(samp, lp, Q_tilde, r_tilde, S_tilde=None, m_tilde=None,
         return S_hat, m_hat, True
 
 
+def root_seed(seed=None):
+    """Convert the argument `seed` into an integer root seed.
+    
+    An integer is returned as is, a RandomState is used to draw the root seed
+    and None draws it from the operating system entropy source.
+    
+    """
+    if seed is None:
+        seed = np.random.RandomState()
+    if isinstance(seed, np.random.RandomState):
+        seed = seed.randint(2**31-1)
+    return int(seed)
+
+
+def derive_seed(root, *key):
+    """Derive a seed for the stream identified by the integers in `key`.
+    
+    The seed is obtained from the SHA-256 hash of the root seed and the key,
+    so that the streams of different keys are practically independent and the
+    seed of a key does not depend on which other seeds are derived or in which
+    order. The seed is in the range [0, 2**31-1) accepted by Stan and
+    RandomState.
+    
+    Example:
+        >>> seed = derive_seed(root, site, iteration)
+    
+    """
+    data = struct.pack('<{}q'.format(len(key)+1), *map(int, (root,)+key))
+    return int(int(hashlib.sha256(data).hexdigest()[:16], 16) % (2**31-1))
+
+
 def get_last_sample(fit, out=None):
     """Extract the last sample from a PyStan fit object.
     
@@ -446,6 +739,10 @@ def get_last_sample(fit, out=None):
     return out
 
 
+# Models loaded by load_stan in this process by their absolute filename
+_loaded_models = {}
+
+
 def load_stan(filename, overwrite=False):
     """Load or compile a stan model.
     
@@ -456,18 +753,27 @@ def load_stan(filename, overwrite=False):
         '.stan' or '.pkl'. If a respective file with ending '.pkl' is found,
         the model is not built but loaded from the pickle file (unless
         `overwrite` is True). Otherwise the model is compiled from the
-        respective file ending with '.stan' and saved into '.pkl' file.
+        respective file ending with '.stan' and saved into '.pkl' file. A
+        model loaded once is reused in the same process.
     overwrite : bool
         Compile and save a new model even if a pickled model with same name
         already exists.
     
     """
+    # Imported here so that the rest of the module works without PyStan
+    from pystan import StanModel
+    
     # Remove '.pkl' or '.stan' endings
     if filename.endswith('.pkl'):
         filename = filename[:-4]
     elif filename.endswith('.stan'):
         filename = filename[:-5]
     
+    key = os.path.abspath(filename)
+    if not overwrite and _loaded_models.has_key(key):
+        # Already loaded
+        return _loaded_models[key]
+    
     if not overwrite and os.path.isfile(filename+'.pkl'):
         # Use precompiled model
         with open(filename+'.pkl', 'rb') as f:
@@ -492,6 +798,7 @@ def load_stan(filename, overwrite=False):
     else:
         raise IOError("File {} or {} not found"
                       .format(filename+'.stan', filename+'.pkl'))
+    _loaded_models[key] = sm
     return sm
 
 
@@ -523,9 +830,11 @@ class suppress_stdout(object):
         # Re-assign the real stdout/stderr back to (1) and (2)
         os.dup2(self.save_fds[0],1)
         os.dup2(self.save_fds[1],2)
-        # Close the null files
+        # Close the null files and the saved descriptors
         os.close(self.null_fds[0])
         os.close(self.null_fds[1])
+        os.close(self.save_fds[0])
+        os.close(self.save_fds[1])
 # <<< Temp solution to suppres output from STAN model (remove when fixed)
 
 
@@ -14,6 +14,7 @@ https://github.com/gelman/ep-stan
 
 from __future__ import division
 import os
+import shutil
 import numpy as np
 
 # Add parent dir to sys.path if not present already. This is only done because
@@ -28,11 +29,24 @@ if os.path.exists(os.path.join(parent_dir, 'dep')):
         os.sys.path.insert(0, parent_dir)
 
 from dep.serial import Master
+from dep.store import ResultsStore
 from dep.util import load_stan, suppress_stdout
 
 
-def fit_distributed(model_name, niter, J, K, Nj, X, y, phi_true, options):
-    """Fit distributed model and save the results."""
+def fit_distributed(model_name, niter, J, K, Nj, X, y, phi_true, options,
+                    filename=None, overwrite=False):
+    """Fit distributed model and save the results.
+    
+    The results are saved into `filename`, results/res_d_<model_name>.npz by
+    default, and the results of each iteration into the directory of the same
+    name without the ending and with the postfix _store. If the store already
+    exists, the iterations are appended into it (see dep.store.ResultsStore),
+    unless `overwrite` is True, in which case the existing store is removed.
+    
+    """
+    
+    if filename is None:
+        filename = 'results/res_d_{}.npz'.format(model_name)
     
     print "Distributed model {} ...".format(model_name)
     
@@ -121,9 +135,13 @@ def fit_distributed(model_name, niter, J, K, Nj, X, y, phi_true, options):
     else:
         raise ValueError("K cant be greater than number of samples")
     
-    # Run the algorithm for `niter` iterations
+    # Run the algorithm for `niter` iterations recording the results of each
+    # iteration into an on-disk store (see dep.store.load_results)
     print "Run distributed EP algorithm for {} iterations.".format(niter)
-    m_phi, var_phi = dep_master.run(niter)
+    store_path = os.path.splitext(filename)[0] + '_store'
+    if overwrite and os.path.exists(store_path):
+        shutil.rmtree(store_path)
+    m_phi, var_phi = dep_master.run(niter, hooks=ResultsStore(store_path))
     print "Form the final approximation " \
           "by mixing the samples from all the sites."
     S_mix, m_mix = dep_master.mix_samples()
@@ -131,9 +149,7 @@ def fit_distributed(model_name, niter, J, K, Nj, X, y, phi_true, options):
     
     print "Distributed model sampled."
     
-    if not os.path.exists('results'):
-        os.makedirs('results')
-    np.savez('results/res_d_{}.npz'.format(model_name),
+    np.savez(filename,
         phi_true=phi_true,
         m_phi=m_phi,
         var_phi=var_phi,
@@ -142,8 +158,18 @@ def fit_distributed(model_name, niter, J, K, Nj, X, y, phi_true, options):
     )
 
 
-def fit_full(model_name, J, j_ind, X, y, phi_true, m0, Q0, seed):
-    """Fit full model and save the results."""
+def fit_full(model_name, J, j_ind, X, y, phi_true, m0, Q0, seed, n_jobs=-1,
+             filename=None):
+    """Fit full model and save the results.
+    
+    The chains are sampled with `n_jobs` processes (see StanModel.sampling).
+    The results are saved into `filename`, results/res_f_<model_name>.npz by
+    default.
+    
+    """
+    
+    if filename is None:
+        filename = 'results/res_f_{}.npz'.format(model_name)
     
     print "Full model {} ...".format(model_name)
     
@@ -167,7 +193,8 @@ def fit_full(model_name, J, j_ind, X, y, phi_true, m0, Q0, seed):
             chains=4,
             iter=1000,
             warmup=500,
-            thin=2
+            thin=2,
+            n_jobs=n_jobs
         )
     samp = fit.extract(pars='phi')['phi']
     m_phi_full = samp.mean(axis=0)
@@ -176,9 +203,10 @@ def fit_full(model_name, J, j_ind, X, y, phi_true, m0, Q0, seed):
     print "Full model sampled."
     
     
-    if not os.path.exists('results'):
-        os.makedirs('results')
-    np.savez('results/res_f_{}.npz'.format(model_name),
+    res_dir = os.path.dirname(filename)
+    if res_dir and not os.path.exists(res_dir):
+        os.makedirs(res_dir)
+    np.savez(filename,
         phi_true=phi_true,
         m_phi_full=m_phi_full,
         var_phi_full=var_phi_full,
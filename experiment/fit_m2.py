@@ -38,6 +38,7 @@ import os
 import numpy as np
 
 from fit import fit_distributed, fit_full
+from dep.simulate import simulate_m2
 
 
 # ------------------------------------------------------------------------------
@@ -74,6 +75,7 @@ CHAINS = 4
 ITER = 800
 WARMUP = 400
 THIN = 2
+N_JOBS = -1         # Processes sampling the chains (-1 for all cores)
 
 # ====== Number of EP iterations ===============================================
 EP_ITER = 6
@@ -82,17 +84,19 @@ EP_ITER = 6
 # Available options are 'sample' and 'olse', see class serial.Master.
 PREC_ESTIM = 'olse'
 
-# ====== 32bit Python ? ========================================================
-# Temp fix for the RandomState seed problem with pystan in 32bit Python. Set
-# the following to True if using 32bit Python.
-TMP_FIX_32BIT = False
-
 # ------------------------------------------------------------------------------
 # <<<<<<<<<<<<< Configurations end <<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
 # ------------------------------------------------------------------------------
 
 
-def main(mtype='both'):
+def main(mtype='both', filename_d=None, filename_f=None):
+    """Simulate the data and fit the model(s).
+    
+    The results of the distributed and the full model are saved into
+    `filename_d` and `filename_f` respectively (see fit.fit_distributed and
+    fit.fit_full for the defaults).
+    
+    """
     
     # Check mtype
     if mtype != 'both' and mtype != 'full' and mtype != 'distributed':
@@ -104,43 +108,11 @@ def main(mtype='both'):
     #     Simulate data
     # ------------------------------------------------------
     
-    # Set seed
-    rnd_data = np.random.RandomState(seed=SEED_DATA)
-    
-    # Parameters
-    # Number of observations for each group
-    if hasattr(NPG, '__getitem__') and len(NPG) == 2:
-        Nj = rnd_data.randint(NPG[0],NPG[1]+1, size=J)
-    else:
-        Nj = NPG*np.ones(J, dtype=np.int64)
-    # Total number of observations
-    N = np.sum(Nj)
-    # Observation index limits for J groups
-    j_lim = np.concatenate(([0], np.cumsum(Nj)))
-    # Group indices for each sample
-    j_ind = np.empty(N, dtype=np.int64)
-    for j in xrange(J):
-        j_ind[j_lim[j]:j_lim[j+1]] = j
-    
-    # Assign parameters
-    if SIGMA_A is None:
-        sigma_a = np.exp(rnd_data.randn()*SIGMA_AH)
-    else:
-        sigma_a = SIGMA_A
-    sigma_b = np.exp(rnd_data.randn(D)*SIGMA_BH)
-    alpha_j = rnd_data.randn(J)*sigma_a
-    beta_j = rnd_data.randn(J,D)*sigma_b
-    phi_true = np.append(np.log(sigma_a), np.log(sigma_b))
+    X, y, j_ind, Nj, phi_true = simulate_m2(
+        J, D, NPG, seed=SEED_DATA, sigma_a=SIGMA_A, sigma_aH=SIGMA_AH,
+        sigma_bH=SIGMA_BH)
     dphi = D+1  # Number of shared parameters
     
-    # Simulate data
-    X = rnd_data.randn(N,D)
-    y = np.empty(N)
-    for n in xrange(N):
-        y[n] = alpha_j[j_ind[n]] + X[n].dot(beta_j[j_ind[n]])
-    y = 1/(1+np.exp(-y))
-    y = (rnd_data.rand(N) < y).astype(int)
-    
     # ------------------------------------------------------
     #     Prior
     # ------------------------------------------------------
@@ -168,21 +140,16 @@ def main(mtype='both'):
             'iter'       : ITER,
             'warmup'     : WARMUP,
             'thin'       : THIN,
+            'n_jobs'     : N_JOBS,
             'prior'      : prior
         }
-        # Temp fix for the RandomState seed problem with pystan in 32bit Python
-        options['tmp_fix_32bit'] = TMP_FIX_32BIT
-        
-        fit_distributed(model_name, EP_ITER, J, K, Nj, X, y, phi_true, options)
+        fit_distributed(model_name, EP_ITER, J, K, Nj, X, y, phi_true, options,
+                        filename=filename_d)
     
     if mtype == 'both' or mtype == 'full':
         
-        seed = np.random.RandomState(seed=SEED_MCMC)
-        
-        # Temp fix for the RandomState seed problem with pystan in 32bit Python
-        seed = seed.randint(2**31-1) if TMP_FIX_32BIT else seed
-        
-        fit_full(model_name, J, j_ind, X, y, phi_true, m0, Q0, seed)
+        fit_full(model_name, J, j_ind, X, y, phi_true, m0, Q0, SEED_MCMC,
+                 n_jobs=N_JOBS, filename=filename_f)
     
 
 if __name__ == '__main__':
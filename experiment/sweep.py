@@ -0,0 +1,404 @@
+"""Run the experiments over a grid of configurations in parallel.
+
+The experiment scripts fit_m1.py, fit_m2.py, fit_m3.py and
+../stars_sim/distributed.py are configured with their module level constants.
+This script runs a script with every combination of the given values of the
+constants J, K, NPG, PREC_ESTIM, SEED_DATA and SEED_MCMC in a pool of
+processes, the other constants keeping their values in the script.
+
+Execute with:
+    $ python sweep.py <model> [options]
+where <model> is one of m1, m2, m3 or stars. For example
+    $ python sweep.py m1 --K 2 10 22 --prec-estim sample olse --seed 0 1 2
+fits the distributed model m1 with 18 configurations. See
+    $ python sweep.py --help
+for all the options.
+
+The stan models are compiled (if necessary) and loaded once before the runs
+are started, so that the processes of the pool share them. The processes run
+max(1, cores // jobs_per_run) configurations at a time, each sampling its
+chains with `jobs_per_run` processes (the constant N_JOBS of the script). The
+processes of the pool are not daemonic, so that PyStan can start its own
+processes for the chains. The results of each configuration are
+saved into the output directory as <tag>.npz, where the tag identifies the
+configuration, the output of the run into <tag>.log and a summary into
+<tag>.json. Configurations whose results already exist are skipped, so an
+interrupted sweep can be continued by running the same command again. The
+results of all the configurations are finally gathered into the table
+table.csv in the output directory.
+
+The most recent version of the code can be found on GitHub:
+https://github.com/gelman/ep-stan
+
+"""
+
+# Licensed under the 3-clause BSD license.
+# http://opensource.org/licenses/BSD-3-Clause
+#
+# Copyright (C) 2014 Tuomas Sivula
+# All rights reserved.
+
+from __future__ import division
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+import itertools
+import traceback
+import multiprocessing
+import multiprocessing.pool
+import numpy as np
+
+# Add parent dir to sys.path if not present already. This is only done because
+# of easy importing of the package dep. Adding the parent directory into the
+# PYTHONPATH works as well.
+parent_dir = os.path.abspath(os.path.join(
+                os.path.dirname(os.path.abspath(__file__)),
+                os.pardir))
+# Double check that the package is in the parent directory
+if os.path.exists(os.path.join(parent_dir, 'dep')):
+    if parent_dir not in os.sys.path:
+        os.sys.path.insert(0, parent_dir)
+
+from dep.serial import Worker
+from dep.util import load_stan
+
+
+EXPERIMENT_DIR = os.path.dirname(os.path.abspath(__file__))
+STARS_DIR = os.path.join(parent_dir, 'stars_sim')
+
+# Script directory, module name and the stan models of each experiment
+EXPERIMENTS = {
+    'm1'    : (EXPERIMENT_DIR, 'fit_m1', ('m1', 'm1_sg')),
+    'm2'    : (EXPERIMENT_DIR, 'fit_m2', ('m2', 'm2_sg')),
+    'm3'    : (EXPERIMENT_DIR, 'fit_m3', ('m3', 'm3_sg')),
+    'stars' : (STARS_DIR, 'distributed', ('model',))
+}
+
+# The grid axes: command line option, constant in the script, tag prefix
+AXES = (
+    ('J', 'J', 'J'),
+    ('K', 'K', 'K'),
+    ('npg', 'NPG', 'npg'),
+    ('prec_estim', 'PREC_ESTIM', ''),
+    ('seed_data', 'SEED_DATA', 'sd'),
+    ('seed', 'SEED_MCMC', 's')
+)
+
+# The columns of the results table
+TABLE_COLUMNS = (
+    ['model', 'tag', 'status', 'wall']
+    + [const for (_, const, _) in AXES]
+    + ['err_mean', 'err_mix_mean', 'err_full_mean', 'err_full_var']
+)
+
+
+def _import(model):
+    """Import the script module of the experiment `model`."""
+    script_dir, module_name, _ = EXPERIMENTS[model]
+    if script_dir not in sys.path:
+        sys.path.insert(0, script_dir)
+    return __import__(module_name)
+
+
+def _parse_npg(val):
+    """Parse NPG given as 'n' or 'min,max'."""
+    vals = [int(v) for v in val.split(',')]
+    if len(vals) == 1:
+        return vals[0]
+    elif len(vals) == 2:
+        return vals
+    raise argparse.ArgumentTypeError("NPG should be 'n' or 'min,max'")
+
+
+def _tag_value(val):
+    if isinstance(val, (list, tuple)):
+        return '-'.join(str(v) for v in val)
+    return str(val)
+
+
+def make_tag(model, config, full=False):
+    """Form the name identifying a configuration."""
+    parts = [model]
+    if full:
+        parts.append('full')
+    for (_, const, prefix) in AXES:
+        if full and const in ('K', 'PREC_ESTIM'):
+            # The full model does not depend on these
+            continue
+        parts.append(prefix + _tag_value(config[const]))
+    return '_'.join(parts)
+
+
+class _redirect_output(object):
+    """Redirect stdout and stderr, also of compiled code, into a file."""
+    
+    def __init__(self, filename):
+        self.filename = filename
+    
+    def __enter__(self):
+        sys.stdout.flush()
+        sys.stderr.flush()
+        self.fd = os.open(self.filename,
+                          os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+        self.save_fds = (os.dup(1), os.dup(2))
+        os.dup2(self.fd, 1)
+        os.dup2(self.fd, 2)
+    
+    def __exit__(self, *_):
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(self.save_fds[0], 1)
+        os.dup2(self.save_fds[1], 2)
+        os.close(self.save_fds[0])
+        os.close(self.save_fds[1])
+        os.close(self.fd)
+
+
+class _NonDaemonProcess(multiprocessing.Process):
+    """Process that is never daemonic and can thus have children."""
+    
+    def _get_daemon(self):
+        return False
+    
+    def _set_daemon(self, value):
+        pass
+    
+    daemon = property(_get_daemon, _set_daemon)
+
+
+class _NonDaemonPool(multiprocessing.pool.Pool):
+    """Pool whose processes can start their own processes."""
+    Process = _NonDaemonProcess
+
+
+def run_config(task):
+    """Run one configuration of an experiment (in a process of the pool).
+    
+    Parameters
+    ----------
+    task : dict
+        Contains the name of the experiment `model`, the values of the
+        constants `config`, the `tag` of the configuration, the `full` flag
+        indicating if the full model is fit instead of the distributed one,
+        the number of processes `n_jobs` sampling the chains and the output
+        directory `out_dir`.
+    
+    Returns
+    -------
+    tag : str
+        The tag of the configuration.
+    
+    status : str
+        'ok' or the error message.
+    
+    wall : float
+        The wall time of the run.
+    
+    """
+    model = task['model']
+    tag = task['tag']
+    out_base = os.path.join(task['out_dir'], tag)
+    # Reload to reset the constants possibly altered by a previous task
+    module = reload(_import(model))
+    for (const, val) in task['config'].iteritems():
+        setattr(module, const, val)
+    # Limit the processes used for the chains
+    module.N_JOBS = task['n_jobs']
+    os.chdir(EXPERIMENTS[model][0])
+    t0 = time.time()
+    with _redirect_output(out_base + '.log'):
+        try:
+            if model == 'stars':
+                module.main(out_base + '.npz')
+            elif task['full']:
+                module.main('full', filename_f=out_base + '.npz')
+            else:
+                module.main('distributed', filename_d=out_base + '.npz')
+            status = 'ok'
+        except Exception as e:
+            traceback.print_exc()
+            status = 'error: {}'.format(e)
+    wall = time.time() - t0
+    with open(out_base + '.json', 'w') as f:
+        json.dump({'model': model, 'tag': tag, 'full': task['full'],
+                   'config': task['config'], 'status': status, 'wall': wall},
+                  f, indent=1, sort_keys=True)
+    return tag, status, wall
+
+
+def _rmse(a, b):
+    return np.sqrt(np.mean((np.asarray(a) - np.asarray(b))**2))
+
+
+def gather_table(tasks, out_dir):
+    """Gather the results of the distributed configurations into a table.
+    
+    The errors are root mean squared errors of the final posterior
+    approximation mean (`err_mean`) and of the mean of the mixed samples
+    (`err_mix_mean`) against the true phi, and of the final approximation mean
+    and variance against the full model (`err_full_mean`, `err_full_var`) if
+    it was fit.
+    
+    """
+    rows = []
+    for task in tasks:
+        if task['full']:
+            continue
+        out_base = os.path.join(out_dir, task['tag'])
+        row = dict((col, '') for col in TABLE_COLUMNS)
+        row['model'] = task['model']
+        row['tag'] = task['tag']
+        for (const, val) in task['config'].iteritems():
+            row[const] = _tag_value(val)
+        if os.path.exists(out_base + '.json'):
+            with open(out_base + '.json', 'r') as f:
+                summary = json.load(f)
+            row['status'] = summary['status']
+            row['wall'] = '{:.1f}'.format(summary['wall'])
+        if os.path.exists(out_base + '.npz'):
+            res = np.load(out_base + '.npz')
+            row['err_mean'] = _rmse(res['m_phi'][-1], res['phi_true'])
+            row['err_mix_mean'] = _rmse(res['m_mix'], res['phi_true'])
+            full_file = task.get('full_file')
+            if full_file and os.path.exists(full_file):
+                res_f = np.load(full_file)
+                row['err_full_mean'] = _rmse(res['m_phi'][-1],
+                                             res_f['m_phi_full'])
+                row['err_full_var'] = _rmse(res['var_phi'][-1],
+                                            res_f['var_phi_full'])
+        rows.append(row)
+    with open(os.path.join(out_dir, 'table.csv'), 'wb') as f:
+        writer = csv.DictWriter(f, TABLE_COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+    return rows
+
+
+def make_tasks(model, grid, out_dir, full=False):
+    """Form the tasks of every configuration in the grid.
+    
+    Parameters
+    ----------
+    model : str
+        The name of the experiment.
+    
+    grid : dict
+        The list of values of each varied constant. The other constants of
+        the AXES keep their value in the script.
+    
+    out_dir : str
+        The output directory.
+    
+    full : bool, optional
+        If True, the full model is also fit for every distinct data set and
+        MCMC seed (not available for the experiment stars).
+    
+    """
+    module = _import(model)
+    values = [grid.get(const, [getattr(module, const)])
+              for (_, const, _) in AXES]
+    consts = [const for (_, const, _) in AXES]
+    tasks = []
+    full_tasks = {}
+    for combination in itertools.product(*values):
+        config = dict(zip(consts, combination))
+        task = {'model': model, 'config': config, 'out_dir': out_dir,
+                'tag': make_tag(model, config), 'full': False}
+        if full:
+            full_tag = make_tag(model, config, full=True)
+            task['full_file'] = os.path.join(out_dir, full_tag + '.npz')
+            if not full_tasks.has_key(full_tag):
+                full_tasks[full_tag] = {
+                    'model': model, 'config': config, 'out_dir': out_dir,
+                    'tag': full_tag, 'full': True}
+        tasks.append(task)
+    # Start with the full models
+    return full_tasks.values() + tasks
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Run an experiment over a grid of configurations.")
+    parser.add_argument('model', choices=sorted(EXPERIMENTS.keys()),
+                        help="the experiment")
+    parser.add_argument('--J', type=int, nargs='+',
+                        help="numbers of hierarchical groups")
+    parser.add_argument('--K', type=int, nargs='+',
+                        help="numbers of sites")
+    parser.add_argument('--npg', type=_parse_npg, nargs='+',
+                        help="observations per group, 'n' or 'min,max'")
+    parser.add_argument('--prec-estim', dest='prec_estim', nargs='+',
+                        choices=Worker.PREC_ESTIM_OPTIONS,
+                        help="tilted precision estimate methods")
+    parser.add_argument('--seed-data', dest='seed_data', type=int, nargs='+',
+                        help="seeds for simulating the data")
+    parser.add_argument('--seed', type=int, nargs='+',
+                        help="seeds for the inference")
+    parser.add_argument('--full', action='store_true',
+                        help="fit also the full models for comparison")
+    parser.add_argument('--cores', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help="the number of cores available "
+                             "(default: all)")
+    parser.add_argument('--jobs-per-run', dest='jobs_per_run', type=int,
+                        default=1,
+                        help="processes sampling the chains in each run "
+                             "(default: 1)")
+    parser.add_argument('--out', default=os.path.join('results', 'sweep'),
+                        help="the output directory (default: results/sweep)")
+    args = parser.parse_args(argv)
+    
+    if args.full and args.model == 'stars':
+        parser.error("The full model is not available for stars")
+    out_dir = os.path.abspath(args.out)
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    grid = {}
+    for (option, const, _) in AXES:
+        vals = getattr(args, option)
+        if vals is not None:
+            grid[const] = vals
+    tasks = make_tasks(args.model, grid, out_dir, full=args.full)
+    
+    # Skip the configurations already done
+    todo = []
+    for task in tasks:
+        summary = os.path.join(out_dir, task['tag'] + '.json')
+        done = False
+        if os.path.exists(summary):
+            with open(summary, 'r') as f:
+                done = json.load(f)['status'] == 'ok'
+        if not done:
+            task['n_jobs'] = args.jobs_per_run
+            todo.append(task)
+    print "{} configurations, {} already done.".format(
+        len(tasks), len(tasks) - len(todo))
+    
+    if todo:
+        # Compile and load the models once, shared by the forked processes
+        script_dir, _, models = EXPERIMENTS[args.model]
+        for name in models:
+            load_stan(os.path.join(script_dir, name))
+        nproc = max(1, args.cores // args.jobs_per_run)
+        print "Running in {} processes.".format(nproc)
+        pool = _NonDaemonPool(nproc)
+        try:
+            for (tag, status, wall) in pool.imap_unordered(run_config, todo):
+                print "{}: {} ({:.1f} s)".format(tag, status, wall)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    
+    rows = gather_table(tasks, out_dir)
+    print "Results of {} configurations gathered into {}.".format(
+        len(rows), os.path.join(out_dir, 'table.csv'))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,14 +3,36 @@
 Compile with:
     $ python setup.py build_ext --inplace
 
+The kernels can be parallelised with OpenMP by compiling with:
+    $ python setup.py build_ext --inplace --openmp
+The number of threads is controlled with the environment variable
+OMP_NUM_THREADS.
+
 """
 
+import sys
 from distutils.core import setup
+from distutils.extension import Extension
 from Cython.Build import cythonize
 import numpy
 
+# Parse the OpenMP option (not known by distutils)
+if '--openmp' in sys.argv:
+    sys.argv.remove('--openmp')
+    openmp_args = ['-fopenmp']
+else:
+    openmp_args = []
+
+ext = Extension(
+    'dep.cython_util',
+    ['dep/cython_util.pyx'],
+    extra_compile_args = openmp_args,
+    extra_link_args = openmp_args
+)
+
 setup(
-    ext_modules = cythonize("dep/cython_util.pyx"),
+    name = 'ep-stan',
+    packages = ['dep'],
+    ext_modules = cythonize([ext]),
 	include_dirs = [numpy.get_include()]
 )
-
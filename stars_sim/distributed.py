@@ -33,6 +33,7 @@ if os.path.exists(os.path.join(parent_dir, 'dep')):
         os.sys.path.insert(0, parent_dir)
 
 from dep.serial import Master
+from dep.simulate import simulate_stars
 from dep.util import load_stan, suppress_stdout
 
 
@@ -70,6 +71,7 @@ CHAINS = 4
 ITER = 800
 WARMUP = 400
 THIN = 2
+N_JOBS = -1         # Processes sampling the chains (-1 for all cores)
 
 # ====== Number of EP iterations ===============================================
 EP_ITER = 4
@@ -78,11 +80,6 @@ EP_ITER = 4
 # Available options are 'sample' and 'olse', see class serial.Master.
 PREC_ESTIM = 'sample'
 
-# ====== 32bit Python ? ========================================================
-# Temp fix for the RandomState seed problem with pystan in 32bit Python. Set
-# the following to True if using 32bit Python.
-TMP_FIX_32BIT = False
-
 # ------------------------------------------------------------------------------
 # <<<<<<<<<<<<< Configurations end <<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
 # ------------------------------------------------------------------------------
@@ -94,43 +91,14 @@ def main(filename='res.npz'):
     #     Simulate data
     # ------------------------------------------------------
     
-    # Set seed
-    rnd_data = np.random.RandomState(seed=SEED_DATA)
-    
-    # Parameters
-    # Number of observations for each group
-    if hasattr(NPG, '__getitem__') and len(NPG) == 2:
-        Nj = rnd_data.randint(NPG[0],NPG[1]+1, size=J)
-    else:
-        Nj = NPG*np.ones(J, dtype=np.int64)
-    # Total number of observations
-    N = np.sum(Nj)
+    X, y, j_ind, Nj, phi_true = simulate_stars(
+        J, NPG, seed=SEED_DATA, mu=MU, tau=TAU, beta=BETA, sigma=SIGMA,
+        x_mu=X_MU, x_std=X_STD)
+    N = len(y)
     # Observation index limits for J groups
     j_lim = np.concatenate(([0], np.cumsum(Nj)))
-    # Group indices for each sample
-    j_ind = np.empty(N, dtype=np.int64)
-    for j in xrange(J):
-        j_ind[j_lim[j]:j_lim[j+1]] = j
-    
-    # Assign parameters
-    alpha_j = MU + rnd_data.randn(J)*TAU
-    phi_true = np.log([MU, TAU, BETA, SIGMA])
     dphi = 4  # Number of shared parameters
     
-    # Simulate data
-    # Truncated normal rejection sampling
-    X = X_MU + rnd_data.randn(N)*X_STD
-    xneg = X<0
-    while np.any(xneg):
-        X[xneg] = X_MU + rnd_data.randn(np.count_nonzero(xneg))*X_STD
-        xneg = X<0
-    f = alpha_j[j_ind] + X*BETA
-    y = f + rnd_data.randn(N)*SIGMA
-    yneg = y<0
-    while np.any(yneg):
-        y[yneg] = f[yneg] + rnd_data.randn(np.count_nonzero(yneg))*SIGMA
-        yneg = y<0
-    
     # ------------------------------------------------------
     #     Prior
     # ------------------------------------------------------
@@ -157,12 +125,10 @@ def main(filename='res.npz'):
         'chains'     : CHAINS,
         'iter'       : ITER,
         'warmup'     : WARMUP,
-        'thin'       : THIN
+        'thin'       : THIN,
+        'n_jobs'     : N_JOBS
     }
     
-    # Temp fix for the RandomState seed problem with pystan in 32bit Python
-    options['tmp_fix_32bit'] = TMP_FIX_32BIT
-    
     model = load_stan('model')
     if K < 2:
         raise ValueError("K should be at least 2.")
@@ -33,6 +33,7 @@ if os.path.exists(os.path.join(parent_dir, 'dep')):
         os.sys.path.insert(0, parent_dir)
 
 # from dep.serial import Master
+from dep.simulate import simulate_stars
 from dep.util import load_stan
 
 
@@ -71,11 +72,6 @@ ITER = 1600
 WARMUP = 800
 THIN = 2
 
-# ====== 32bit Python ? ========================================================
-# Temp fix for the RandomState seed problem with pystan in 32bit Python. Set
-# the following to True if using 32bit Python.
-TMP_FIX_32BIT = False
-
 # ------------------------------------------------------------------------------
 # <<<<<<<<<<<<< Configurations end <<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<
 # ------------------------------------------------------------------------------
@@ -87,43 +83,12 @@ def main(filename='res_full.npz'):
     #     Simulate data
     # ------------------------------------------------------
     
-    # Set seed
-    rnd_data = np.random.RandomState(seed=SEED_DATA)
-    
-    # Parameters
-    # Number of observations for each group
-    if hasattr(NPG, '__getitem__') and len(NPG) == 2:
-        Nj = rnd_data.randint(NPG[0],NPG[1]+1, size=J)
-    else:
-        Nj = NPG*np.ones(J, dtype=np.int64)
-    # Total number of observations
-    N = np.sum(Nj)
-    # Observation index limits for J groups
-    j_lim = np.concatenate(([0], np.cumsum(Nj)))
-    # Group indices for each sample
-    j_ind = np.empty(N, dtype=np.int64)
-    for j in xrange(J):
-        j_ind[j_lim[j]:j_lim[j+1]] = j
-    
-    # Assign parameters
-    alpha_j = MU + rnd_data.randn(J)*TAU
-    phi_true = np.log([MU, TAU, BETA, SIGMA])
+    X, y, j_ind, Nj, phi_true = simulate_stars(
+        J, NPG, seed=SEED_DATA, mu=MU, tau=TAU, beta=BETA, sigma=SIGMA,
+        x_mu=X_MU, x_std=X_STD)
+    N = len(y)
     dphi = 4  # Number of shared parameters
     
-    # Simulate data
-    # Truncated normal rejection sampling
-    X = X_MU + rnd_data.randn(N)*X_STD
-    xneg = X<0
-    while np.any(xneg):
-        X[xneg] = X_MU + rnd_data.randn(np.count_nonzero(xneg))*X_STD
-        xneg = X<0
-    f = alpha_j[j_ind] + X*BETA
-    y = f + rnd_data.randn(N)*SIGMA
-    yneg = y<0
-    while np.any(yneg):
-        y[yneg] = f[yneg] + rnd_data.randn(np.count_nonzero(yneg))*SIGMA
-        yneg = y<0
-    
     # ------------------------------------------------------
     #     Prior
     # ------------------------------------------------------
@@ -142,9 +107,6 @@ def main(filename='res_full.npz'):
     
     print "Full model..."
     
-    # Set seed
-    rnd_mcmc = np.random.RandomState(seed=SEED_MCMC)
-    
     data = dict(
         N=N,
         J=J,
@@ -159,7 +121,7 @@ def main(filename='res_full.npz'):
     model = load_stan('model')
     fit = model.sampling(
         data=data,
-        seed=(rnd_mcmc.randint(2**31-1) if TMP_FIX_32BIT else rnd_mcmc),
+        seed=SEED_MCMC,
         chains=CHAINS,
         iter=ITER,
         warmup=WARMUP,
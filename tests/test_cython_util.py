@@ -0,0 +1,77 @@
+"""Tests for the Cython kernels in the module dep.cython_util.
+
+The most recent version of the code can be found on GitHub:
+https://github.com/gelman/ep-stan
+
+"""
+
+# Licensed under the 3-clause BSD license.
+# http://opensource.org/licenses/BSD-3-Clause
+#
+# Copyright (C) 2014 Tuomas Sivula
+# All rights reserved.
+
+from __future__ import division
+import numpy as np
+from numpy.testing import assert_allclose, assert_array_equal
+import pytest
+
+from dep.cython_util import cho_inv_stack, bucket_argsort
+
+
+def test_cho_inv_stack_matches_inv():
+    rs = np.random.RandomState(0)
+    d, K = 6, 5
+    A = np.empty((d,d,K), order='F')
+    for k in xrange(K):
+        M = rs.randn(d, d)
+        A[:,:,k] = M.dot(M.T) + np.eye(d)
+    A[:,:,0] = np.diag(np.arange(1, d+1))
+    A[0,0,2] = -1
+    b = np.asfortranarray(rs.randn(d, K))
+    A_orig = A.copy()
+    b_orig = b.copy()
+    info = np.empty(K, dtype=np.intc)
+    cho_inv_stack(A, b, info)
+    assert_array_equal(info == 0, np.arange(K) != 2)
+    for k in xrange(K):
+        if k == 2:
+            continue
+        inv = np.linalg.inv(A_orig[:,:,k])
+        assert_allclose(A[:,:,k], inv, rtol=1e-10, atol=1e-12)
+        assert_allclose(b[:,k], inv.dot(b_orig[:,k]), rtol=1e-10)
+
+
+def test_cho_inv_stack_without_b():
+    rs = np.random.RandomState(1)
+    d, K = 3, 4
+    M = rs.randn(K, d, d)
+    A = np.asfortranarray(np.einsum('kij,klj->ilk', M, M)
+                          + 0.5*np.eye(d)[:,:,np.newaxis])
+    A_orig = A.copy()
+    info = np.empty(K, dtype=np.intc)
+    cho_inv_stack(A, None, info)
+    assert (info == 0).all()
+    for k in xrange(K):
+        assert_allclose(A[:,:,k], np.linalg.inv(A_orig[:,:,k]), rtol=1e-10)
+
+
+@pytest.mark.parametrize('dtype', [np.int32, np.int64, np.intp])
+def test_bucket_argsort_matches_mergesort(dtype):
+    rs = np.random.RandomState(0)
+    N, K = 1000, 37
+    k_ind = rs.randint(K, size=N).astype(dtype)
+    # Leave some buckets empty
+    k_ind[k_ind == 5] = 6
+    counts = np.empty(K, dtype=np.intp)
+    out = np.empty(N, dtype=np.intp)
+    bucket_argsort(k_ind, counts, out)
+    assert_array_equal(out, np.argsort(k_ind, kind='mergesort'))
+    assert_array_equal(counts, np.bincount(k_ind, minlength=K))
+
+
+def test_bucket_argsort_out_of_range():
+    counts = np.empty(3, dtype=np.intp)
+    out = np.empty(4, dtype=np.intp)
+    with pytest.raises(ValueError):
+        bucket_argsort(np.array([0, 1, 3, 2], dtype=np.intp), counts, out)
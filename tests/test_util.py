@@ -0,0 +1,203 @@
+"""Tests for the module dep.util.
+
+Run from the root of the repository with:
+    $ python setup.py build_ext --inplace
+    $ python -m pytest
+
+The most recent version of the code can be found on GitHub:
+https://github.com/gelman/ep-stan
+
+"""
+
+# Licensed under the 3-clause BSD license.
+# http://opensource.org/licenses/BSD-3-Clause
+#
+# Copyright (C) 2014 Tuomas Sivula
+# All rights reserved.
+
+from __future__ import division
+import warnings
+import numpy as np
+from numpy.testing import assert_allclose
+from scipy import linalg
+import pytest
+
+from dep.util import (
+    cv_moments,
+    invert_normal_params_stack,
+    merge_moments,
+    root_seed,
+    derive_seed
+)
+
+
+@pytest.mark.parametrize('K', [1, 2, 5, 8])
+def test_merge_moments_matches_np_cov(K):
+    rs = np.random.RandomState(K)
+    d = 3
+    n = rs.randint(2, 40, size=K)
+    sets = [rs.randn(nk, d)*[1, 10, 0.1] + [5, -2, 1e3] for nk in n]
+    m = np.array([x.mean(axis=0) for x in sets])
+    M2 = np.array([np.cov(x, rowvar=0)*(len(x)-1) for x in sets])
+    n_tot, m_tot, M2_tot = merge_moments(n, m, M2)
+    samp = np.concatenate(sets)
+    assert n_tot == n.sum()
+    assert_allclose(m_tot, samp.mean(axis=0), rtol=1e-12)
+    assert_allclose(M2_tot/(n_tot-1), np.cov(samp, rowvar=0), rtol=1e-10)
+
+
+def test_derive_seed_is_stable():
+    # Fixed by the SHA-256 hash, independent of the platform and the process
+    assert derive_seed(0, 1, 2) == 347101706
+    assert derive_seed(123) == 1172915085
+    assert derive_seed(2**40, 3) == 360353289
+    assert derive_seed(np.int64(0), np.int32(1), 2) == derive_seed(0, 1, 2)
+    assert type(derive_seed(0, 1)) is int
+
+
+def test_derive_seed_is_distinct():
+    keys = [(k, i) for k in xrange(50) for i in xrange(20)]
+    seeds = [derive_seed(7, *key) for key in keys]
+    assert len(set(seeds)) == len(keys)
+    assert all(0 <= s < 2**31-1 for s in seeds)
+    # Neither the order of the arguments nor the root seed collide
+    assert derive_seed(7, 1, 2) != derive_seed(7, 2, 1)
+    assert derive_seed(7, 1) != derive_seed(8, 1)
+    assert derive_seed(7, 1) != derive_seed(7, 1, 0)
+
+
+def test_root_seed():
+    assert root_seed(5) == 5
+    a = root_seed(np.random.RandomState(3))
+    assert a == root_seed(np.random.RandomState(3))
+    assert 0 <= root_seed() < 2**31-1
+
+
+def _spd_stack(d, K, seed=0):
+    """Stack of shape (d,d,K) of random symmetric positive definite
+    matrices."""
+    rs = np.random.RandomState(seed)
+    A = rs.randn(K, d, d)
+    A = np.einsum('kij,klj->ilk', A, A)
+    A += d*np.eye(d)[:,:,np.newaxis]
+    return np.asfortranarray(A)
+
+
+def test_invert_normal_params_stack_matches_inv():
+    d, K = 5, 7
+    A = _spd_stack(d, K)
+    b = np.asfortranarray(np.random.RandomState(1).randn(d, K))
+    # Make one of the matrices indefinite
+    A[:,:,3] = -A[:,:,3]
+    out_A, out_b, posdef = invert_normal_params_stack(A, b)
+    assert_allclose(posdef, np.arange(K) != 3)
+    for k in np.nonzero(posdef)[0]:
+        inv = np.linalg.inv(A[:,:,k])
+        assert_allclose(out_A[:,:,k], inv, rtol=1e-10)
+        assert_allclose(out_b[:,k], inv.dot(b[:,k]), rtol=1e-10)
+    # The input is not modified unless requested
+    assert_allclose(A[:,:,3], -_spd_stack(d, K)[:,:,3])
+
+
+def test_invert_normal_params_stack_in_place_float32():
+    d, K = 4, 6
+    A = _spd_stack(d, K).astype(np.float32, order='F')
+    A64 = A.astype(np.float64)
+    out_A, out_b, posdef = invert_normal_params_stack(A, out_A='in_place')
+    assert out_A is A
+    assert out_b is None
+    assert posdef.all()
+    for k in xrange(K):
+        assert_allclose(A[:,:,k], np.linalg.inv(A64[:,:,k]), rtol=1e-4)
+
+
+def _cv_problem(n, d, seed=0):
+    """Samples and normalised log densities of a tilted distribution and the
+    natural parameters of a nearby control variate distribution."""
+    rs = np.random.RandomState(seed)
+    A = rs.randn(d, d)
+    S = A.dot(A.T) + d*np.eye(d)
+    m = rs.randn(d)
+    samp = rs.multivariate_normal(m, S, size=n)
+    cho = linalg.cho_factor(S)
+    dev = samp - m
+    lp = -0.5*np.sum(dev*linalg.cho_solve(cho, dev.T).T, axis=1)
+    lp -= np.sum(np.log(np.diag(cho[0]))) + 0.5*d*np.log(2*np.pi)
+    Q_tilde = np.asfortranarray(linalg.inv(S*1.2))
+    r_tilde = Q_tilde.dot(m + 0.1)
+    return samp, lp, Q_tilde, r_tilde
+
+
+@pytest.mark.parametrize('multiple_cv', [True, False])
+@pytest.mark.parametrize('block_size', [1, 4, 100])
+def test_cv_moments_blocks_match_dense(multiple_cv, block_size):
+    samp, lp, Q_tilde, r_tilde = _cv_problem(400, 4)
+    S_d, m_d, _ = cv_moments(samp.copy(), lp.copy(), Q_tilde, r_tilde,
+                             multiple_cv=multiple_cv, m_treshold=None)
+    S_b, m_b, _ = cv_moments(samp.copy(), lp.copy(), Q_tilde, r_tilde,
+                             multiple_cv=multiple_cv, m_treshold=None,
+                             block_size=block_size)
+    assert_allclose(m_b, m_d, rtol=1e-12)
+    assert_allclose(S_b, S_d, rtol=1e-8, atol=1e-10)
+
+
+def test_cv_moments_small_ridge_matches_dense():
+    samp, lp, Q_tilde, r_tilde = _cv_problem(400, 4)
+    S_d, m_d, _ = cv_moments(samp.copy(), lp.copy(), Q_tilde, r_tilde,
+                             m_treshold=None)
+    S_b, m_b, _ = cv_moments(samp.copy(), lp.copy(), Q_tilde, r_tilde,
+                             m_treshold=None, block_size=3, ridge=1e-12)
+    assert_allclose(S_b, S_d, rtol=1e-6, atol=1e-8)
+
+
+def _cv_cov_reference(samp, lp, Q_tilde, r_tilde, m_hat, ridge=None):
+    """Covariance control variate estimate with a directly solved d2 x d2
+    system, or with a single control variate per element if `ridge` is None.
+    """
+    n, d = samp.shape
+    S_tilde = linalg.inv(Q_tilde)
+    m_tilde = S_tilde.dot(r_tilde)
+    rows, cols = np.triu_indices(d)
+    dev_tilde = samp - m_tilde
+    lp_tilde = -0.5*np.sum(dev_tilde.dot(Q_tilde)*dev_tilde, axis=1)
+    lp_tilde += 0.5*np.linalg.slogdet(Q_tilde)[1] - 0.5*d*np.log(2*np.pi)
+    pr = np.exp(lp_tilde - lp)
+    hc = dev_tilde[:,rows]*dev_tilde[:,cols]*pr[:,np.newaxis]
+    hc -= S_tilde[rows, cols]
+    dev = samp - m_hat
+    f = dev[:,rows]*dev[:,cols]
+    f_hat = f.sum(axis=0)/(n-1)
+    fc = f - f_hat
+    k = n**2/(n-1)**2
+    if ridge is None:
+        a = k*np.sum(fc*hc, axis=0)/np.sum(hc**2, axis=0)
+        f_hat -= a*hc.mean(axis=0)
+    else:
+        var_h = hc.T.dot(hc)
+        var_h += ridge*np.trace(var_h)/len(rows)*np.eye(len(rows))
+        u = np.linalg.solve(var_h, hc.mean(axis=0))
+        f_hat -= k*hc.dot(u).dot(fc)
+    S = np.empty((d,d))
+    S[rows, cols] = f_hat
+    S[cols, rows] = f_hat
+    return S
+
+
+def test_cv_moments_gram_ridge_matches_reference():
+    # d2 = 21 covariance control variates but only 15 samples
+    samp, lp, Q_tilde, r_tilde = _cv_problem(15, 6, seed=1)
+    S_b, m_b, _ = cv_moments(samp.copy(), lp.copy(), Q_tilde, r_tilde,
+                             m_treshold=None, block_size=5, ridge=0.1)
+    S_ref = _cv_cov_reference(samp, lp, Q_tilde, r_tilde, m_b, ridge=0.1)
+    assert_allclose(S_b, S_ref, rtol=1e-8)
+
+
+def test_cv_moments_no_ridge_warns_and_uses_single_cv():
+    samp, lp, Q_tilde, r_tilde = _cv_problem(15, 6, seed=1)
+    with warnings.catch_warnings(record=True) as w:
+        warnings.simplefilter('always')
+        S_b, m_b, _ = cv_moments(samp.copy(), lp.copy(), Q_tilde, r_tilde,
+                                 m_treshold=None, block_size=5)
+    assert any(issubclass(x.category, RuntimeWarning) for x in w)
+    S_ref = _cv_cov_reference(samp, lp, Q_tilde, r_tilde, m_b)
+    assert_allclose(S_b, S_ref, rtol=1e-8)